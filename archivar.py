@@ -0,0 +1,46 @@
+#XONILAB - Archivo histórico
+#Mueve los préstamos devueltos, las deudas pagadas y las reservas pasadas
+#a archivos por semestre (o por año) en data/archivo, dejando en las
+#tablas solo lo vigente. La aplicación lo hace sola al iniciar y cada
+#pocas horas; este script permite hacerlo a mano o con otras opciones.
+#
+#Uso:
+#  python archivar.py
+#  python archivar.py --datos /ruta/data --dias 0 --periodo anio --gzip
+
+import argparse
+
+from start import crear_app, archivar_todo, particiones, TABLAS_ARCHIVO
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Archivo histórico de XONILAB')
+    parser.add_argument('--datos', help='Carpeta de datos (por defecto la de la aplicación)')
+    parser.add_argument('--dias', type=int, help='Días que lo cerrado se queda en las tablas vigentes')
+    parser.add_argument('--periodo', choices=['semestre', 'anio'], help='Un archivo por semestre o por año')
+    parser.add_argument('--gzip', action='store_true', help='Comprimir los archivos con gzip')
+    args = parser.parse_args()
+
+    config = {'COMPACTADOR': False, 'REVISION_VENCIDOS': False, 'ARCHIVADOR': False}
+    if args.datos:
+        config['CSV_FOLDER'] = args.datos
+    if args.dias is not None:
+        config['ARCHIVO_DIAS'] = args.dias
+    if args.periodo:
+        config['ARCHIVO_PERIODO'] = args.periodo
+    if args.gzip:
+        config['ARCHIVO_GZIP'] = True
+    app = crear_app(config)
+
+    with app.app_context():
+        archivadas = archivar_todo()
+        archivos = {tabla: len(particiones(tabla)) for tabla in TABLAS_ARCHIVO}
+
+    if not archivadas:
+        print("Sin cambios: no había filas cerradas para archivar")
+    for tabla, n in archivadas.items():
+        print(f"✅ {tabla}: {n} fila(s) archivadas ({archivos[tabla]} archivo(s))")
+
+
+if __name__ == '__main__':
+    main()
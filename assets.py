@@ -0,0 +1,122 @@
+#XONILAB - Recursos estáticos locales
+#Descarga Bootstrap, jQuery, DataTables y Font Awesome a static/vendor/ y
+#genera static/dist/ con el hash del contenido en cada nombre, variantes
+#precomprimidas (.gz y, si está instalado el módulo brotli, .br) y el
+#manifest.json que usa asset() en las plantillas. Así las páginas no
+#dependen de CDNs externos y el navegador guarda los recursos para siempre.
+#
+#Uso:
+#  python assets.py                 (descarga lo que falte y construye)
+#  python assets.py --sin-descargar (solo construye desde static/vendor/)
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import sys
+import urllib.request
+
+from start import RECURSOS_ESTATICOS, ASSETS_FOLDER, BASE_DIR
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+VENDOR_FOLDER = os.path.join(BASE_DIR, 'static', 'vendor')
+
+# Formatos que ya vienen comprimidos
+SIN_COMPRIMIR = ('.woff2', '.png', '.jpg', '.gif')
+
+
+def descargar(vendor):
+    """Descarga los recursos que aún no estén en static/vendor/"""
+    errores = 0
+    for nombre, url in RECURSOS_ESTATICOS.items():
+        destino = os.path.join(vendor, nombre)
+        if os.path.exists(destino):
+            continue
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        try:
+            with urllib.request.urlopen(url, timeout=30) as respuesta:
+                datos = respuesta.read()
+        except OSError as e:
+            print(f"  ✗ {nombre}: {e}")
+            errores += 1
+            continue
+        with open(destino + '.tmp', 'wb') as f:
+            f.write(datos)
+        os.replace(destino + '.tmp', destino)
+        print(f"  ✓ {nombre} ({len(datos) / 1024:.1f} KB)")
+    return errores
+
+
+def escribir(ruta, datos):
+    with open(ruta + '.tmp', 'wb') as f:
+        f.write(datos)
+    os.replace(ruta + '.tmp', ruta)
+
+
+def construir(vendor, dist):
+    """Copia cada recurso a dist/ con hash en el nombre y sus variantes comprimidas"""
+    os.makedirs(dist, exist_ok=True)
+    manifiesto = {}
+    faltantes = []
+    # Primero las fuentes: las hojas de estilo se reescriben con sus nombres finales
+    for nombre in sorted(RECURSOS_ESTATICOS, key=lambda n: (n.endswith('.css'), n)):
+        origen = os.path.join(vendor, nombre)
+        if not os.path.exists(origen):
+            faltantes.append(nombre)
+            continue
+        with open(origen, 'rb') as f:
+            datos = f.read()
+        if nombre.endswith('.css'):
+            texto = datos.decode('utf-8')
+            fuentes = [n for n in RECURSOS_ESTATICOS if n.startswith('webfonts/') and '../' + n in texto]
+            if any(n not in manifiesto for n in fuentes):
+                # Sin todas sus fuentes la hoja local quedaría rota
+                faltantes.append(nombre)
+                continue
+            for logico in fuentes:
+                texto = texto.replace('../' + logico, manifiesto[logico])
+            datos = texto.encode('utf-8')
+
+        base, extension = os.path.splitext(os.path.basename(nombre))
+        final = f"{base}.{hashlib.sha256(datos).hexdigest()[:12]}{extension}"
+        destino = os.path.join(dist, final)
+        if not os.path.exists(destino):
+            escribir(destino, datos)
+            if extension not in SIN_COMPRIMIR:
+                escribir(destino + '.gz', gzip.compress(datos, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    escribir(destino + '.br', brotli.compress(datos, quality=11))
+        manifiesto[nombre] = final
+
+    escribir(os.path.join(dist, 'manifest.json'),
+             json.dumps(manifiesto, indent=2, sort_keys=True).encode('utf-8'))
+    return manifiesto, faltantes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recursos estáticos locales de XONILAB')
+    parser.add_argument('--sin-descargar', action='store_true', help='No descargar, solo construir')
+    parser.add_argument('--vendor', default=VENDOR_FOLDER, help='Carpeta con los originales')
+    parser.add_argument('--dist', default=ASSETS_FOLDER, help='Carpeta de salida')
+    args = parser.parse_args()
+
+    if not args.sin_descargar:
+        print('Descargando recursos...')
+        descargar(args.vendor)
+
+    manifiesto, faltantes = construir(args.vendor, args.dist)
+    print(f"Recursos locales: {len(manifiesto)} en {args.dist}"
+          f"{'' if brotli else ' (sin .br: instale brotli para generarlos)'}")
+    if faltantes:
+        print(f"Se seguirán sirviendo desde el CDN: {', '.join(faltantes)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
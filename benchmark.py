@@ -0,0 +1,432 @@
+#XONILAB - Benchmark de rutas
+#Genera carpetas data/ sintéticas a distintas escalas y mide cada página y
+#cada operación de escritura con el cliente de pruebas de Flask.
+#
+#Uso:
+#  python benchmark.py --escalas 1000 10000 100000 --salida bench.json
+#  python benchmark.py --escalas 1000 --comparar bench_anterior.json
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+CAMPOS = {
+    'usuarios.csv': ['username', 'password', 'nombre', 'rol'],
+    'inventario.csv': ['id_item', 'codigo', 'nombre', 'categoria', 'descripcion',
+                       'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code'],
+    'prestamos.csv': ['id_prestamo', 'id_item', 'nombre_item', 'id_alumno',
+                      'nombre_alumno', 'num_cuenta', 'fecha_prestamo',
+                      'fecha_devolucion', 'cantidad', 'estado', 'observaciones'],
+    'alumnos.csv': ['id_alumno', 'nombre', 'num_cuenta', 'grupo', 'semestre', 'telefono', 'email', 'activo'],
+    'deudas.csv': ['id_deuda', 'id_prestamo', 'nombre_alumno', 'num_cuenta',
+                   'nombre_item', 'descripcion_dano', 'monto', 'estado',
+                   'fecha_deuda', 'fecha_pago', 'observaciones'],
+    'reservas.csv': ['id_reserva', 'fecha', 'hora_inicio', 'hora_fin', 'duracion',
+                     'grupo', 'materia', 'profesor', 'num_alumnos', 'observaciones',
+                     'estado', 'fecha_registro', 'responsable'],
+}
+
+NOMBRES = ['Ana', 'Luis', 'María', 'José', 'Carmen', 'Jorge', 'Lucía', 'Pedro', 'Sofía', 'Diego',
+           'Valeria', 'Andrés', 'Fernanda', 'Miguel', 'Daniela', 'Ricardo', 'Paola', 'Emilio']
+APELLIDOS = ['García', 'Hernández', 'López', 'Martínez', 'González', 'Pérez', 'Rodríguez',
+             'Sánchez', 'Ramírez', 'Cruz', 'Flores', 'Gómez', 'Morales', 'Vázquez', 'Reyes']
+CATEGORIAS = {
+    'Vidrio': ['Vaso de precipitados', 'Matraz Erlenmeyer', 'Probeta', 'Pipeta', 'Bureta', 'Tubo de ensayo'],
+    'Equipo': ['Microscopio', 'Balanza analítica', 'Parrilla', 'Centrífuga', 'Multímetro'],
+    'Reactivos': ['Ácido clorhídrico', 'Hidróxido de sodio', 'Sulfato de cobre', 'Etanol'],
+    'Material': ['Soporte universal', 'Pinzas', 'Mechero Bunsen', 'Gradilla', 'Espátula'],
+    'Electronica': ['Protoboard', 'Fuente de poder', 'Osciloscopio', 'Arduino'],
+}
+MATERIAS = ['Química General', 'Física I', 'Biología Celular', 'Química Orgánica', 'Electrónica']
+PROFESORES = ['Dr. Ramírez', 'Mtra. López', 'Ing. Cruz', 'Dra. Flores', 'Mtro. Reyes', 'Dr. Gómez']
+GRUPOS = [f"{s}{g}" for s in range(1, 9) for g in ('01', '02', '03')]
+
+
+def tamanos_tablas(escala):
+    """Filas por tabla para una escala (la escala es el número de préstamos)"""
+    return {
+        'inventario': max(50, escala // 10),
+        'alumnos': max(100, escala // 4),
+        'prestamos': escala,
+        'deudas': max(10, escala // 10),
+        'reservas': max(20, escala // 5),
+    }
+
+
+def escribir_tabla(carpeta, nombre, filas):
+    with open(os.path.join(carpeta, nombre), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=CAMPOS[nombre])
+        writer.writeheader()
+        writer.writerows(filas)
+
+
+def generar_datos(carpeta, escala, semilla=2025):
+    """Genera una carpeta data/ realista con `escala` préstamos"""
+    rnd = random.Random(semilla)
+    tam = tamanos_tablas(escala)
+    hoy = datetime.now()
+    os.makedirs(carpeta, exist_ok=True)
+
+    escribir_tabla(carpeta, 'usuarios.csv', [
+        {'username': 'XONILAB', 'password': 'laboratorio', 'nombre': 'Administrador Laboratorio', 'rol': 'admin'},
+        {'username': 'PROFESOR1', 'password': 'prof123', 'nombre': 'Profesor Ejemplo', 'rol': 'profesor'},
+    ])
+
+    items = []
+    por_categoria = {}
+    for n in range(tam['inventario']):
+        categoria = rnd.choice(list(CATEGORIAS))
+        por_categoria[categoria] = por_categoria.get(categoria, 0) + 1
+        cantidad = rnd.randint(0, 60)
+        items.append({
+            'id_item': f"IT{n:07d}",
+            'codigo': f"{categoria[:3].upper()}{por_categoria[categoria]:03d}",
+            'nombre': f"{rnd.choice(CATEGORIAS[categoria])} {rnd.choice(['50 ml', '100 ml', '250 ml', 'chico', 'grande', 'digital'])}",
+            'categoria': categoria,
+            'descripcion': f"Material de {categoria.lower()} para prácticas",
+            'cantidad': str(cantidad),
+            'unidad': 'pzas',
+            'ubicacion': f"Anaquel {rnd.randint(1, 20)}",
+            'estado': 'disponible' if cantidad > 0 else 'agotado',
+            'fecha_registro': (hoy - timedelta(days=rnd.randint(30, 900))).strftime('%Y-%m-%d %H:%M:%S'),
+            'qr_code': '',
+        })
+    escribir_tabla(carpeta, 'inventario.csv', items)
+
+    alumnos = []
+    for n in range(tam['alumnos']):
+        nombre = f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}"
+        alumnos.append({
+            'id_alumno': f"AL{n:07d}",
+            'nombre': nombre,
+            'num_cuenta': f"{310000000 + n}",
+            'grupo': rnd.choice(GRUPOS),
+            'semestre': str(rnd.randint(1, 8)),
+            'telefono': f"55{rnd.randint(10000000, 99999999)}",
+            'email': f"alumno{n}@escuela.edu.mx",
+            'activo': '1' if rnd.random() < 0.9 else '0',
+        })
+    escribir_tabla(carpeta, 'alumnos.csv', alumnos)
+
+    prestamos = []
+    for n in range(tam['prestamos']):
+        item = rnd.choice(items)
+        alumno = rnd.choice(alumnos)
+        fecha = hoy - timedelta(days=rnd.randint(0, 365), minutes=rnd.randint(0, 600))
+        activo = rnd.random() < 0.2
+        prestamos.append({
+            'id_prestamo': f"PR{n:08d}",
+            'id_item': item['id_item'],
+            'nombre_item': item['nombre'],
+            'id_alumno': alumno['id_alumno'],
+            'nombre_alumno': alumno['nombre'],
+            'num_cuenta': alumno['num_cuenta'],
+            'fecha_prestamo': fecha.strftime('%Y-%m-%d %H:%M:%S'),
+            'fecha_devolucion': ((fecha + timedelta(days=rnd.randint(1, 14))).strftime('%Y-%m-%d') if activo
+                                 else (fecha + timedelta(days=rnd.randint(0, 10))).strftime('%Y-%m-%d %H:%M:%S')),
+            'cantidad': str(rnd.randint(1, 3)),
+            'estado': 'prestado' if activo else 'devuelto',
+            'observaciones': '',
+        })
+    # El archivo se escribe en orden de alta, como lo hace la aplicación
+    prestamos.sort(key=lambda p: p['fecha_prestamo'])
+    escribir_tabla(carpeta, 'prestamos.csv', prestamos)
+
+    deudas = []
+    for n in range(tam['deudas']):
+        prestamo = rnd.choice(prestamos)
+        pagada = rnd.random() < 0.6
+        fecha = datetime.strptime(prestamo['fecha_prestamo'], '%Y-%m-%d %H:%M:%S') + timedelta(days=rnd.randint(1, 15))
+        deudas.append({
+            'id_deuda': f"DE{n:07d}",
+            'id_prestamo': prestamo['id_prestamo'],
+            'nombre_alumno': prestamo['nombre_alumno'],
+            'num_cuenta': prestamo['num_cuenta'],
+            'nombre_item': prestamo['nombre_item'],
+            'descripcion_dano': rnd.choice(['Roto', 'Estrellado', 'Incompleto', 'No devuelto']),
+            'monto': f"{rnd.choice([50, 80, 120, 250, 400, 1200])}.00",
+            'estado': 'pagado' if pagada else 'pendiente',
+            'fecha_deuda': fecha.strftime('%Y-%m-%d %H:%M:%S'),
+            'fecha_pago': (fecha + timedelta(days=rnd.randint(1, 30))).strftime('%Y-%m-%d %H:%M:%S') if pagada else '',
+            'observaciones': '',
+        })
+    escribir_tabla(carpeta, 'deudas.csv', deudas)
+
+    # Reservas sin solapamiento, repartidas alrededor de hoy (hasta 6 por día)
+    reservas = []
+    dias = max(1, tam['reservas'] // 4)
+    inicio = hoy.date() - timedelta(days=dias // 2)
+    n = 0
+    for d in range(dias):
+        fecha = inicio + timedelta(days=d)
+        hora = 7 + rnd.randint(0, 1)
+        while hora < 19 and n < tam['reservas']:
+            duracion = rnd.choice([1, 2])
+            if hora + duracion > 19:
+                break
+            reservas.append({
+                'id_reserva': f"RE{n:07d}",
+                'fecha': fecha.strftime('%Y-%m-%d'),
+                'hora_inicio': f"{hora:02d}:00",
+                'hora_fin': f"{hora + duracion:02d}:00",
+                'duracion': str(duracion),
+                'grupo': rnd.choice(GRUPOS),
+                'materia': rnd.choice(MATERIAS),
+                'profesor': rnd.choice(PROFESORES),
+                'num_alumnos': str(rnd.randint(10, 35)),
+                'observaciones': '',
+                'estado': 'confirmada' if rnd.random() < 0.9 else 'cancelada',
+                'fecha_registro': (datetime.combine(fecha, datetime.min.time()) - timedelta(days=rnd.randint(1, 30))).strftime('%Y-%m-%d %H:%M:%S'),
+                'responsable': 'Administrador Laboratorio',
+            })
+            n += 1
+            hora += duracion + rnd.randint(0, 2)
+    escribir_tabla(carpeta, 'reservas.csv', reservas)
+
+    return {'items': items, 'alumnos': alumnos, 'prestamos': prestamos,
+            'deudas': deudas, 'reservas': reservas}
+
+
+def crear_app_aislada(carpeta):
+    """Instancia de la aplicación sobre una carpeta de datos propia"""
+    import start
+    return start.crear_app({
+        'CSV_FOLDER': os.path.join(carpeta, 'data'),
+        'QR_FOLDER': os.path.join(carpeta, 'qrcodes'),
+        'BACKUP_FOLDER': os.path.join(carpeta, 'backups'),
+        'PERFILES_FOLDER': os.path.join(carpeta, 'perfiles'),
+        'COMPACTADOR': False,
+        'REVISION_VENCIDOS': False,
+        'ARCHIVADOR': False,
+        'CACHE_PAGINAS': False,
+        'TESTING': True,
+    })
+
+
+def medir(cliente, metodo, url, data=None):
+    inicio = time.perf_counter()
+    respuesta = cliente.open(url, method=metodo, data=data)
+    return (time.perf_counter() - inicio) * 1000, respuesta.status_code
+
+
+def fallo_escritura(cliente, estado):
+    """Devuelve el error de la última escritura o None si se completó
+
+    Los manejadores redirigen con 302 también cuando fallan, así que el
+    resultado se juzga por los mensajes flash que dejaron en la sesión.
+    """
+    with cliente.session_transaction() as sesion:
+        mensajes = sesion.pop('_flashes', [])
+    errores = [m for categoria, m in mensajes if categoria in ('danger', 'warning')]
+    if errores:
+        return errores[0]
+    if estado != 302 or not any(categoria == 'success' for categoria, _ in mensajes):
+        return f"HTTP {estado} sin mensaje de éxito"
+    return None
+
+
+def resumir(tiempos, estados):
+    ordenados = sorted(tiempos)
+    return {
+        'n': len(tiempos),
+        'primera_ms': round(tiempos[0], 2),
+        'min_ms': round(ordenados[0], 2),
+        'p50_ms': round(statistics.median(ordenados), 2),
+        'p95_ms': round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * 0.95))], 2),
+        'media_ms': round(statistics.fmean(ordenados), 2),
+        'max_ms': round(ordenados[-1], 2),
+        'estados': sorted(set(estados)),
+    }
+
+
+def peticiones_escritura(datos, rnd, reservados=10):
+    """Genera (nombre, método, url, formulario) para cada operación de escritura
+
+    Los ítems y alumnos que se eliminan salen de un grupo de `reservados`
+    sin préstamos activos que ninguna otra operación usa.
+    """
+    hoy = datetime.now()
+    activos = [p for p in datos['prestamos'] if p['estado'] == 'prestado']
+    pendientes = [d for d in datos['deudas'] if d['estado'] == 'pendiente']
+    confirmadas = [r for r in datos['reservas'] if r['estado'] == 'confirmada']
+    
+    items_prestados = {p['id_item'] for p in activos}
+    alumnos_con_prestamo = {p['id_alumno'] for p in activos}
+    items_eliminar = [i for i in datos['items'] if i['id_item'] not in items_prestados][-reservados:]
+    alumnos_eliminar = [a for a in datos['alumnos'] if a['id_alumno'] not in alumnos_con_prestamo][-reservados:]
+    reservados_ids = {i['id_item'] for i in items_eliminar} | {a['id_alumno'] for a in alumnos_eliminar}
+    items = [i for i in datos['items'] if i['id_item'] not in reservados_ids]
+    alumnos = [a for a in datos['alumnos'] if a['id_alumno'] not in reservados_ids]
+    
+    sin_deuda = {a['num_cuenta'] for a in alumnos} - {d['num_cuenta'] for d in pendientes}
+    alumnos_ok = [a for a in alumnos if a['num_cuenta'] in sin_deuda and a['activo'] == '1']
+    items_ok = [i for i in items if int(i['cantidad']) > 5]
+    contador = {'n': 0}
+
+    def siguiente():
+        contador['n'] += 1
+        return contador['n']
+
+    def fecha_libre():
+        # Días lejanos sin reservas para no chocar con los datos generados
+        return (hoy + timedelta(days=2000 + siguiente())).strftime('%Y-%m-%d')
+
+    return {
+        'agregar_item': lambda: ('POST', '/inventario/agregar', {
+            'nombre': f"Bench {siguiente()}", 'categoria': 'Vidrio', 'cantidad': '10', 'unidad': 'pzas'}),
+        'editar_item': lambda: ('POST', f"/inventario/editar/{rnd.choice(items)['id_item']}", {
+            'nombre': f"Editado {siguiente()}", 'categoria': 'Vidrio', 'cantidad': '20', 'unidad': 'pzas'}),
+        'nuevo_prestamo': lambda: ('POST', '/prestamos/nuevo', {
+            'item': rnd.choice(items_ok)['id_item'], 'alumno': rnd.choice(alumnos_ok)['id_alumno'],
+            'cantidad': '1', 'fecha_devolucion': (hoy + timedelta(days=7)).strftime('%Y-%m-%d')}),
+        'devolver_prestamo': lambda: ('GET', f"/prestamos/devolver/{activos.pop()['id_prestamo']}", None),
+        'agregar_alumno': lambda: ('POST', '/alumnos/agregar', {
+            'nombre': 'Alumno Bench', 'num_cuenta': f"999{siguiente():06d}", 'grupo': '101'}),
+        'editar_alumno': lambda: ('POST', f"/alumnos/editar/{rnd.choice(alumnos)['id_alumno']}", {
+            'nombre': 'Alumno Editado', 'num_cuenta': f"998{siguiente():06d}", 'grupo': '101', 'activo': '1'}),
+        'nueva_deuda': lambda: ('POST', '/deudas/nueva', {
+            'prestamo': rnd.choice(datos['prestamos'])['id_prestamo'], 'descripcion_dano': 'Roto', 'monto': '100'}),
+        'pagar_deuda': lambda: ('GET', f"/deudas/pagar/{pendientes.pop()['id_deuda']}", None),
+        'reservar_sesion': lambda: ('POST', '/calendario/reservar', {
+            'fecha': fecha_libre(), 'hora_inicio': '09:00', 'duracion': '2', 'grupo': '101',
+            'materia': 'Química General', 'profesor': 'Dr. Ramírez', 'num_alumnos': '20'}),
+        'cancelar_reserva': lambda: ('GET', f"/calendario/cancelar/{confirmadas.pop()['id_reserva']}", None),
+        'eliminar_deuda': lambda: ('GET', f"/deudas/eliminar/{pendientes.pop()['id_deuda']}", None),
+        'eliminar_reserva': lambda: ('GET', f"/calendario/eliminar/{confirmadas.pop()['id_reserva']}", None),
+        'eliminar_item': lambda: ('GET', f"/inventario/eliminar/{items_eliminar.pop()['id_item']}", None),
+        'eliminar_alumno': lambda: ('GET', f"/alumnos/eliminar/{alumnos_eliminar.pop()['id_alumno']}", None),
+    }
+
+
+def rutas_lectura():
+    hoy = datetime.now()
+    return {
+        'dashboard': '/dashboard',
+        'inventario': '/inventario',
+        'prestamos': '/prestamos',
+        'alumnos': '/alumnos',
+        'deudas': '/deudas',
+        'calendario': '/calendario',
+        'calendario_dia': f"/calendario/dia/{hoy.strftime('%Y-%m-%d')}",
+        'reportes': '/reportes',
+        'backup': '/backup',
+    }
+
+
+def ejecutar_escala(escala, repeticiones, semilla):
+    carpeta = tempfile.mkdtemp(prefix=f"xonilab_bench_{escala}_")
+    try:
+        inicio = time.perf_counter()
+        datos = generar_datos(os.path.join(carpeta, 'data'), escala, semilla)
+        generacion = time.perf_counter() - inicio
+
+        app = crear_app_aislada(carpeta)
+        cliente = app.test_client()
+        cliente.post('/login', data={'username': 'XONILAB', 'password': 'laboratorio'})
+
+        resultado = {'filas': tamanos_tablas(escala), 'generacion_s': round(generacion, 2),
+                     'lectura': {}, 'escritura': {}}
+
+        for nombre, url in rutas_lectura().items():
+            tiempos, estados = [], []
+            for _ in range(repeticiones):
+                ms, estado = medir(cliente, 'GET', url)
+                tiempos.append(ms)
+                estados.append(estado)
+            resultado['lectura'][nombre] = resumir(tiempos, estados)
+            print(f"  [{escala}] {nombre:<18} p50 {resultado['lectura'][nombre]['p50_ms']:>9.2f} ms")
+
+        rnd = random.Random(semilla)
+        for nombre, peticion in peticiones_escritura(datos, rnd, repeticiones).items():
+            tiempos, estados, errores = [], [], []
+            for _ in range(repeticiones):
+                try:
+                    metodo, url, formulario = peticion()
+                except IndexError:
+                    break  # no quedan filas para esta operación
+                ms, estado = medir(cliente, metodo, url, formulario)
+                error = fallo_escritura(cliente, estado)
+                if error:
+                    errores.append(error)
+                    continue  # una escritura rechazada no cuenta como tiempo válido
+                tiempos.append(ms)
+                estados.append(estado)
+            if tiempos:
+                resultado['escritura'][nombre] = resumir(tiempos, estados)
+                print(f"  [{escala}] {nombre:<18} p50 {resultado['escritura'][nombre]['p50_ms']:>9.2f} ms")
+            if errores:
+                resultado['escritura'].setdefault(nombre, {'n': 0})
+                resultado['escritura'][nombre].update({'fallidas': len(errores), 'error': errores[0]})
+                print(f"  ⚠️  [{escala}] {nombre}: {len(errores)} fallida(s): {errores[0]}")
+        return resultado
+    finally:
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+
+def comparar(actual, anterior, umbral):
+    """Lista las rutas cuyo p50 empeoró más del umbral respecto al reporte anterior"""
+    regresiones = []
+    for escala, datos in actual['escalas'].items():
+        previo = anterior.get('escalas', {}).get(escala)
+        if not previo:
+            continue
+        for tipo in ('lectura', 'escritura'):
+            for ruta, medida in datos[tipo].items():
+                base = previo.get(tipo, {}).get(ruta)
+                if not base or base['p50_ms'] <= 0:
+                    continue
+                cambio = medida['p50_ms'] / base['p50_ms'] - 1
+                if cambio > umbral:
+                    regresiones.append({'escala': escala, 'ruta': ruta, 'antes_ms': base['p50_ms'],
+                                        'ahora_ms': medida['p50_ms'], 'cambio': round(cambio, 3)})
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de rutas de XONILAB')
+    parser.add_argument('--escalas', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--semilla', type=int, default=2025)
+    parser.add_argument('--salida', default='benchmark_reporte.json')
+    parser.add_argument('--comparar', help='Reporte JSON anterior para detectar regresiones')
+    parser.add_argument('--umbral', type=float, default=0.2, help='Empeoramiento tolerado del p50 (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    reporte = {
+        'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'repeticiones': args.repeticiones,
+        'semilla': args.semilla,
+        'escalas': {},
+    }
+    for escala in args.escalas:
+        print(f"Escala {escala}...")
+        reporte['escalas'][str(escala)] = ejecutar_escala(escala, args.repeticiones, args.semilla)
+
+    if args.comparar:
+        with open(args.comparar, 'r', encoding='utf-8') as f:
+            reporte['regresiones'] = comparar(reporte, json.load(f), args.umbral)
+
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(reporte, f, ensure_ascii=False, indent=2)
+    print(f"Reporte guardado en {args.salida}")
+
+    if reporte.get('regresiones'):
+        print("⚠️  Regresiones detectadas:")
+        for r in reporte['regresiones']:
+            print(f"  [{r['escala']}] {r['ruta']}: {r['antes_ms']} -> {r['ahora_ms']} ms (+{r['cambio'] * 100:.0f}%)")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#XONILAB - Migración de referencias
+#Reescribe prestamos.csv y deudas.csv guardando solo las claves foráneas
+#(id_item, id_alumno, id_prestamo); los nombres y el número de cuenta se
+#resuelven al leer. Con --desnormalizar se restauran las columnas copiadas.
+#
+#Uso:
+#  python migrar_referencias.py
+#  python migrar_referencias.py --datos /ruta/data --desnormalizar
+
+import argparse
+
+from start import crear_app, migrar_referencias
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migración de referencias de préstamos y deudas')
+    parser.add_argument('--datos', help='Carpeta de datos (por defecto la de la aplicación)')
+    parser.add_argument('--desnormalizar', action='store_true', help='Volver a copiar nombres en cada fila')
+    args = parser.parse_args()
+
+    config = {'COMPACTADOR': False, 'REVISION_VENCIDOS': False, 'ARCHIVADOR': False,
+              'REFERENCIAS_NORMALIZADAS': False}
+    if args.datos:
+        config['CSV_FOLDER'] = args.datos
+    app = crear_app(config)
+
+    with app.app_context():
+        migradas = migrar_referencias(not args.desnormalizar)
+
+    if not migradas:
+        print("Sin cambios: las tablas ya estaban en ese formato")
+    for tabla, antes, despues in migradas:
+        print(f"✅ {tabla}: {antes / 1024:.1f} KB -> {despues / 1024:.1f} KB")
+
+
+if __name__ == '__main__':
+    main()
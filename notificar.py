@@ -0,0 +1,61 @@
+#XONILAB - Recordatorios por correo
+#Encola un recordatorio por alumno con préstamos vencidos o deudas pendientes
+#y entrega la bandeja de salida con el transporte indicado. Pensado para
+#ejecutarse desde cron cuando no se usa el notificador en segundo plano.
+#
+#Uso:
+#  python notificar.py --encolar
+#  python notificar.py --entregar --transporte archivo
+#  python notificar.py --encolar --entregar --transporte smtp --smtp localhost:1025
+
+import argparse
+import os
+import sys
+
+from start import crear_app, encolar_recordatorios, entregar_notificaciones, TRANSPORTES
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recordatorios de XONILAB')
+    parser.add_argument('--datos', help='Carpeta de datos (por defecto la de la aplicación)')
+    parser.add_argument('--encolar', action='store_true', help='Encolar los recordatorios de hoy')
+    parser.add_argument('--entregar', action='store_true', help='Entregar las notificaciones pendientes')
+    parser.add_argument('--transporte', choices=sorted(TRANSPORTES), help='Transporte de entrega')
+    parser.add_argument('--smtp', help='Servidor SMTP host:puerto')
+    parser.add_argument('--lotes', type=int, default=1, help='Lotes (minutos) de entrega a procesar')
+    args = parser.parse_args()
+
+    if not args.encolar and not args.entregar:
+        parser.error('indique --encolar y/o --entregar')
+    transporte = args.transporte or os.environ.get('XONILAB_NOTIFICAR') or 'archivo'
+    if args.entregar and transporte not in TRANSPORTES:
+        parser.error(f"transporte desconocido en XONILAB_NOTIFICAR: '{transporte}' "
+                     f"(opciones: {', '.join(sorted(TRANSPORTES))})")
+
+    config = {'COMPACTADOR': False, 'REVISION_VENCIDOS': False, 'ARCHIVADOR': False,
+              'NOTIFICACIONES_TRANSPORTE': ''}
+    if args.datos:
+        config['CSV_FOLDER'] = args.datos
+    if args.smtp:
+        config['NOTIFICACIONES_SMTP'] = args.smtp
+    app = crear_app(config)
+
+    with app.app_context():
+        if args.encolar:
+            resultado = encolar_recordatorios()
+            print(f"Encolados: {resultado['encolados']} | alumnos sin correo: {resultado['sin_correo']}")
+        if args.entregar:
+            for _ in range(max(args.lotes, 1)):
+                resultado = entregar_notificaciones(transporte)
+                if resultado is None:
+                    print('Otra instancia está entregando la bandeja')
+                    return 1
+                print(f"Enviadas: {resultado['enviadas']} | reintentos: {resultado['reintentos']} | "
+                      f"fallidas: {resultado['fallidas']}")
+                if not any(resultado.values()):
+                    break
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
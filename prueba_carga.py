@@ -0,0 +1,315 @@
+#XONILAB - Prueba de carga
+#Simula el inicio de una sesión de laboratorio: muchos alumnos pidiendo
+#préstamos a la vez (nuevo_prestamo) mientras el personal refresca el
+#dashboard. Reporta rendimiento, latencias p50/p95/p99 y verifica al final
+#la consistencia de los datos (conservación del stock entre inventario.csv
+#y los préstamos activos, préstamos perdidos).
+#
+#Uso:
+#  python prueba_carga.py --iniciar --escala 10000 --workers 4 --threads 4
+#  python prueba_carga.py --url http://localhost:5005 --datos data/
+
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MENSAJE_EXITO = 'Préstamo registrado correctamente'
+
+
+class SinRedireccion(urllib.request.HTTPRedirectHandler):
+    """Devuelve las respuestas 302 en lugar de seguirlas"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Cliente:
+    """Usuario virtual con su propia sesión (cookie)"""
+
+    def __init__(self, url_base):
+        self.url_base = url_base.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), SinRedireccion())
+
+    def pedir(self, ruta, datos=None):
+        """Devuelve (estado, cuerpo, location, segundos)"""
+        cuerpo = urllib.parse.urlencode(datos).encode() if datos is not None else None
+        inicio = time.perf_counter()
+        try:
+            with self.opener.open(self.url_base + ruta, data=cuerpo, timeout=60) as r:
+                contenido = r.read()
+                return r.status, contenido, None, time.perf_counter() - inicio
+        except urllib.error.HTTPError as e:
+            contenido = e.read()
+            return e.code, contenido, e.headers.get('Location'), time.perf_counter() - inicio
+
+    def login(self, usuario, contrasena):
+        estado, _, _, _ = self.pedir('/login', {'username': usuario, 'password': contrasena})
+        return estado in (200, 302)
+
+
+class Resultados:
+    """Latencias y contadores compartidos entre hilos"""
+
+    def __init__(self):
+        self.bloqueo = threading.Lock()
+        self.latencias = {}
+        self.errores = {}
+        self.prestamos_exitosos = 0
+        self.prestamos_rechazados = 0
+
+    def registrar(self, operacion, segundos, ok):
+        with self.bloqueo:
+            self.latencias.setdefault(operacion, []).append(segundos)
+            if not ok:
+                self.errores[operacion] = self.errores.get(operacion, 0) + 1
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+
+def leer_tablas(carpeta):
+    """Lee inventario, préstamos, alumnos y deudas (incluye el registro de cambios pendiente)"""
+    sys.path.insert(0, BASE_DIR)
+    from start import leer_csv
+    return {nombre: leer_csv(os.path.join(os.path.abspath(carpeta), f"{nombre}.csv"))
+            for nombre in ('inventario', 'prestamos', 'alumnos', 'deudas')}
+
+
+def stock_total(tablas):
+    """Stock total por ítem = disponible en inventario + prestado en préstamos activos"""
+    totales = {}
+    for item in tablas['inventario']:
+        try:
+            totales[item['id_item']] = int(item.get('cantidad') or 0)
+        except ValueError:
+            totales[item['id_item']] = 0
+    for prestamo in tablas['prestamos']:
+        if prestamo.get('estado') == 'prestado' and prestamo.get('id_item') in totales:
+            try:
+                totales[prestamo['id_item']] += int(prestamo.get('cantidad') or 0)
+            except ValueError:
+                pass
+    return totales
+
+
+def verificar_consistencia(antes, despues, exitosos):
+    """Compara el estado antes y después de la prueba"""
+    stock_antes = stock_total(antes)
+    stock_despues = stock_total(despues)
+    descuadres = [{'id_item': i, 'antes': stock_antes[i], 'despues': stock_despues.get(i)}
+                  for i in stock_antes if stock_despues.get(i) != stock_antes[i]]
+    negativos = [i['id_item'] for i in despues['inventario'] if (i.get('cantidad') or '0').lstrip('-').isdigit()
+                 and int(i['cantidad']) < 0]
+    ids = [p['id_prestamo'] for p in despues['prestamos']]
+    nuevos = len(set(ids) - {p['id_prestamo'] for p in antes['prestamos']})
+    return {
+        'stock_conservado': not descuadres,
+        'items_descuadrados': len(descuadres),
+        'unidades_descuadradas': sum(abs((d['despues'] or 0) - d['antes']) for d in descuadres),
+        'ejemplos_descuadre': descuadres[:10],
+        'items_stock_negativo': negativos,
+        'prestamos_reportados': exitosos,
+        'prestamos_guardados': nuevos,
+        'prestamos_perdidos': exitosos - nuevos,
+        'ids_duplicados': len(ids) - len(set(ids)),
+    }
+
+
+def hilo_alumno(url, fin, candidatos, resultados, rnd):
+    cliente = Cliente(url)
+    if not cliente.login('XONILAB', 'laboratorio'):
+        resultados.registrar('login', 0, False)
+        return
+    devolucion = (datetime.now() + timedelta(days=7)).strftime('%Y-%m-%d')
+    while time.time() < fin:
+        estado, _, location, segundos = cliente.pedir('/prestamos/nuevo', {
+            'item': rnd.choice(candidatos['items']),
+            'alumno': rnd.choice(candidatos['alumnos']),
+            'cantidad': '1',
+            'fecha_devolucion': devolucion,
+        })
+        resultados.registrar('nuevo_prestamo', segundos, estado == 302)
+        if estado != 302:
+            continue
+
+        # El navegador recarga la página de préstamos con el mensaje del resultado
+        ruta = urllib.parse.urlparse(location).path if location else '/prestamos'
+        estado, cuerpo, _, segundos = cliente.pedir(ruta)
+        resultados.registrar('prestamos', segundos, estado == 200)
+        with resultados.bloqueo:
+            if MENSAJE_EXITO.encode() in cuerpo:
+                resultados.prestamos_exitosos += 1
+            else:
+                resultados.prestamos_rechazados += 1
+
+
+def hilo_personal(url, fin, pausa, resultados):
+    cliente = Cliente(url)
+    if not cliente.login('XONILAB', 'laboratorio'):
+        resultados.registrar('login', 0, False)
+        return
+    while time.time() < fin:
+        estado, _, _, segundos = cliente.pedir('/dashboard')
+        resultados.registrar('dashboard', segundos, estado == 200)
+        time.sleep(pausa)
+
+
+def iniciar_servidor(carpeta, port, workers, threads):
+    """Lanza servidor.py sobre una carpeta de datos y espera a que responda"""
+    env = dict(os.environ, XONILAB_DATOS=carpeta, PYTHONUNBUFFERED='1')
+    proceso = subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, 'servidor.py'), '--port', str(port),
+         '--host', '127.0.0.1', '--workers', str(workers), '--threads', str(threads)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + '/login', timeout=1).read()
+            return proceso, url
+        except OSError:
+            time.sleep(0.2)
+    proceso.terminate()
+    raise RuntimeError('El servidor no respondió')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga de una sesión de laboratorio')
+    parser.add_argument('--url', help='Instancia ya iniciada (p. ej. http://localhost:5005)')
+    parser.add_argument('--datos', help='Carpeta data/ de esa instancia, para verificar consistencia')
+    parser.add_argument('--iniciar', action='store_true', help='Genera datos y lanza un servidor local')
+    parser.add_argument('--escala', type=int, default=10000, help='Préstamos de los datos generados')
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--alumnos', type=int, default=40, help='Hilos pidiendo préstamos')
+    parser.add_argument('--personal', type=int, default=5, help='Hilos refrescando el dashboard')
+    parser.add_argument('--pausa-dashboard', type=float, default=2.0)
+    parser.add_argument('--duracion', type=float, default=60, help='Segundos de prueba')
+    parser.add_argument('--semilla', type=int, default=2025)
+    parser.add_argument('--salida', default='prueba_carga.json')
+    args = parser.parse_args()
+
+    if not args.iniciar and not args.url:
+        parser.error('Indique --url o --iniciar')
+
+    temporal = None
+    proceso = None
+    try:
+        if args.iniciar:
+            sys.path.insert(0, BASE_DIR)
+            from benchmark import generar_datos
+            temporal = tempfile.mkdtemp(prefix='xonilab_carga_')
+            args.datos = os.path.join(temporal, 'data')
+            print(f"Generando datos (escala {args.escala})...")
+            generar_datos(args.datos, args.escala, args.semilla)
+            print(f"Iniciando servidor ({args.workers} workers x {args.threads} hilos)...")
+            proceso, args.url = iniciar_servidor(args.datos, args.port, args.workers, args.threads)
+
+        antes = leer_tablas(args.datos) if args.datos else None
+        if antes:
+            con_deuda = {d['num_cuenta'] for d in antes['deudas'] if d.get('estado') == 'pendiente'}
+            candidatos = {
+                'items': [i['id_item'] for i in antes['inventario'] if int(i.get('cantidad') or 0) > 0],
+                'alumnos': [a['id_alumno'] for a in antes['alumnos']
+                            if a.get('activo') == '1' and a.get('num_cuenta') not in con_deuda],
+            }
+        else:
+            parser.error('Se necesita --datos para elegir ítems y alumnos')
+
+        resultados = Resultados()
+        fin = time.time() + args.duracion
+        rnd = random.Random(args.semilla)
+        hilos = [threading.Thread(target=hilo_alumno,
+                                  args=(args.url, fin, candidatos, resultados, random.Random(rnd.random())))
+                 for _ in range(args.alumnos)]
+        hilos += [threading.Thread(target=hilo_personal, args=(args.url, fin, args.pausa_dashboard, resultados))
+                  for _ in range(args.personal)]
+
+        print(f"Carga: {args.alumnos} alumnos + {args.personal} personal durante {args.duracion:.0f} s...")
+        inicio = time.time()
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        transcurrido = time.time() - inicio
+
+        reporte = {
+            'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'url': args.url,
+            'duracion_s': round(transcurrido, 2),
+            'alumnos': args.alumnos,
+            'personal': args.personal,
+            'operaciones': {},
+        }
+        total = 0
+        for operacion, latencias in sorted(resultados.latencias.items()):
+            total += len(latencias)
+            reporte['operaciones'][operacion] = {
+                'peticiones': len(latencias),
+                'errores': resultados.errores.get(operacion, 0),
+                'por_segundo': round(len(latencias) / transcurrido, 2),
+                'p50_ms': round(percentil(latencias, 50) * 1000, 2),
+                'p95_ms': round(percentil(latencias, 95) * 1000, 2),
+                'p99_ms': round(percentil(latencias, 99) * 1000, 2),
+            }
+        reporte['peticiones_por_segundo'] = round(total / transcurrido, 2)
+        reporte['prestamos_rechazados'] = resultados.prestamos_rechazados
+
+        if proceso:
+            # Detener el servidor antes de leer para no competir con escrituras
+            proceso.terminate()
+            proceso.wait(timeout=30)
+            proceso = None
+        reporte['consistencia'] = verificar_consistencia(antes, leer_tablas(args.datos),
+                                                         resultados.prestamos_exitosos)
+
+        print()
+        print(f"{'Operación':<16}{'Peticiones':>11}{'Errores':>9}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for operacion, m in reporte['operaciones'].items():
+            print(f"{operacion:<16}{m['peticiones']:>11}{m['errores']:>9}{m['por_segundo']:>9}"
+                  f"{m['p50_ms']:>10}{m['p95_ms']:>10}{m['p99_ms']:>10}")
+        print(f"Total: {reporte['peticiones_por_segundo']} req/s")
+        c = reporte['consistencia']
+        print()
+        print(f"Préstamos confirmados: {c['prestamos_reportados']} | guardados: {c['prestamos_guardados']} "
+              f"| perdidos: {c['prestamos_perdidos']}")
+        print(f"Stock conservado: {'sí' if c['stock_conservado'] else 'NO'} "
+              f"({c['items_descuadrados']} ítems, {c['unidades_descuadradas']} unidades descuadradas)")
+        if c['items_stock_negativo']:
+            print(f"Ítems con stock negativo: {len(c['items_stock_negativo'])}")
+
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(reporte, f, ensure_ascii=False, indent=2)
+        print(f"Reporte guardado en {args.salida}")
+
+        consistente = (c['stock_conservado'] and not c['prestamos_perdidos'] and
+                       not c['items_stock_negativo'] and not c['ids_duplicados'])
+        sys.exit(0 if consistente else 1)
+    finally:
+        if proceso:
+            proceso.terminate()
+        if temporal:
+            shutil.rmtree(temporal, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#XONILAB - Servidor de producción
+#Lanza la aplicación con varios procesos (workers) e hilos por proceso.
+#Usa gunicorn si está instalado (Linux/macOS), si no waitress (Windows)
+#y como último recurso el servidor de Werkzeug en modo multihilo.
+#
+#Recarga elegante (gunicorn): kill -HUP <pid del proceso maestro>
+
+import argparse
+import importlib.util
+import multiprocessing
+import os
+
+
+def workers_por_defecto():
+    """Un proceso por núcleo más uno (mínimo 2)"""
+    return max(2, multiprocessing.cpu_count() + 1)
+
+
+def ejecutar_gunicorn(host, port, workers, threads, timeout):
+    """Servidor preforked con gunicorn (SIGHUP recarga los workers sin cortar conexiones)"""
+    from gunicorn.app.base import BaseApplication
+
+    class ServidorXonilab(BaseApplication):
+        def __init__(self, opciones):
+            self.opciones = opciones
+            super().__init__()
+
+        def load_config(self):
+            for clave, valor in self.opciones.items():
+                self.cfg.set(clave, valor)
+
+        def load(self):
+            # Cada worker crea su propia instancia de la aplicación
+            from start import crear_app
+            return crear_app()
+
+    ServidorXonilab({
+        'bind': f"{host}:{port}",
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'timeout': timeout,
+        'graceful_timeout': timeout,
+        'preload_app': False,
+        'max_requests': 5000,
+        'max_requests_jitter': 500,
+        'proc_name': 'xonilab',
+    }).run()
+
+
+def ejecutar_waitress(host, port, threads):
+    """Servidor multihilo con waitress (un solo proceso)"""
+    from waitress import serve
+    from start import crear_app
+    serve(crear_app(), host=host, port=port, threads=threads)
+
+
+def ejecutar_werkzeug(host, port):
+    """Servidor de Werkzeug multihilo, sin depurador ni recarga"""
+    from werkzeug.serving import run_simple
+    from start import crear_app
+    run_simple(host, port, crear_app(), threaded=True, use_reloader=False, use_debugger=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor de producción de XONILAB')
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5005)))
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('XONILAB_WORKERS', workers_por_defecto())))
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('XONILAB_THREADS', 4)))
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('XONILAB_TIMEOUT', 60)))
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print("🔬 XONILAB - Servidor de producción")
+    print(f"  URL: http://{'localhost' if args.host == '0.0.0.0' else args.host}:{args.port}")
+
+    if importlib.util.find_spec('gunicorn') and os.name != 'nt':
+        print(f"  gunicorn: {args.workers} workers x {args.threads} hilos")
+        if args.threads < 2:
+            print("  ⚠️  Worker sync: sin actualización en vivo (las páginas consultan cada 30 s)")
+        # crear_app ajusta los flujos /eventos a los hilos y al timeout de cada worker
+        os.environ['XONILAB_THREADS'] = str(args.threads)
+        os.environ['XONILAB_TIMEOUT'] = str(args.timeout)
+        print(f"  Recarga elegante: kill -HUP {os.getpid()}")
+        print("=" * 80)
+        ejecutar_gunicorn(args.host, args.port, args.workers, args.threads, args.timeout)
+        return
+
+    if importlib.util.find_spec('waitress'):
+        print(f"  waitress: 1 proceso x {args.threads} hilos (instale gunicorn para usar varios procesos)")
+        os.environ['XONILAB_THREADS'] = str(args.threads)
+        print("=" * 80)
+        ejecutar_waitress(args.host, args.port, args.threads)
+        return
+
+    print("  ⚠️  Sin gunicorn ni waitress: usando Werkzeug multihilo")
+    print("     pip install gunicorn   (Linux/macOS)")
+    print("     pip install waitress   (Windows)")
+    print("=" * 80)
+    ejecutar_werkzeug(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
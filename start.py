@@ -1,39 +1,187 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, current_app, has_app_context, has_request_context, g, Response, jsonify, send_from_directory
 import os
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 import calendar
 import locale
-import qrcode
-from io import BytesIO
+from io import BytesIO, StringIO
 import base64
+import gzip
+import json
+import mmap
+import threading
+import time
+import hashlib
+import mimetypes
+import re
+import unicodedata
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from werkzeug.utils import secure_filename
 
-# Configurar locale para español
 try:
-    locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
-except:
-    try:
-        locale.setlocale(locale.LC_TIME, 'es_ES')
-    except:
-        locale.setlocale(locale.LC_TIME, 'Spanish_Spain.1252')
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+def configurar_locale():
+    """Configura el locale para español (nombres de meses y días)"""
+    for nombre in ('es_ES.UTF-8', 'es_ES', 'Spanish_Spain.1252'):
+        try:
+            locale.setlocale(locale.LC_TIME, nombre)
+            return True
+        except locale.Error:
+            continue
+    return False
+
+class RegistroApp:
+    """Guarda rutas y manejadores para instalarlos en cada app de crear_app()"""
+    
+    def __init__(self):
+        self.instalaciones = []
+    
+    def route(self, regla, **opciones):
+        def decorador(f):
+            self.instalaciones.append(lambda app: app.add_url_rule(regla, view_func=f, **opciones))
+            return f
+        return decorador
+    
+    def context_processor(self, f):
+        self.instalaciones.append(lambda app: app.context_processor(f))
+        return f
+    
+    def before_request(self, f):
+        self.instalaciones.append(lambda app: app.before_request(f))
+        return f
+    
+    def after_request(self, f):
+        self.instalaciones.append(lambda app: app.after_request(f))
+        return f
+    
+    def teardown_request(self, f):
+        self.instalaciones.append(lambda app: app.teardown_request(f))
+        return f
+    
+    def errorhandler(self, codigo):
+        def decorador(f):
+            self.instalaciones.append(lambda app: app.register_error_handler(codigo, f))
+            return f
+        return decorador
+    
+    def instalar(self, app):
+        for instalar in self.instalaciones:
+            instalar(app)
 
-app = Flask(__name__)
-app.secret_key = "xonilab_Darian_Alberto_Camacho_Salas"
+rutas = RegistroApp()
 
 # Configuración
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CSV_FOLDER = os.path.join(BASE_DIR, 'data')
 QR_FOLDER = os.path.join(BASE_DIR, 'static', 'qrcodes')
-os.makedirs(CSV_FOLDER, exist_ok=True)
-os.makedirs(QR_FOLDER, exist_ok=True)
 
-USUARIOS_CSV = os.path.join(CSV_FOLDER, 'usuarios.csv')
-INVENTARIO_CSV = os.path.join(CSV_FOLDER, 'inventario.csv')
-PRESTAMOS_CSV = os.path.join(CSV_FOLDER, 'prestamos.csv')
-ALUMNOS_CSV = os.path.join(CSV_FOLDER, 'alumnos.csv')
-DEUDAS_CSV = os.path.join(CSV_FOLDER, 'deudas.csv')
-RESERVAS_CSV = os.path.join(CSV_FOLDER, 'reservas.csv')
+BACKUP_FOLDER = os.path.join(BASE_DIR, 'backups')
+PERFILES_FOLDER = os.path.join(BASE_DIR, 'perfiles')
+REPORTES_FOLDER = os.path.join(BASE_DIR, 'reportes')
+NOTIFICACIONES_FOLDER = os.path.join(BASE_DIR, 'notificaciones')
+ASSETS_FOLDER = os.path.join(BASE_DIR, 'static', 'dist')
+
+# Recursos de terceros: se sirven localmente desde static/dist/ con nombres
+# con hash (ver assets.py) y, mientras no se generen, desde su CDN original
+RECURSOS_ESTATICOS = {
+    'bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css',
+    'bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/js/bootstrap.bundle.min.js',
+    'fontawesome.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+    'webfonts/fa-solid-900.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-solid-900.woff2',
+    'webfonts/fa-solid-900.ttf': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-solid-900.ttf',
+    'webfonts/fa-regular-400.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-regular-400.woff2',
+    'webfonts/fa-regular-400.ttf': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-regular-400.ttf',
+    'webfonts/fa-brands-400.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-brands-400.woff2',
+    'webfonts/fa-brands-400.ttf': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-brands-400.ttf',
+    'webfonts/fa-v4compatibility.woff2': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-v4compatibility.woff2',
+    'webfonts/fa-v4compatibility.ttf': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/webfonts/fa-v4compatibility.ttf',
+    'jquery.min.js': 'https://code.jquery.com/jquery-3.6.0.min.js',
+    'dataTables.bootstrap5.min.css': 'https://cdn.datatables.net/1.13.4/css/dataTables.bootstrap5.min.css',
+    'jquery.dataTables.min.js': 'https://cdn.datatables.net/1.13.4/js/jquery.dataTables.min.js',
+    'dataTables.es-ES.json': 'https://cdn.datatables.net/plug-ins/1.13.4/i18n/es-ES.json',
+    'dataTables.bootstrap5.min.js': 'https://cdn.datatables.net/1.13.4/js/dataTables.bootstrap5.min.js',
+}
+
+# Tablas: se resuelven dentro de la carpeta de datos de la app (ver ruta_datos)
+USUARIOS_CSV = 'usuarios.csv'
+INVENTARIO_CSV = 'inventario.csv'
+PRESTAMOS_CSV = 'prestamos.csv'
+ALUMNOS_CSV = 'alumnos.csv'
+DEUDAS_CSV = 'deudas.csv'
+RESERVAS_CSV = 'reservas.csv'
+MOVIMIENTOS_CSV = 'movimientos.csv'
+NOTIFICACIONES_CSV = 'notificaciones.csv'
+ELIMINADOS_CSV = 'eliminados.csv'
+
+TABLAS_CSV = [USUARIOS_CSV, INVENTARIO_CSV, PRESTAMOS_CSV,
+              ALUMNOS_CSV, DEUDAS_CSV, RESERVAS_CSV, MOVIMIENTOS_CSV,
+              NOTIFICACIONES_CSV, ELIMINADOS_CSV]
+
+# Clave primaria de cada tabla; los cambios se registran por esta clave
+CLAVES_TABLAS = {
+    'usuarios.csv': 'username',
+    'inventario.csv': 'id_item',
+    'prestamos.csv': 'id_prestamo',
+    'alumnos.csv': 'id_alumno',
+    'deudas.csv': 'id_deuda',
+    'reservas.csv': 'id_reserva',
+    'notificaciones.csv': 'id_notificacion',
+    'eliminados.csv': 'clave',
+}
+
+# Columnas copiadas de otras tablas; en modo normalizado no se guardan y se
+# resuelven al leer a partir de las claves foráneas
+COLUMNAS_DERIVADAS = {
+    'prestamos.csv': ['nombre_item', 'nombre_alumno', 'num_cuenta'],
+    'deudas.csv': ['nombre_alumno', 'num_cuenta', 'nombre_item'],
+}
+NOMBRE_ELIMINADO = '(eliminado)'
+# Nombre y cuenta de ítems y alumnos borrados (clave 'item:<id>' o
+# 'alumno:<id>') para que el historial normalizado no los pierda
+CAMPOS_ELIMINADOS = ['clave', 'nombre', 'num_cuenta', 'fecha_eliminacion']
+ESQUEMAS_DESNORMALIZADOS = {
+    'prestamos.csv': ['id_prestamo', 'id_item', 'nombre_item', 'id_alumno',
+                      'nombre_alumno', 'num_cuenta', 'fecha_prestamo',
+                      'fecha_devolucion', 'cantidad', 'estado', 'observaciones'],
+    'deudas.csv': ['id_deuda', 'id_prestamo', 'nombre_alumno', 'num_cuenta',
+                   'nombre_item', 'descripcion_dano', 'monto', 'estado',
+                   'fecha_deuda', 'fecha_pago', 'observaciones'],
+}
+
+# Compactación del registro de cambios
+LIMITE_REGISTRO_BYTES = int(os.environ.get('XONILAB_COMPACTAR_BYTES', 256 * 1024))
+INTERVALO_COMPACTACION = int(os.environ.get('XONILAB_COMPACTAR_CADA', 600))
+
+# Revisión diaria de préstamos vencidos
+INTERVALO_REVISION_VENCIDOS = 900
+
+# Archivo histórico de préstamos, deudas y reservas cerrados
+INTERVALO_ARCHIVO = 6 * 3600
+
+def carpeta_datos():
+    """Carpeta de datos de la app actual (o la predeterminada)"""
+    return current_app.config['CSV_FOLDER'] if has_app_context() else CSV_FOLDER
+
+def carpeta_qr():
+    """Carpeta de códigos QR de la app actual (o la predeterminada)"""
+    return current_app.config['QR_FOLDER'] if has_app_context() else QR_FOLDER
+
+def ruta_datos(archivo, carpeta=None):
+    """Resuelve el nombre de una tabla dentro de la carpeta de datos"""
+    if os.path.isabs(archivo):
+        return archivo
+    return os.path.join(carpeta or carpeta_datos(), archivo)
 
 # =============================================
 # FUNCIONES PARA CÓDIGOS QR
@@ -43,7 +191,6 @@ def generar_qr_terminal(url):
     """Genera un código QR en la terminal usando caracteres Unicode"""
     try:
         import qrcode
-        from PIL import Image
         
         # Crear código QR
         qr = qrcode.QRCode(
@@ -55,9 +202,6 @@ def generar_qr_terminal(url):
         qr.add_data(url)
         qr.make(fit=True)
         
-        # Crear imagen del QR
-        qr_image = qr.make_image(fill_color="black", back_color="white")
-        
         # Convertir a matriz de caracteres para terminal
         qr_matrix = qr.get_matrix()
         
@@ -83,11 +227,22 @@ def generar_qr_terminal(url):
     except ImportError:
         return ["⚠️  Instalar qrcode[pil] para ver QR en terminal"]
 
+def url_qr_item(item_id):
+    """URL corta y estable que codifican los QR de ítems: /i/<id_item>"""
+    return f"{request.host_url}i/{item_id}"
+
+def archivo_qr_item(item_id):
+    """Nombre del PNG con el QR compacto del ítem"""
+    return f"qr_{item_id}_i.png"
+
 def generar_qr_item(item_id, codigo, nombre):
-    """Genera código QR para un ítem del inventario"""
+    """Genera código QR para un ítem del inventario
+    
+    El QR lleva solo la URL corta del ítem (sin código ni nombre), así que
+    es más pequeño y se lee más rápido en la estación de escaneo.
+    """
     try:
-        # URL del ítem (puedes cambiarla según tu necesidad)
-        url = f"http://{request.host}/item/{item_id}"
+        import qrcode
         
         # Crear código QR
         qr = qrcode.QRCode(
@@ -96,16 +251,17 @@ def generar_qr_item(item_id, codigo, nombre):
             box_size=10,
             border=4,
         )
-        qr.add_data(f"XONILAB - {codigo}\n{nombre}\n{url}")
+        qr.add_data(url_qr_item(item_id))
         qr.make(fit=True)
         
         # Crear imagen
-        qr_image = qr.make_image(fill_color="black", back_color="white")
-        
-        # Guardar imagen
-        qr_filename = f"qr_{item_id}.png"
-        qr_path = os.path.join(QR_FOLDER, qr_filename)
-        qr_image.save(qr_path)
+        with medir_qr('archivo'):
+            qr_image = qr.make_image(fill_color="black", back_color="white")
+            
+            # Guardar imagen
+            qr_filename = archivo_qr_item(item_id)
+            qr_path = os.path.join(carpeta_qr(), qr_filename)
+            qr_image.save(qr_path)
         
         return qr_filename
     except Exception as e:
@@ -115,6 +271,8 @@ def generar_qr_item(item_id, codigo, nombre):
 def obtener_qr_base64(data):
     """Obtiene código QR en base64 para incrustar en HTML"""
     try:
+        import qrcode
+        
         qr = qrcode.QRCode(
             version=1,
             error_correction=qrcode.constants.ERROR_CORRECT_L,
@@ -124,10 +282,11 @@ def obtener_qr_base64(data):
         qr.add_data(data)
         qr.make(fit=True)
         
-        qr_image = qr.make_image(fill_color="black", back_color="white")
-        
-        buffered = BytesIO()
-        qr_image.save(buffered, format="PNG")
+        with medir_qr('base64'):
+            qr_image = qr.make_image(fill_color="black", back_color="white")
+            
+            buffered = BytesIO()
+            qr_image.save(buffered, format="PNG")
         img_str = base64.b64encode(buffered.getvalue()).decode()
         
         return f"data:image/png;base64,{img_str}"
@@ -139,71 +298,342 @@ def obtener_qr_base64(data):
 # FUNCIONES AUXILIARES MEJORADAS
 # =============================================
 
-def inicializar_csv():
+def inicializar_csv(carpeta=None):
     """Inicializa los archivos CSV con datos de ejemplo"""
-    if not os.path.exists(USUARIOS_CSV):
-        with open(USUARIOS_CSV, 'w', newline='', encoding='utf-8') as f:
+    if not os.path.exists(ruta_datos(USUARIOS_CSV, carpeta)):
+        with open(ruta_datos(USUARIOS_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(['username', 'password', 'nombre', 'rol'])
             writer.writerow(['XONILAB', 'laboratorio', 'Administrador Laboratorio', 'admin'])
             writer.writerow(['PROFESOR1', 'prof123', 'Profesor Ejemplo', 'profesor'])
     
-    if not os.path.exists(INVENTARIO_CSV):
-        with open(INVENTARIO_CSV, 'w', newline='', encoding='utf-8') as f:
+    if not os.path.exists(ruta_datos(INVENTARIO_CSV, carpeta)):
+        with open(ruta_datos(INVENTARIO_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(['id_item', 'codigo', 'nombre', 'categoria', 'descripcion', 
                            'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code'])
     
-    if not os.path.exists(PRESTAMOS_CSV):
-        with open(PRESTAMOS_CSV, 'w', newline='', encoding='utf-8') as f:
+    if not os.path.exists(ruta_datos(PRESTAMOS_CSV, carpeta)):
+        with open(ruta_datos(PRESTAMOS_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(['id_prestamo', 'id_item', 'nombre_item', 'id_alumno', 
                            'nombre_alumno', 'num_cuenta', 'fecha_prestamo', 
                            'fecha_devolucion', 'cantidad', 'estado', 'observaciones'])
     
-    if not os.path.exists(ALUMNOS_CSV):
-        with open(ALUMNOS_CSV, 'w', newline='', encoding='utf-8') as f:
+    if not os.path.exists(ruta_datos(ALUMNOS_CSV, carpeta)):
+        with open(ruta_datos(ALUMNOS_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(['id_alumno', 'nombre', 'num_cuenta', 'grupo', 'semestre', 'telefono', 'email', 'activo'])
     
-    if not os.path.exists(DEUDAS_CSV):
-        with open(DEUDAS_CSV, 'w', newline='', encoding='utf-8') as f:
+    if not os.path.exists(ruta_datos(DEUDAS_CSV, carpeta)):
+        with open(ruta_datos(DEUDAS_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(['id_deuda', 'id_prestamo', 'nombre_alumno', 'num_cuenta', 
                            'nombre_item', 'descripcion_dano', 'monto', 'estado', 
                            'fecha_deuda', 'fecha_pago', 'observaciones'])
     
-    if not os.path.exists(RESERVAS_CSV):
-        with open(RESERVAS_CSV, 'w', newline='', encoding='utf-8') as f:
+    if not os.path.exists(ruta_datos(RESERVAS_CSV, carpeta)):
+        with open(ruta_datos(RESERVAS_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             writer.writerow(['id_reserva', 'fecha', 'hora_inicio', 'hora_fin', 'duracion',
                            'grupo', 'materia', 'profesor', 'num_alumnos', 'observaciones', 
                            'estado', 'fecha_registro', 'responsable'])
+    
+    if not os.path.exists(ruta_datos(NOTIFICACIONES_CSV, carpeta)):
+        with open(ruta_datos(NOTIFICACIONES_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(CAMPOS_NOTIFICACIONES)
+    
+    if not os.path.exists(ruta_datos(ELIMINADOS_CSV, carpeta)):
+        with open(ruta_datos(ELIMINADOS_CSV, carpeta), 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerow(CAMPOS_ELIMINADOS)
 
 def leer_csv(archivo):
-    """Lee un archivo CSV"""
+    """Lee un archivo CSV (instantánea + registro de cambios pendiente)"""
+    archivo = ruta_datos(archivo)
     if not os.path.exists(archivo):
         return []
     try:
-        with open(archivo, 'r', encoding='utf-8') as f:
-            return list(csv.DictReader(f))
+        if not clave_tabla(archivo):
+            with open(archivo, 'r', encoding='utf-8') as f:
+                return list(csv.DictReader(f))
+        inicio = time.perf_counter()
+        campos, filas = leer_tabla(archivo)
+        if os.path.basename(archivo) == INVENTARIO_CSV:
+            filas = aplicar_saldos(archivo, [dict(fila) for fila in filas])
+        recordar_version_leida(archivo, filas)
+        copia = [dict(fila) for fila in filas]
+        if tabla_normalizada(archivo, campos):
+            resolver_referencias(archivo, copia)
+        registrar_csv('leer', archivo, filas=len(copia), segundos=time.perf_counter() - inicio)
+        return copia
     except Exception as e:
         print(f"Error leyendo {archivo}: {e}")
         return []
 
 def escribir_csv(archivo, datos, campos):
-    """Escribe datos a un archivo CSV"""
+    """Escribe datos a un archivo CSV registrando solo los cambios"""
+    archivo = ruta_datos(archivo)
+    inicio = time.perf_counter()
     try:
-        with open(archivo, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=campos)
-            writer.writeheader()
-            if datos:
-                writer.writerows(datos)
+        clave = clave_tabla(archivo)
+        if not clave:
+            escribir_instantanea(archivo, datos, campos)
+            return True
+        
+        with bloqueo_tabla(archivo):
+            campos_actuales, filas_actuales = leer_tabla(archivo)
+            if tabla_normalizada(archivo, campos_actuales):
+                campos = [c for c in campos if c not in COLUMNAS_DERIVADAS[os.path.basename(archivo)]]
+            nuevas = [normalizar_fila(d, campos) for d in (datos or [])]
+            
+            # Si cambia la estructura o hay filas sin clave, reescribir completo
+            if (list(campos) != campos_actuales or not os.path.exists(archivo) or
+                    any(not fila.get(clave) for fila in nuevas)):
+                escribir_instantanea(archivo, nuevas, campos)
+                eliminar_registro(archivo)
+                _cache_tablas.pop(archivo, None)
+                registrar_csv('escribir', archivo, filas=len(nuevas), bytes_=os.path.getsize(archivo),
+                              segundos=time.perf_counter() - inicio)
+                return True
+            
+            # Los cambios se calculan contra la versión que leyó esta petición,
+            # así no se pierden filas que otra petición escribió mientras tanto
+            base = version_leida(archivo)
+            anteriores = {fila[clave]: fila for fila in (filas_actuales if base is None else base)}
+            claves_nuevas = set()
+            cambios = []
+            for fila in nuevas:
+                claves_nuevas.add(fila[clave])
+                if anteriores.get(fila[clave]) != fila:
+                    cambios.append({'op': 'upsert', 'fila': fila})
+            for pk in anteriores:
+                if pk not in claves_nuevas:
+                    cambios.append({'op': 'delete', 'pk': pk})
+            
+            texto = ''.join(json.dumps(c, ensure_ascii=False) + '\n' for c in cambios)
+            if cambios:
+                with open(registro_de(archivo), 'a', encoding='utf-8') as f:
+                    f.write(texto)
+                    f.flush()
+            
+            # Estado resultante = estado actual + cambios de esta petición
+            actuales = {fila[clave]: fila for fila in filas_actuales}
+            resultado = dict(actuales)
+            for cambio in cambios:
+                if cambio['op'] == 'upsert':
+                    resultado[cambio['fila'][clave]] = cambio['fila']
+                else:
+                    resultado.pop(cambio['pk'], None)
+            resultado = list(resultado.values())
+            _cache_tablas[archivo] = (firma_tabla(archivo), list(campos), resultado)
+            recordar_version_leida(archivo, resultado)
+            
+            # Índices derivados que se actualizan con el cambio en vez de reconstruirse
+            for actualizar in INDICES_INCREMENTALES.get(os.path.basename(archivo), ()):
+                actualizar(archivo, filas_actuales, actuales, cambios, resultado)
+        
+        registrar_csv('escribir', archivo, filas=len(cambios), bytes_=len(texto.encode('utf-8')),
+                      segundos=time.perf_counter() - inicio)
+        if os.path.exists(registro_de(archivo)) and os.path.getsize(registro_de(archivo)) > LIMITE_REGISTRO_BYTES:
+            programar_compactacion(archivo)
         return True
     except Exception as e:
         print(f"Error escribiendo {archivo}: {e}")
         return False
 
+# =============================================
+# REGISTRO DE CAMBIOS Y COMPACTACIÓN
+# =============================================
+# Cada tabla es una instantánea CSV más un registro (<tabla>.csv.log) con
+# una línea JSON por cambio. Las escrituras solo agregan al registro y la
+# compactación lo integra periódicamente en una nueva instantánea.
+
+_bloqueos_tablas = {}
+_bloqueos_guard = threading.Lock()
+_bloqueos_locales = threading.local()
+_cache_tablas = {}
+_compactando = set()
+_compactadores = set()
+
+def clave_tabla(archivo):
+    """Obtiene la clave primaria de una tabla (None si no tiene registro)"""
+    return CLAVES_TABLAS.get(os.path.basename(archivo))
+
+def recordar_version_leida(archivo, filas):
+    """Guarda en la petición actual la versión de la tabla que se leyó"""
+    if has_app_context():
+        g.setdefault('versiones_leidas', {})[archivo] = filas
+
+def version_leida(archivo):
+    """Versión de la tabla leída por la petición actual (None si no hay)"""
+    if has_app_context():
+        return g.get('versiones_leidas', {}).get(archivo)
+    return None
+
+def registro_de(archivo):
+    """Ruta del registro de cambios de una tabla"""
+    return archivo + '.log'
+
+def normalizar_fila(fila, campos):
+    """Deja una fila solo con los campos de la tabla y valores de texto"""
+    return {c: '' if fila.get(c) is None else str(fila.get(c)) for c in campos}
+
+@contextmanager
+def bloqueo_tabla(archivo):
+    """Bloqueo exclusivo de escritura de una tabla (hilos y procesos)"""
+    with _bloqueos_guard:
+        bloqueo = _bloqueos_tablas.setdefault(archivo, threading.RLock())
+    with bloqueo:
+        # Reentrante: el flock solo lo toma el primer nivel de cada hilo
+        tenidos = _bloqueos_locales.__dict__.setdefault('tenidos', set())
+        if fcntl is None or archivo in tenidos:
+            yield
+            return
+        with open(archivo + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            tenidos.add(archivo)
+            try:
+                yield
+            finally:
+                tenidos.discard(archivo)
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def firma_tabla(archivo):
+    """Identifica la versión en disco de la instantánea y su registro"""
+    firma = []
+    for ruta in (archivo, registro_de(archivo)):
+        try:
+            st = os.stat(ruta)
+            firma.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            firma.append(None)
+    return tuple(firma)
+
+def leer_tabla(archivo):
+    """Lee instantánea + registro; devuelve (campos, filas) sin copiar"""
+    anotar_lectura(archivo)
+    clave = clave_tabla(archivo)
+    for _ in range(5):
+        firma = firma_tabla(archivo)
+        en_cache = _cache_tablas.get(archivo)
+        if en_cache and en_cache[0] == firma:
+            return en_cache[1], en_cache[2]
+        
+        campos, filas = [], {}
+        try:
+            with open(archivo, 'r', encoding='utf-8') as f:
+                lector = csv.DictReader(f)
+                campos = list(lector.fieldnames or [])
+                for n, fila in enumerate(lector):
+                    fila = normalizar_fila(fila, campos)
+                    filas[fila.get(clave) or ('', n)] = fila
+        except FileNotFoundError:
+            pass
+        aplicar_registro(archivo, filas, campos, clave)
+        registrar_csv('leer', archivo, llamadas=0,
+                      bytes_=sum(f[2] for f in firma if f))
+        
+        # Si una compactación o escritura cambió los archivos, releer
+        if firma_tabla(archivo) == firma:
+            filas = list(filas.values())
+            _cache_tablas[archivo] = (firma, campos, filas)
+            return campos, filas
+    return campos, list(filas.values())
+
+def aplicar_registro(archivo, filas, campos, clave):
+    """Aplica sobre `filas` los cambios pendientes del registro"""
+    try:
+        with open(registro_de(archivo), 'r', encoding='utf-8') as f:
+            for linea in f:
+                try:
+                    cambio = json.loads(linea)
+                except ValueError:
+                    continue  # línea incompleta por una escritura interrumpida
+                if cambio.get('op') == 'upsert':
+                    fila = normalizar_fila(cambio['fila'], campos)
+                    filas[fila[clave]] = fila
+                elif cambio.get('op') == 'delete':
+                    filas.pop(cambio.get('pk'), None)
+    except FileNotFoundError:
+        pass
+
+def escribir_instantanea(archivo, datos, campos):
+    """Escribe la tabla completa de forma atómica (archivo temporal + rename)"""
+    temporal = archivo + '.tmp'
+    with open(temporal, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=campos)
+        writer.writeheader()
+        if datos:
+            writer.writerows(datos)
+    os.replace(temporal, archivo)
+
+def eliminar_registro(archivo):
+    """Elimina el registro de cambios ya aplicado"""
+    try:
+        os.remove(registro_de(archivo))
+    except FileNotFoundError:
+        pass
+
+def compactar_tabla(archivo):
+    """Integra el registro de cambios en una nueva instantánea de la tabla"""
+    archivo = ruta_datos(archivo)
+    if not clave_tabla(archivo):
+        return False
+    if not os.path.exists(registro_de(archivo)) and not stock_desactualizado(archivo):
+        return False
+    try:
+        # Solo bloquea a los escritores; los lectores detectan el cambio
+        # de versión y releen la nueva instantánea
+        with bloqueo_tabla(archivo):
+            campos, filas = leer_tabla(archivo)
+            if not campos:
+                return False
+            if os.path.basename(archivo) == INVENTARIO_CSV:
+                # La copia de cantidad/estado se refresca desde el libro
+                filas = aplicar_saldos(archivo, [dict(fila) for fila in filas])
+            escribir_instantanea(archivo, filas, campos)
+            eliminar_registro(archivo)
+            _cache_tablas[archivo] = (firma_tabla(archivo), campos, filas)
+        return True
+    except Exception as e:
+        print(f"Error compactando {archivo}: {e}")
+        return False
+
+def compactar_todo(carpeta=None):
+    """Compacta todas las tablas con cambios pendientes"""
+    return [t for t in TABLAS_CSV if compactar_tabla(ruta_datos(t, carpeta))]
+
+def programar_compactacion(archivo):
+    """Compacta una tabla en segundo plano (una sola vez a la vez)"""
+    with _bloqueos_guard:
+        if archivo in _compactando:
+            return
+        _compactando.add(archivo)
+    
+    def tarea():
+        try:
+            compactar_tabla(archivo)
+        finally:
+            with _bloqueos_guard:
+                _compactando.discard(archivo)
+    
+    threading.Thread(target=tarea, daemon=True).start()
+
+def iniciar_compactador(carpeta, intervalo=INTERVALO_COMPACTACION):
+    """Inicia el hilo que compacta periódicamente los registros de una carpeta"""
+    with _bloqueos_guard:
+        if intervalo <= 0 or carpeta in _compactadores:
+            return
+        _compactadores.add(carpeta)
+    
+    def ciclo():
+        while True:
+            time.sleep(intervalo)
+            compactar_todo(carpeta)
+    
+    threading.Thread(target=ciclo, daemon=True).start()
+
 def generar_id():
     """Genera un ID único"""
     import secrets
@@ -240,235 +670,3050 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Context processor para inyectar variables a todos los templates
-@app.context_processor
-def inject_now():
-    return {
-        'now': datetime.now(),
-        'current_year': datetime.now().year,
-        'current_month': datetime.now().month,
-        'current_day': datetime.now().day
-    }
-
 # =============================================
-# FUNCIONES PARA CALENDARIO MEJORADO
+# ARCHIVO HISTÓRICO
 # =============================================
+# prestamos.csv, deudas.csv y reservas.csv guardan solo lo vigente:
+# préstamos abiertos, deudas pendientes y reservas futuras, más lo cerrado
+# en los últimos ARCHIVO_DIAS días. Lo demás se mueve a archivos por
+# semestre (o por año) en la subcarpeta `archivo`, opcionalmente con gzip.
+# Los listados leen solo lo vigente; el historial y los reportes recorren
+# los archivos fila por fila cuando se piden.
 
-def obtener_mes_actual():
-    """Obtiene el mes y año actual"""
-    now = datetime.now()
-    return now.year, now.month
+CARPETA_ARCHIVO = 'archivo'
+TABLAS_ARCHIVO = {
+    # tabla: campo de fecha que decide el periodo
+    PRESTAMOS_CSV: 'fecha_prestamo',
+    DEUDAS_CSV: 'fecha_deuda',
+    RESERVAS_CSV: 'fecha',
+}
 
-def generar_calendario_mes(year, month):
-    """Genera estructura completa del calendario para un mes"""
-    # Obtener información del mes
-    cal = calendar.monthcalendar(year, month)
-    month_name = datetime(year, month, 1).strftime('%B').capitalize()
-    year_name = year
-    
-    # Generar días del mes con información detallada
-    days = []
-    today = datetime.now().date()
-    
-    for week in cal:
-        week_days = []
-        for day in week:
-            if day == 0:
-                week_days.append(None)  # Día fuera del mes
-            else:
-                day_date = datetime(year, month, day).date()
-                is_today = (day_date == today)
-                is_weekend = day_date.weekday() >= 5  # 5=sábado, 6=domingo
-                is_past = (day_date < today)
-                
-                week_days.append({
-                    'day': day,
-                    'date': day_date.strftime('%Y-%m-%d'),
-                    'is_today': is_today,
-                    'is_weekend': is_weekend,
-                    'is_past': is_past,
-                    'weekday': day_date.strftime('%A').capitalize()[:3]
-                })
-        days.append(week_days)
-    
-    # Calcular estadísticas del mes
-    total_dias = sum(1 for week in cal for day in week if day != 0)
-    dias_laborables = sum(1 for week in cal for day in week 
-                         if day != 0 and datetime(year, month, day).weekday() < 5)
-    
-    # Obtener reservas del mes
-    reservas = leer_csv(RESERVAS_CSV)
-    reservas_mes = []
-    for reserva in reservas:
-        try:
-            fecha_reserva = datetime.strptime(reserva['fecha'], '%Y-%m-%d')
-            if fecha_reserva.year == year and fecha_reserva.month == month:
-                reservas_mes.append(reserva)
-        except:
+_archivadores = set()
+_resumenes_archivados = {}
+
+def carpeta_archivo(carpeta=None):
+    """Subcarpeta con los archivos históricos de la carpeta de datos"""
+    return os.path.join(carpeta or carpeta_datos(), CARPETA_ARCHIVO)
+
+def config_archivo(clave, predeterminado):
+    """Opción de archivo de la app actual (o el valor predeterminado)"""
+    return current_app.config.get(clave, predeterminado) if has_app_context() else predeterminado
+
+def corte_archivo(hoy=None):
+    """Fecha (AAAA-MM-DD) antes de la cual lo cerrado se archiva"""
+    hoy = hoy or datetime.now().date()
+    return (hoy - timedelta(days=config_archivo('ARCHIVO_DIAS', 30))).isoformat()
+
+def periodo_archivo(fecha, por='semestre'):
+    """Periodo de archivo de una fecha ('2025-S1' o '2025'); None si no es válida"""
+    try:
+        fecha = datetime.strptime((fecha or '')[:10], '%Y-%m-%d')
+    except ValueError:
+        return None
+    if por == 'anio':
+        return str(fecha.year)
+    return f"{fecha.year}-S{1 if fecha.month <= 6 else 2}"
+
+def limites_periodo(periodo):
+    """Primera y última fecha de un periodo de archivo"""
+    anio, _, semestre = periodo.partition('-S')
+    if semestre == '1':
+        return f'{anio}-01-01', f'{anio}-06-30'
+    if semestre == '2':
+        return f'{anio}-07-01', f'{anio}-12-31'
+    return f'{anio}-01-01', f'{anio}-12-31'
+
+def particiones(tabla, desde=None, hasta=None, carpeta=None):
+    """[(periodo, ruta)] de los archivos de una tabla que tocan [desde, hasta]"""
+    carpeta = carpeta_archivo(carpeta)
+    patron = re.compile(re.escape(os.path.splitext(tabla)[0]) + r'_(\d{4}(?:-S[12])?)\.csv(?:\.gz)?')
+    try:
+        nombres = sorted(os.listdir(carpeta))
+    except FileNotFoundError:
+        return []
+    resultado = []
+    for nombre in nombres:
+        coincide = patron.fullmatch(nombre)
+        if not coincide:
+            continue
+        inicio, fin = limites_periodo(coincide.group(1))
+        if (desde and fin < desde) or (hasta and inicio > hasta):
+            continue
+        resultado.append((coincide.group(1), os.path.join(carpeta, nombre)))
+    return resultado
+
+def abrir_particion(ruta, modo='r'):
+    """Abre un archivo histórico de texto, comprimido o no"""
+    if ruta.endswith('.gz'):
+        return gzip.open(ruta, modo + 't', newline='', encoding='utf-8')
+    return open(ruta, modo, newline='', encoding='utf-8')
+
+def filas_archivadas(tabla, desde=None, hasta=None):
+    """Recorre las filas archivadas de una tabla entre dos fechas, sin cargarlas todas"""
+    campo = TABLAS_ARCHIVO[tabla]
+    for _, ruta in particiones(tabla, desde, hasta):
+        anotar_lectura(ruta)
+        with abrir_particion(ruta) as f:
+            for fila in csv.DictReader(f):
+                fecha = fila.get(campo, '')[:10]
+                if (desde and fecha < desde) or (hasta and fecha > hasta):
+                    continue
+                yield fila
+
+def historial(tabla, desde=None, hasta=None):
+    """Filas archivadas y vigentes de una tabla; si una fila está en ambas gana la vigente
+
+    Las archivadas se marcan con `archivado` para que las vistas no
+    ofrezcan acciones sobre ellas.
+    """
+    clave = CLAVES_TABLAS[tabla]
+    campo = TABLAS_ARCHIVO[tabla]
+    vigentes = leer_csv(tabla)
+    ids = {fila.get(clave) for fila in vigentes}
+    for fila in filas_archivadas(tabla, desde, hasta):
+        if fila.get(clave) not in ids:
+            fila['archivado'] = '1'
+            yield fila
+    for fila in vigentes:
+        fecha = fila.get(campo, '')[:10]
+        if (desde and fecha < desde) or (hasta and fecha > hasta):
             continue
+        yield fila
+
+def fila_archivable(tabla, fila, corte):
+    """Indica si una fila está cerrada desde antes de `corte`"""
+    if tabla == PRESTAMOS_CSV:
+        return (fila.get('estado') == 'devuelto' and
+                max(fila.get('fecha_prestamo', '')[:10], fila.get('fecha_devolucion', '')[:10]) < corte)
+    if tabla == DEUDAS_CSV:
+        return (fila.get('estado') == 'pagado' and
+                max(fila.get('fecha_deuda', '')[:10], fila.get('fecha_pago', '')[:10]) < corte)
+    return fila.get('fecha', '')[:10] < corte
+
+def escribir_particion(tabla, periodo, campos, filas, comprimir):
+    """Agrega filas al archivo de un periodo (reescritura atómica, sin duplicar claves)"""
+    carpeta = carpeta_archivo()
+    os.makedirs(carpeta, exist_ok=True)
+    base = os.path.join(carpeta, f'{os.path.splitext(tabla)[0]}_{periodo}.csv')
+    destino = base + '.gz' if comprimir else base
+    clave = CLAVES_TABLAS[tabla]
     
-    # Contar reservas por día
-    reservas_por_dia = {}
-    for reserva in reservas_mes:
-        fecha = reserva['fecha']
-        if fecha not in reservas_por_dia:
-            reservas_por_dia[fecha] = 0
-        reservas_por_dia[fecha] += 1
+    # Lo ya archivado del periodo (en cualquiera de los dos formatos) se conserva
+    existentes = {}
+    for ruta in (base, base + '.gz'):
+        if os.path.exists(ruta):
+            with abrir_particion(ruta) as f:
+                for fila in csv.DictReader(f):
+                    existentes[fila.get(clave)] = fila
+    for fila in filas:
+        existentes[fila[clave]] = fila
     
-    # Agregar conteo de reservas a cada día
-    for week in days:
-        for day_info in week:
-            if day_info and 'date' in day_info:
-                day_info['reservas_count'] = reservas_por_dia.get(day_info['date'], 0)
+    temporal = destino + '.tmp'
+    with (gzip.open(temporal, 'wt', newline='', encoding='utf-8') if comprimir
+          else open(temporal, 'w', newline='', encoding='utf-8')) as f:
+        writer = csv.DictWriter(f, fieldnames=campos)
+        writer.writeheader()
+        writer.writerows(normalizar_fila(fila, campos) for fila in existentes.values())
+    os.replace(temporal, destino)
+    otro = base if comprimir else base + '.gz'
+    for ruta in (otro, otro + '.idx'):
+        # El índice de posiciones del formato anterior ya no sirve
+        if os.path.exists(ruta):
+            os.remove(ruta)
+
+def archivar_tabla(tabla, hoy=None, retenidos=()):
+    """Mueve a los archivos por periodo las filas cerradas antes del corte
+
+    Las claves de `retenidos` se quedan en la tabla vigente. Devuelve el
+    número de filas archivadas.
+    """
+    archivo = ruta_datos(tabla)
+    clave = CLAVES_TABLAS[tabla]
+    corte = corte_archivo(hoy)
+    por = config_archivo('ARCHIVO_PERIODO', 'semestre')
+    with bloqueo_tabla(archivo):
+        campos, filas = leer_tabla(archivo)
+        grupos = {}
+        for fila in filas:
+            if fila.get(clave) in retenidos or not fila_archivable(tabla, fila, corte):
+                continue
+            periodo = periodo_archivo(fila.get(TABLAS_ARCHIVO[tabla]), por)
+            if periodo:
+                grupos.setdefault(periodo, []).append(fila)
+        if not grupos:
+            return 0
+        
+        # Lo archivado no cambia: se guarda con los nombres ya resueltos
+        esquema = campos
+        if tabla_normalizada(archivo, campos):
+            esquema = ESQUEMAS_DESNORMALIZADOS[tabla]
+        for periodo, filas_periodo in sorted(grupos.items()):
+            copias = [dict(fila) for fila in filas_periodo]
+            if esquema is not campos:
+                resolver_referencias(archivo, copias)
+            escribir_particion(tabla, periodo, esquema, copias, config_archivo('ARCHIVO_GZIP', False))
+        
+        # Si algo falla antes de aquí, las filas quedan en ambos lados y
+        # el historial se queda con la vigente
+        archivadas = {fila[clave] for filas_periodo in grupos.values() for fila in filas_periodo}
+        restantes = [fila for fila in filas if fila.get(clave) not in archivadas]
+        escribir_instantanea(archivo, restantes, campos)
+        eliminar_registro(archivo)
+        _cache_tablas[archivo] = (firma_tabla(archivo), campos, restantes)
+        
+        # Archivar no es un cambio que deban ver las pantallas en vivo
+        canal = _canales.get(os.path.dirname(archivo))
+        if canal is not None:
+            with canal.vigilancia:
+                if archivo in canal.vistas:
+                    canal.vistas[archivo] = restantes
+                    canal.firmas[archivo] = firma_tabla(archivo)
+    return len(archivadas)
+
+def archivar_todo(hoy=None):
+    """Archiva préstamos, deudas y reservas cerrados; devuelve {tabla: filas}"""
+    archivadas = {DEUDAS_CSV: archivar_tabla(DEUDAS_CSV, hoy)}
+    # Los préstamos con deudas vigentes se quedan: las deudas los buscan por
+    # clave. El bloqueo de préstamos cubre también la lectura de las deudas,
+    # igual que en nueva_deuda, para no archivar uno que acaba de recibir deuda
+    with bloqueo_tabla(ruta_datos(PRESTAMOS_CSV)):
+        retenidos = {d.get('id_prestamo') for d in leer_tabla(ruta_datos(DEUDAS_CSV))[1]}
+        archivadas[PRESTAMOS_CSV] = archivar_tabla(PRESTAMOS_CSV, hoy, retenidos)
+    archivadas[RESERVAS_CSV] = archivar_tabla(RESERVAS_CSV, hoy)
+    return {tabla: n for tabla, n in archivadas.items() if n}
+
+def iniciar_archivador(app, intervalo=INTERVALO_ARCHIVO):
+    """Inicia el hilo que archiva periódicamente lo cerrado"""
+    carpeta = app.config['CSV_FOLDER']
+    with _bloqueos_guard:
+        if intervalo <= 0 or carpeta in _archivadores:
+            return
+        _archivadores.add(carpeta)
     
-    # Calcular horas totales reservadas
-    horas_totales = 0
-    grupos_unicos = set()
-    profesores_unicos = set()
-    for reserva in reservas_mes:
-        try:
-            horas_totales += int(reserva.get('duracion', 0))
-            grupos_unicos.add(reserva.get('grupo', ''))
-            profesores_unicos.add(reserva.get('profesor', ''))
-        except:
-            continue
+    def ciclo():
+        while True:
+            time.sleep(intervalo)
+            try:
+                with app.app_context():
+                    archivar_todo()
+            except Exception as e:
+                print(f"Error archivando: {e}")
     
-    return {
-        'year': year,
-        'month': month,
-        'month_name': month_name,
-        'year_name': year_name,
-        'calendar': days,
-        'reservas_mes': reservas_mes,
-        'total_reservas': len(reservas_mes),
-        'total_dias': total_dias,
-        'dias_laborables': dias_laborables,
-        'horas_totales': horas_totales,
-        'grupos_unicos': len(grupos_unicos),
-        'profesores_unicos': len(profesores_unicos),
-        'prev_month': get_previous_month(year, month),
-        'next_month': get_next_month(year, month),
-        'today': today.strftime('%Y-%m-%d')
-    }
+    threading.Thread(target=ciclo, daemon=True).start()
 
-def get_previous_month(year, month):
-    """Obtiene el mes anterior"""
-    if month == 1:
-        return year - 1, 12
-    return year, month - 1
+# =============================================
+# ÍNDICE DE FILAS POR POSICIÓN
+# =============================================
+# Para leer pocas filas de un prestamos.csv muy grande sin cargarlo entero:
+# un índice lateral (<archivo>.idx) guarda la posición en bytes de cada fila
+# de la instantánea y se construye en una sola pasada. Las filas se leen
+# con mmap, decodificando solo las pedidas, y el registro de cambios se
+# indexa en memoria leyendo únicamente lo agregado desde la última consulta.
+# El archivo se mapea solo mientras dura cada consulta: en Windows un mapa
+# abierto impide que la compactación o el archivado lo reemplacen.
 
-def get_next_month(year, month):
-    """Obtiene el mes siguiente"""
-    if month == 12:
-        return year + 1, 1
-    return year, month + 1
+CABECERA_INDICE = 'XONILAB-IDX 1'
+TABLAS_INDICE_FILAS = {PRESTAMOS_CSV: 'id_item'}
+_indices_filas = {}
 
-def obtener_horarios_disponibles(fecha, hora_inicio=None):
-    """Obtiene horarios disponibles para una fecha específica"""
-    # Generar todos los horarios de 7am a 7pm
-    horarios = []
-    for hora in range(7, 19):
-        horarios.append(f"{hora:02d}:00")
+class IndiceFilas:
+    """Clave primaria -> posición de cada fila de un CSV y de su registro"""
     
-    # Si no hay hora_inicio especificada, devolver todos los horarios
-    if not hora_inicio:
-        return horarios
+    def __init__(self, ruta, clave, columna):
+        self.ruta = ruta
+        self.clave = clave
+        self.columna = columna
+        self.bloqueo = threading.Lock()
+        self.firma = None
+        self.campos = []
+        self.posiciones = {}
+        self.por_columna = {}
+        self.registro = {}
+        self.registro_ino = None
+        self.leido = 0
     
-    # Obtener reservas para la fecha
-    reservas = leer_csv(RESERVAS_CSV)
-    reservas_dia = [r for r in reservas if r['fecha'] == fecha and r.get('estado') == 'confirmada']
+    def actualizar(self):
+        """Sigue a la versión en disco: reindexa si cambió la instantánea y aplica lo nuevo del registro"""
+        with self.bloqueo:
+            with self.mapeado():
+                pass
+            self.aplicar_registro()
     
-    # Verificar horarios ocupados
-    horarios_ocupados = []
-    for reserva in reservas_dia:
+    @contextmanager
+    def mapeado(self):
+        """Mapea la instantánea mientras dura el bloque (None si está vacía)
+
+        Se llama con self.bloqueo tomado. Si el archivo ya no es el
+        indexado (se compactó o archivó), se reindexa antes de usarlo.
+        """
         try:
-            inicio = int(reserva['hora_inicio'].split(':')[0])
-            fin = int(reserva['hora_fin'].split(':')[0])
-            # Marcar todas las horas que están ocupadas
-            for hora in range(inicio, fin):
-                horarios_ocupados.append(f"{hora:02d}:00")
-        except:
-            continue
+            f = open(self.ruta, 'rb')
+        except FileNotFoundError:
+            self.olvidar()
+            yield None
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            firma = (st.st_ino, st.st_mtime_ns, st.st_size)
+            mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else None
+            try:
+                if firma != self.firma:
+                    self.olvidar()
+                    self.firma = firma
+                    self.cargar(mapa)
+                    self.aplicar_registro()
+                yield mapa
+            finally:
+                if mapa is not None:
+                    mapa.close()
     
-    # Filtrar horarios disponibles
-    horarios_disponibles = [h for h in horarios if h not in horarios_ocupados]
+    def olvidar(self):
+        """Descarta lo indexado"""
+        self.firma = None
+        self.campos, self.posiciones, self.por_columna = [], {}, {}
+        self.registro, self.registro_ino, self.leido = {}, None, 0
     
-    return horarios_disponibles, horarios_ocupados
-
-def verificar_disponibilidad(fecha, hora_inicio, duracion):
-    """Verifica si un horario está disponible"""
-    try:
-        hora_inicio_int = int(hora_inicio.split(':')[0])
-        hora_fin_int = hora_inicio_int + int(duracion)
-        
-        # Verificar que esté dentro del rango permitido
-        if hora_inicio_int < 7 or hora_fin_int > 19:
-            return False, "Horario fuera del rango permitido (7:00 - 19:00)"
-        
-        # Obtener reservas del día
-        reservas = leer_csv(RESERVAS_CSV)
-        reservas_dia = [r for r in reservas if r['fecha'] == fecha and r.get('estado') == 'confirmada']
-        
-        # Verificar solapamiento
-        for reserva in reservas_dia:
+    def cargar(self, mapa):
+        """Carga el índice lateral de esta instantánea o lo construye"""
+        if mapa is None:
+            return
+        self.campos = next(csv.reader(StringIO(mapa[:mapa.find(b'\n') + 1].decode('utf-8'))), [])
+        lateral = self.ruta + '.idx'
+        cabecera = f"{CABECERA_INDICE} {' '.join(map(str, self.firma))}\n"
+        if not self.leer_lateral(lateral, cabecera):
+            # Otro proceso puede estar construyéndolo: se espera y se reintenta
+            with bloqueo_tabla(lateral):
+                if not self.leer_lateral(lateral, cabecera):
+                    self.construir(mapa, lateral, cabecera)
+        por_columna = {}
+        for pk, (_, _, valor) in self.posiciones.items():
+            por_columna.setdefault(valor, []).append(pk)
+        self.por_columna = por_columna
+    
+    def leer_lateral(self, lateral, cabecera):
+        """Lee el índice lateral si corresponde a la instantánea actual"""
+        try:
+            with open(lateral, 'r', encoding='utf-8') as f:
+                if f.readline() != cabecera:
+                    return False
+                posiciones = {}
+                for linea in f:
+                    pk, inicio, fin, valor = linea.rstrip('\n').split('\t')
+                    posiciones[pk] = (int(inicio), int(fin), valor)
+        except (FileNotFoundError, ValueError):
+            return False
+        self.posiciones = posiciones
+        return True
+    
+    def construir(self, mapa, lateral, cabecera):
+        """Recorre la instantánea una vez anotando dónde empieza y termina cada fila"""
+        inicio = time.perf_counter()
+        posicion = 0
+        
+        def lineas():
+            nonlocal posicion
+            mapa.seek(0)
+            for linea in iter(mapa.readline, b''):
+                posicion += len(linea)
+                yield linea.decode('utf-8')
+        
+        lector = csv.reader(lineas())
+        next(lector, None)
+        i_clave = self.campos.index(self.clave) if self.clave in self.campos else None
+        i_columna = self.campos.index(self.columna) if self.columna in self.campos else None
+        posiciones = {}
+        desde = posicion
+        for valores in lector:
+            # El lector solo consume las líneas de la fila (también si tiene saltos entre comillas)
+            if i_clave is not None and i_clave < len(valores) and valores[i_clave]:
+                valor = valores[i_columna] if i_columna is not None and i_columna < len(valores) else ''
+                posiciones[valores[i_clave]] = (desde, posicion, valor)
+            desde = posicion
+        
+        temporal = lateral + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            f.write(cabecera)
+            f.writelines(f'{pk}\t{a}\t{b}\t{valor}\n' for pk, (a, b, valor) in posiciones.items())
+        os.replace(temporal, lateral)
+        self.posiciones = posiciones
+        registrar_csv('leer', self.ruta, filas=len(posiciones), bytes_=posicion,
+                      segundos=time.perf_counter() - inicio)
+    
+    def aplicar_registro(self):
+        """Indexa en memoria lo agregado al registro desde la última vez"""
+        try:
+            with open(registro_de(self.ruta), 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_ino != self.registro_ino or st.st_size < self.leido:
+                    # Registro nuevo (tras compactar): se aplica desde el principio
+                    self.registro, self.registro_ino, self.leido = {}, st.st_ino, 0
+                f.seek(self.leido)
+                nuevo = f.read()
+        except FileNotFoundError:
+            self.registro, self.registro_ino, self.leido = {}, None, 0
+            return
+        # Una línea sin terminar es una escritura en curso: se lee la próxima vez
+        nuevo = nuevo[:nuevo.rfind(b'\n') + 1]
+        self.leido += len(nuevo)
+        for linea in nuevo.splitlines():
             try:
-                inicio_existente = int(reserva['hora_inicio'].split(':')[0])
-                fin_existente = int(reserva['hora_fin'].split(':')[0])
-                
-                # Verificar solapamiento
-                if hora_inicio_int < fin_existente and hora_fin_int > inicio_existente:
-                    return False, f"El horario se solapa con una reserva existente: {reserva['hora_inicio']}-{reserva['hora_fin']}"
-            except:
+                cambio = json.loads(linea)
+            except ValueError:
                 continue
-        
-        return True, "Horario disponible"
-    except Exception as e:
-        return False, f"Error verificando disponibilidad: {str(e)}"
-
-def obtener_horarios_detalle(fecha):
-    """Obtiene detalle de horarios para un día específico"""
-    horarios = []
-    reservas = leer_csv(RESERVAS_CSV)
-    reservas_dia = [r for r in reservas if r['fecha'] == fecha and r.get('estado') == 'confirmada']
+            if cambio.get('op') == 'upsert':
+                fila = normalizar_fila(cambio['fila'], self.campos)
+                self.registro[fila[self.clave]] = fila
+            elif cambio.get('op') == 'delete':
+                self.registro[cambio.get('pk')] = None
     
-    for hora in range(7, 19):
+    def _decodificar(self, mapa, pk):
+        """Fila actual de una clave (None si no existe); lee solo sus bytes"""
+        if pk in self.registro:
+            fila = self.registro[pk]
+            return dict(fila) if fila is not None else None
+        posicion = self.posiciones.get(pk)
+        if posicion is None or mapa is None:
+            return None
+        valores = next(csv.reader(StringIO(mapa[posicion[0]:posicion[1]].decode('utf-8'))), [])
+        return normalizar_fila(dict(zip(self.campos, valores)), self.campos)
+    
+    def existe(self, pk):
+        """Indica si la clave está en la tabla"""
+        with self.bloqueo:
+            if pk in self.registro:
+                return self.registro[pk] is not None
+            return pk in self.posiciones
+    
+    def fila(self, pk):
+        """Copia de la fila con esa clave (None si no existe)"""
+        with self.bloqueo, self.mapeado() as mapa:
+            fila = self._decodificar(mapa, pk)
+        registrar_csv('leer', self.ruta, filas=int(fila is not None))
+        return fila
+    
+    def filas_de(self, valor):
+        """Copias de las filas cuya columna indexada tiene ese valor"""
+        with self.bloqueo, self.mapeado() as mapa:
+            claves = list(self.por_columna.get(valor, ()))
+            vistas = set(claves)
+            claves += [pk for pk, fila in self.registro.items()
+                       if fila is not None and fila.get(self.columna) == valor and pk not in vistas]
+            filas = [fila for fila in (self._decodificar(mapa, pk) for pk in claves)
+                     if fila is not None and fila.get(self.columna) == valor]
+        registrar_csv('leer', self.ruta, filas=len(filas))
+        return filas
+
+def usar_indice_filas():
+    """Indica si la app actual lee préstamos sueltos con el índice de posiciones"""
+    return has_app_context() and current_app.config.get('INDICE_FILAS', False)
+
+def indice_filas(ruta, tabla=PRESTAMOS_CSV):
+    """Índice de posiciones de un CSV de `tabla` (vigente o archivado), al día"""
+    with _bloqueos_guard:
+        indice = _indices_filas.get(ruta)
+        if indice is None:
+            indice = IndiceFilas(ruta, CLAVES_TABLAS[tabla], TABLAS_INDICE_FILAS[tabla])
+            _indices_filas[ruta] = indice
+    anotar_lectura(ruta)
+    indice.actualizar()
+    return indice
+
+def fila_prestamo(id_prestamo):
+    """Préstamo vigente tal como está guardado (None si no existe)
+
+    Con el índice de posiciones lee solo esa fila; si no, la busca en la
+    tabla en memoria. La fila devuelta no debe modificarse.
+    """
+    if usar_indice_filas():
+        return indice_filas(ruta_datos(PRESTAMOS_CSV)).fila(id_prestamo)
+    return indice_por_clave(PRESTAMOS_CSV).get(id_prestamo)
+
+def prestamo_archivado(id_prestamo):
+    """Préstamo archivado, con sus nombres ya resueltos (None si no está)
+
+    Con el índice de posiciones los archivos sin comprimir leen solo esa
+    fila; los `.gz` se recorren.
+    """
+    for _, ruta in reversed(particiones(PRESTAMOS_CSV)):
+        if usar_indice_filas() and not ruta.endswith('.gz'):
+            fila = indice_filas(ruta).fila(id_prestamo)
+        else:
+            anotar_lectura(ruta)
+            with abrir_particion(ruta) as f:
+                fila = next((fila for fila in csv.DictReader(f) if fila.get('id_prestamo') == id_prestamo), None)
+        if fila is not None:
+            return dict(fila, archivado='1')
+    return None
+
+def prestamo_por_id(id_prestamo, con_archivo=False):
+    """Copia de un préstamo vigente con nombres resueltos (None si no existe)
+
+    Con `con_archivo` también busca en los archivos históricos; esas
+    copias llevan `archivado`.
+    """
+    prestamo = fila_prestamo(id_prestamo)
+    if prestamo is None:
+        return prestamo_archivado(id_prestamo) if con_archivo else None
+    prestamo = dict(prestamo)
+    if tabla_normalizada(PRESTAMOS_CSV, list(prestamo)):
+        resolver_referencias(PRESTAMOS_CSV, [prestamo])
+    return prestamo
+
+def prestamos_de_item(id_item):
+    """Historial de préstamos de un ítem, incluidos los archivados
+
+    Con el índice de posiciones solo se decodifican las filas del ítem,
+    también en los archivos históricos sin comprimir.
+    """
+    if not usar_indice_filas():
+        return [p for p in historial(PRESTAMOS_CSV) if p['id_item'] == id_item]
+    vigentes = indice_filas(ruta_datos(PRESTAMOS_CSV))
+    resultado = []
+    for _, ruta in particiones(PRESTAMOS_CSV):
+        if ruta.endswith('.gz'):
+            anotar_lectura(ruta)
+            with abrir_particion(ruta) as f:
+                archivadas = [fila for fila in csv.DictReader(f) if fila.get('id_item') == id_item]
+        else:
+            archivadas = indice_filas(ruta).filas_de(id_item)
+        for fila in archivadas:
+            if not vigentes.existe(fila.get('id_prestamo')):
+                fila['archivado'] = '1'
+                resultado.append(fila)
+    propias = vigentes.filas_de(id_item)
+    if propias and tabla_normalizada(PRESTAMOS_CSV, vigentes.campos):
+        resolver_referencias(PRESTAMOS_CSV, propias)
+    return resultado + propias
+
+# =============================================
+# LIBRO DE MOVIMIENTOS DE STOCK
+# =============================================
+# El stock de cada ítem es la suma de sus movimientos (alta, préstamo,
+# devolución, ajuste) en movimientos.csv, que solo crece por el final. El
+# disponible se mantiene en memoria leyendo únicamente las líneas nuevas;
+# la columna `cantidad` de inventario.csv es una copia que se refresca al
+# compactar.
+
+TIPOS_MOVIMIENTO = ('alta', 'prestamo', 'devolucion', 'ajuste')
+CAMPOS_MOVIMIENTOS = ['id_movimiento', 'fecha', 'id_item', 'tipo', 'cantidad',
+                      'id_referencia', 'responsable', 'observaciones']
+
+_saldos_stock = {}
+_saldos_guard = threading.Lock()
+
+def ruta_movimientos(archivo_inventario=None):
+    """Libro de movimientos junto al inventario indicado (o el de la app)"""
+    if archivo_inventario:
+        return os.path.join(os.path.dirname(archivo_inventario), MOVIMIENTOS_CSV)
+    return ruta_datos(MOVIMIENTOS_CSV)
+
+def _actualizar_saldos(ruta):
+    """Integra las líneas nuevas del libro en los saldos (con _saldos_guard)"""
+    anotar_lectura(ruta)
+    try:
+        st = os.stat(ruta)
+    except FileNotFoundError:
+        _saldos_stock.pop(ruta, None)
+        return None
+    estado = _saldos_stock.get(ruta)
+    if not estado or estado['ino'] != st.st_ino or st.st_size < estado['offset']:
+        estado = {'ino': st.st_ino, 'offset': 0, 'columnas': None, 'saldos': {}}
+        _saldos_stock[ruta] = estado
+    if st.st_size == estado['offset']:
+        return estado['saldos']
+    
+    inicio = time.perf_counter()
+    with open(ruta, 'rb') as f:
+        f.seek(estado['offset'])
+        datos = f.read()
+    # Solo líneas completas; una escritura a medias se integra después
+    fin = datos.rfind(b'\n') + 1
+    lineas = datos[:fin].decode('utf-8').splitlines()
+    if estado['columnas'] is None and lineas:
+        encabezado = next(csv.reader(lineas[:1]))
+        estado['columnas'] = (encabezado.index('id_item'), encabezado.index('cantidad'))
+        lineas = lineas[1:]
+    col_item, col_cantidad = estado['columnas'] or (2, 4)
+    saldos = estado['saldos']
+    for fila in csv.reader(lineas):
+        try:
+            saldos[fila[col_item]] = saldos.get(fila[col_item], 0) + int(fila[col_cantidad])
+        except (IndexError, ValueError):
+            continue
+    estado['offset'] += fin
+    registrar_csv('leer', ruta, filas=len(lineas), bytes_=fin, segundos=time.perf_counter() - inicio)
+    return saldos
+
+def saldos_stock(ruta=None):
+    """Disponible de todos los ítems según el libro (None si no existe)"""
+    with _saldos_guard:
+        saldos = _actualizar_saldos(ruta or ruta_movimientos())
+        return None if saldos is None else dict(saldos)
+
+def saldo_item(id_item, ruta=None):
+    """Disponible de un ítem según el libro"""
+    with _saldos_guard:
+        return (_actualizar_saldos(ruta or ruta_movimientos()) or {}).get(id_item, 0)
+
+def registrar_movimiento(id_item, tipo, cantidad, id_referencia='', observaciones='',
+                         minimo=0, ruta=None):
+    """Agrega un movimiento al libro y devuelve (registrado, disponible)
+    
+    Las salidas que dejarían el disponible por debajo de `minimo` no se
+    registran (minimo=None las permite siempre). La comprobación y la
+    escritura ocurren bajo el mismo bloqueo, así dos préstamos simultáneos
+    no pueden tomar la misma unidad.
+    """
+    ruta = ruta or ruta_movimientos()
+    inicio = time.perf_counter()
+    with bloqueo_tabla(ruta):
+        disponible = saldo_item(id_item, ruta)
+        if minimo is not None and cantidad < 0 and disponible + cantidad < minimo:
+            return False, disponible
+        
+        return _agregar_movimientos(ruta, [(id_item, tipo, cantidad, id_referencia, observaciones)],
+                                    inicio), saldo_item(id_item, ruta)
+
+def registrar_movimientos(movimientos, ruta=None):
+    """Agrega varias entradas al libro en una sola escritura
+
+    `movimientos` son tuplas (id_item, tipo, cantidad, id_referencia,
+    observaciones). Se registran sin comprobar disponible, así que son
+    para entradas como las devoluciones.
+    """
+    if not movimientos:
+        return True
+    ruta = ruta or ruta_movimientos()
+    inicio = time.perf_counter()
+    with bloqueo_tabla(ruta):
+        return _agregar_movimientos(ruta, movimientos, inicio)
+
+def _agregar_movimientos(ruta, movimientos, inicio):
+    """Escribe las líneas al final del libro (con su bloqueo tomado)"""
+    lineas = StringIO()
+    writer = csv.writer(lineas)
+    fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    responsable = session.get('nombre', '') if has_request_context() else ''
+    for id_item, tipo, cantidad, id_referencia, observaciones in movimientos:
+        writer.writerow([generar_id(), fecha, id_item, tipo, str(cantidad),
+                         id_referencia, responsable, observaciones])
+    with open(ruta, 'a', newline='', encoding='utf-8') as f:
+        f.write(lineas.getvalue())
+        f.flush()
+    registrar_csv('escribir', ruta, filas=len(movimientos), bytes_=len(lineas.getvalue().encode('utf-8')),
+                  segundos=time.perf_counter() - inicio)
+    publicar_stock(ruta, [movimiento[0] for movimiento in movimientos])
+    return True
+
+def aplicar_saldos(archivo, filas):
+    """Sustituye cantidad y estado de las filas del inventario por el libro"""
+    saldos = saldos_stock(ruta_movimientos(archivo))
+    if saldos is None:
+        return filas
+    for fila in filas:
+        cantidad = saldos.get(fila['id_item'])
+        if cantidad is not None:
+            fila['cantidad'] = str(cantidad)
+            fila['estado'] = 'disponible' if cantidad > 0 else 'agotado'
+    return filas
+
+def stock_desactualizado(archivo):
+    """Indica si la copia de cantidades de inventario.csv difiere del libro"""
+    if os.path.basename(archivo) != INVENTARIO_CSV:
+        return False
+    saldos = saldos_stock(ruta_movimientos(archivo))
+    if not saldos:
+        return False
+    return any(fila['id_item'] in saldos and fila.get('cantidad') != str(saldos[fila['id_item']])
+               for fila in leer_tabla(archivo)[1])
+
+def resumen_movimientos(ruta=None):
+    """Suma los movimientos del libro por ítem y tipo (lectura completa)"""
+    resumen = {}
+    try:
+        with open(ruta or ruta_movimientos(), 'r', encoding='utf-8') as f:
+            for mov in csv.DictReader(f):
+                try:
+                    cantidad = int(mov['cantidad'])
+                except (TypeError, ValueError):
+                    continue
+                tipos = resumen.setdefault(mov['id_item'], {})
+                tipos[mov['tipo']] = tipos.get(mov['tipo'], 0) + cantidad
+    except FileNotFoundError:
+        return None
+    return resumen
+
+def inicializar_movimientos(carpeta=None):
+    """Crea el libro con un alta por ítem a partir de las cantidades actuales"""
+    ruta = ruta_datos(MOVIMIENTOS_CSV, carpeta)
+    with bloqueo_tabla(ruta):
+        if os.path.exists(ruta):
+            return False
+        # Los préstamos activos cuentan como existencia que está fuera
+        activos = []
+        for p in leer_tabla(ruta_datos(PRESTAMOS_CSV, carpeta))[1]:
+            try:
+                if p['estado'] == 'prestado' and int(p['cantidad']) > 0:
+                    activos.append((p['id_item'], int(p['cantidad']), p['id_prestamo']))
+            except ValueError:
+                continue
+        fuera = {}
+        for id_item, cantidad, _ in activos:
+            fuera[id_item] = fuera.get(id_item, 0) + cantidad
+        
+        fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with open(ruta + '.tmp', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(CAMPOS_MOVIMIENTOS)
+            for item in leer_tabla(ruta_datos(INVENTARIO_CSV, carpeta))[1]:
+                try:
+                    cantidad = int(item.get('cantidad') or 0)
+                except ValueError:
+                    cantidad = 0
+                writer.writerow([generar_id(), fecha, item['id_item'], 'alta',
+                                 cantidad + fuera.get(item['id_item'], 0), '', '', 'Existencia inicial'])
+            for id_item, cantidad, id_prestamo in activos:
+                writer.writerow([generar_id(), fecha, id_item, 'prestamo', -cantidad,
+                                 id_prestamo, '', 'Préstamo activo al crear el libro'])
+        os.replace(ruta + '.tmp', ruta)
+    return True
+
+# =============================================
+# MÉTRICAS E INSTRUMENTACIÓN
+# =============================================
+# Métricas por proceso (con varios workers cada uno expone las suyas).
+
+LIMITES_HISTOGRAMA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPCION_METRICAS = {
+    'xonilab_peticion_segundos': ('histogram', 'Latencia de las peticiones por ruta'),
+    'xonilab_qr_segundos': ('histogram', 'Tiempo de generación de códigos QR'),
+    'xonilab_csv_llamadas_total': ('counter', 'Llamadas a leer_csv/escribir_csv por tabla'),
+    'xonilab_csv_filas_total': ('counter', 'Filas leídas o escritas por tabla'),
+    'xonilab_csv_bytes_total': ('counter', 'Bytes leídos de disco o agregados por tabla'),
+    'xonilab_csv_segundos_total': ('counter', 'Tiempo acumulado en leer_csv/escribir_csv por tabla'),
+    'xonilab_ruta_csv_llamadas_total': ('counter', 'Llamadas a leer_csv/escribir_csv por ruta'),
+    'xonilab_ruta_csv_filas_total': ('counter', 'Filas leídas o escritas por ruta'),
+    'xonilab_ruta_csv_bytes_total': ('counter', 'Bytes leídos o escritos por ruta'),
+    'xonilab_cache_paginas_total': ('counter', 'Respuestas de páginas cacheables por resultado'),
+    'xonilab_ics_total': ('counter', 'Respuestas de los calendarios .ics por resultado'),
+    'xonilab_eventos_total': ('counter', 'Eventos en vivo publicados por tipo'),
+    'xonilab_eventos_desbordes_total': ('counter', 'Clientes de eventos cuyo búfer se llenó'),
+}
+
+class Histograma:
+    """Histograma acumulativo con límites fijos (formato Prometheus)"""
+    
+    def __init__(self):
+        self.cubetas = [0] * len(LIMITES_HISTOGRAMA)
+        self.suma = 0.0
+        self.cuenta = 0
+    
+    def observar(self, valor):
+        for i, limite in enumerate(LIMITES_HISTOGRAMA):
+            if valor <= limite:
+                self.cubetas[i] += 1
+        self.suma += valor
+        self.cuenta += 1
+
+class Metricas:
+    """Contadores e histogramas del proceso, exportables a Prometheus"""
+    
+    def __init__(self):
+        self.bloqueo = threading.Lock()
+        self.contadores = {}
+        self.histogramas = {}
+    
+    def sumar(self, nombre, etiquetas, valor=1):
+        clave = (nombre, tuple(etiquetas.items()))
+        with self.bloqueo:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+    
+    def observar(self, nombre, etiquetas, valor):
+        clave = (nombre, tuple(etiquetas.items()))
+        with self.bloqueo:
+            self.histogramas.setdefault(clave, Histograma()).observar(valor)
+    
+    def exportar(self):
+        """Texto en formato de exposición de Prometheus"""
+        def etiquetas_texto(etiquetas):
+            if not etiquetas:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in etiquetas) + '}'
+        
+        lineas = []
+        with self.bloqueo:
+            for nombre, (tipo, descripcion) in DESCRIPCION_METRICAS.items():
+                lineas.append(f'# HELP {nombre} {descripcion}')
+                lineas.append(f'# TYPE {nombre} {tipo}')
+                if tipo == 'histogram':
+                    for (n, etiquetas), h in sorted(self.histogramas.items()):
+                        if n != nombre:
+                            continue
+                        for limite, cuenta in zip(LIMITES_HISTOGRAMA, h.cubetas):
+                            lineas.append(f'{nombre}_bucket{etiquetas_texto(etiquetas + (("le", limite),))} {cuenta}')
+                        lineas.append(f'{nombre}_bucket{etiquetas_texto(etiquetas + (("le", "+Inf"),))} {h.cuenta}')
+                        lineas.append(f'{nombre}_sum{etiquetas_texto(etiquetas)} {h.suma:.6f}')
+                        lineas.append(f'{nombre}_count{etiquetas_texto(etiquetas)} {h.cuenta}')
+                else:
+                    for (n, etiquetas), valor in sorted(self.contadores.items()):
+                        if n == nombre:
+                            lineas.append(f'{nombre}{etiquetas_texto(etiquetas)} {round(valor, 6)}')
+        return '\n'.join(lineas) + '\n'
+
+metricas = Metricas()
+
+def registrar_csv(operacion, archivo, filas=0, bytes_=0, segundos=0.0, llamadas=1):
+    """Acumula una lectura/escritura de tabla en las métricas y en la petición actual"""
+    etiquetas = {'tabla': os.path.basename(archivo), 'operacion': operacion}
+    if llamadas:
+        metricas.sumar('xonilab_csv_llamadas_total', etiquetas, llamadas)
+    if filas:
+        metricas.sumar('xonilab_csv_filas_total', etiquetas, filas)
+    if bytes_:
+        metricas.sumar('xonilab_csv_bytes_total', etiquetas, bytes_)
+    if segundos:
+        metricas.sumar('xonilab_csv_segundos_total', etiquetas, segundos)
+    
+    if has_app_context() and 'medicion' in g:
+        medicion = g.medicion[operacion]
+        medicion['llamadas'] += llamadas
+        medicion['filas'] += filas
+        medicion['bytes'] += bytes_
+        medicion['segundos'] += segundos
+
+@contextmanager
+def medir_qr(tipo):
+    """Mide el tiempo de generación de un código QR"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        metricas.observar('xonilab_qr_segundos', {'tipo': tipo}, segundos)
+        if has_app_context() and 'medicion' in g:
+            g.medicion['qr']['llamadas'] += 1
+            g.medicion['qr']['segundos'] += segundos
+
+@rutas.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+    g.medicion = {op: {'llamadas': 0, 'filas': 0, 'bytes': 0, 'segundos': 0.0}
+                  for op in ('leer', 'escribir', 'qr')}
+
+@rutas.after_request
+def registrar_medicion(response):
+    if 'medicion' not in g:
+        return response
+    duracion = time.perf_counter() - g.inicio_peticion
+    ruta = request.endpoint or 'sin_ruta'
+    metricas.observar('xonilab_peticion_segundos', {'ruta': ruta, 'metodo': request.method}, duracion)
+    for operacion in ('leer', 'escribir'):
+        medicion = g.medicion[operacion]
+        etiquetas = {'ruta': ruta, 'operacion': operacion}
+        for campo in ('llamadas', 'filas', 'bytes'):
+            if medicion[campo]:
+                metricas.sumar(f'xonilab_ruta_csv_{campo}_total', etiquetas, medicion[campo])
+    
+    # Encabezado Server-Timing opcional (visible en las herramientas del navegador)
+    if current_app.config.get('SERVER_TIMING'):
+        leer, escribir, qr = g.medicion['leer'], g.medicion['escribir'], g.medicion['qr']
+        response.headers['Server-Timing'] = ', '.join([
+            f'csv-leer;dur={leer["segundos"] * 1000:.2f};desc="{leer["llamadas"]} lecturas, {leer["filas"]} filas"',
+            f'csv-escribir;dur={escribir["segundos"] * 1000:.2f};desc="{escribir["llamadas"]} escrituras, {escribir["filas"]} filas"',
+            f'qr;dur={qr["segundos"] * 1000:.2f}',
+            f'total;dur={duracion * 1000:.2f}',
+        ])
+    return response
+
+# =============================================
+# PERFILADO DE PETICIONES
+# =============================================
+# Un administrador puede perfilar una petición agregando ?perfil=1 a la URL;
+# además se puede perfilar un porcentaje de peticiones al azar
+# (PERFIL_MUESTREO). Los reportes se guardan en PERFILES_FOLDER.
+# cProfile y pyinstrument usan un gancho global del intérprete, así que en
+# cada proceso se perfila una sola petición a la vez; las demás siguen sin
+# perfil.
+
+_perfilando = threading.Lock()
+
+def debe_perfilar():
+    """Decide si la petición actual se perfila"""
+    if request.endpoint in (None, 'static') or (request.endpoint or '').startswith('perfil'):
+        return False
+    if request.args.get('perfil') == '1' and session.get('rol') == 'admin':
+        return True
+    muestreo = current_app.config.get('PERFIL_MUESTREO', 0)
+    if muestreo > 0:
+        import random
+        return random.random() < muestreo
+    return False
+
+@rutas.before_request
+def iniciar_perfil():
+    if not debe_perfilar() or not _perfilando.acquire(blocking=False):
+        return
+    motor = current_app.config.get('PERFIL_MOTOR', 'cprofile')
+    try:
+        if motor == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+                perfilador = Profiler()
+                perfilador.start()
+                g.perfil = ('pyinstrument', perfilador)
+                return
+            except ImportError:
+                pass
+        import cProfile
+        perfilador = cProfile.Profile()
+        perfilador.enable()
+        g.perfil = ('cprofile', perfilador)
+    except (ValueError, RuntimeError) as e:
+        # Otra herramienta ya perfila el proceso: la petición sigue sin perfil
+        print(f"Perfil omitido: {e}")
+        _perfilando.release()
+
+@rutas.after_request
+def guardar_perfil(response):
+    if 'perfil' not in g:
+        return response
+    motor, perfilador = g.pop('perfil')
+    try:
+        carpeta = current_app.config['PERFILES_FOLDER']
+        os.makedirs(carpeta, exist_ok=True)
+        nombre = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{request.endpoint}_{generar_id()[-6:]}"
+        base = os.path.join(carpeta, nombre)
+        
+        if motor == 'pyinstrument':
+            perfilador.stop()
+            duracion = perfilador.last_session.duration
+            with open(base + '.html', 'w', encoding='utf-8') as f:
+                f.write(perfilador.output_html())
+            texto = perfilador.output_text(unicode=True, color=False)
+        else:
+            perfilador.disable()
+            import pstats
+            import io
+            perfilador.dump_stats(base + '.prof')
+            salida = io.StringIO()
+            estadisticas = pstats.Stats(perfilador, stream=salida)
+            duracion = estadisticas.total_tt
+            estadisticas.sort_stats('cumulative').print_stats(60)
+            texto = salida.getvalue()
+        
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(texto)
+        with open(base + '.json', 'w', encoding='utf-8') as f:
+            json.dump({
+                'nombre': nombre,
+                'ruta': request.endpoint,
+                'metodo': request.method,
+                'url': request.path,
+                'parametros': {k: v for k, v in request.args.items() if k != 'perfil'},
+                'estado': response.status_code,
+                'duracion_ms': round(duracion * 1000, 2),
+                'motor': motor,
+                'usuario': session.get('username', ''),
+                'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            }, f, ensure_ascii=False)
+        
+        limpiar_perfiles(carpeta, current_app.config.get('PERFIL_MAXIMO', 200))
+    except Exception as e:
+        print(f"Error guardando perfil: {e}")
+    finally:
+        _perfilando.release()
+    return response
+
+@rutas.teardown_request
+def soltar_perfil(error=None):
+    """Detiene el perfil de una petición que terminó sin pasar por guardar_perfil"""
+    if 'perfil' not in g:
+        return
+    motor, perfilador = g.pop('perfil')
+    try:
+        if motor == 'pyinstrument':
+            perfilador.stop()
+        else:
+            perfilador.disable()
+    finally:
+        _perfilando.release()
+
+def listar_perfiles(carpeta):
+    """Metadatos de los perfiles guardados (más recientes primero)"""
+    perfiles = []
+    if not os.path.exists(carpeta):
+        return perfiles
+    for archivo in os.listdir(carpeta):
+        if archivo.endswith('.json'):
+            try:
+                with open(os.path.join(carpeta, archivo), 'r', encoding='utf-8') as f:
+                    perfiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    perfiles.sort(key=lambda p: p.get('nombre', ''), reverse=True)
+    return perfiles
+
+def limpiar_perfiles(carpeta, maximo):
+    """Conserva solo los `maximo` perfiles más recientes"""
+    for perfil in listar_perfiles(carpeta)[maximo:]:
+        for extension in ('.json', '.txt', '.prof', '.html'):
+            try:
+                os.remove(os.path.join(carpeta, perfil['nombre'] + extension))
+            except FileNotFoundError:
+                pass
+
+# =============================================
+# CACHÉ DE PÁGINAS
+# =============================================
+# Una página de consulta depende solo de las tablas que lee, del usuario y
+# del día. El vector de firmas de esas tablas (inodo, mtime, tamaño) da el
+# ETag y el Last-Modified: si no cambió se responde 304 sin ejecutar la
+# vista, y las últimas páginas renderizadas se guardan en memoria.
+
+_tablas_por_vista = {}
+_paginas = OrderedDict()
+_paginas_guard = threading.Lock()
+_paginas_bytes = [0]
+
+def anotar_lectura(archivo):
+    """Registra en la petición actual una tabla leída"""
+    if has_request_context() and 'tablas_leidas' in g:
+        g.tablas_leidas.add(archivo)
+
+def vector_versiones(tablas):
+    """Firmas en disco de las tablas indicadas, en orden estable"""
+    return tuple((os.path.basename(t), firma_tabla(t)) for t in sorted(tablas))
+
+def ultima_modificacion(vector):
+    """Fecha (timestamp) del cambio más reciente del vector"""
+    mtimes = [parte[1] for _, firma in vector for parte in firma if parte]
+    return max(mtimes) / 1e9 if mtimes else None
+
+def guardar_pagina(etag, cuerpo, mimetype):
+    """Guarda una página renderizada (LRU limitado por bytes)"""
+    maximo = current_app.config['CACHE_PAGINAS_BYTES']
+    if len(cuerpo) > maximo // 4:
+        return
+    with _paginas_guard:
+        if etag in _paginas:
+            return
+        _paginas[etag] = (cuerpo, mimetype)
+        _paginas_bytes[0] += len(cuerpo)
+        while _paginas_bytes[0] > maximo and _paginas:
+            _, (viejo, _) = _paginas.popitem(last=False)
+            _paginas_bytes[0] -= len(viejo)
+
+def pagina_cacheable(f):
+    """Respuestas condicionales y caché de HTML para vistas de solo lectura
+    
+    La primera petición a una vista aprende qué tablas lee; a partir de ahí
+    el vector se calcula antes de ejecutarla (solo os.stat) y el contenido
+    guardado es siempre al menos tan nuevo como su vector.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if (not current_app.config.get('CACHE_PAGINAS') or request.method != 'GET'
+                or session.get('_flashes')):
+            return f(*args, **kwargs)
+        
+        vista = (current_app.config['CSV_FOLDER'], request.endpoint)
+        tablas = _tablas_por_vista.get(vista)
+        g.tablas_leidas = set()
+        if tablas is None:
+            respuesta = f(*args, **kwargs)
+            _tablas_por_vista[vista] = frozenset(g.tablas_leidas)
+            return respuesta
+        
+        vector = vector_versiones(tablas)
+        etag = hashlib.sha1(repr((
+            request.endpoint, sorted(kwargs.items()), sorted(request.args.items(multi=True)),
+            session.get('username'), session.get('rol'), datetime.now().date().isoformat(), vector,
+            sorted(manifiesto_assets().items()),
+        )).encode('utf-8')).hexdigest()[:32]
+        modificado = ultima_modificacion(vector)
+        # Last-Modified tiene resolución de segundos: mientras no termine el
+        # segundo de la última escritura otra podría caer en él, así que no
+        # se anuncia ni se acepta como validador
+        if modificado and int(modificado) >= int(time.time()):
+            modificado = None
+        
+        if request.if_none_match:
+            no_modificado = request.if_none_match.contains(etag)
+        else:
+            no_modificado = bool(request.if_modified_since and modificado and
+                                 int(modificado) <= request.if_modified_since.timestamp())
+        if no_modificado:
+            metricas.sumar('xonilab_cache_paginas_total', {'resultado': '304'})
+            respuesta = Response(status=304)
+        else:
+            with _paginas_guard:
+                en_cache = _paginas.get(etag)
+                if en_cache:
+                    _paginas.move_to_end(etag)
+            if en_cache:
+                metricas.sumar('xonilab_cache_paginas_total', {'resultado': 'acierto'})
+                respuesta = Response(en_cache[0], mimetype=en_cache[1])
+            else:
+                metricas.sumar('xonilab_cache_paginas_total', {'resultado': 'fallo'})
+                respuesta = current_app.make_response(f(*args, **kwargs))
+                leidas = frozenset(g.tablas_leidas)
+                if not leidas <= tablas:
+                    # La vista leyó otras tablas: se aprenden y no se guarda
+                    _tablas_por_vista[vista] = tablas | leidas
+                    return respuesta
+                if respuesta.status_code != 200 or session.modified:
+                    # Errores, redirecciones o mensajes flash no se reutilizan
+                    return respuesta
+                guardar_pagina(etag, respuesta.get_data(), respuesta.mimetype)
+        
+        respuesta.set_etag(etag)
+        if modificado:
+            respuesta.last_modified = datetime.fromtimestamp(int(modificado), timezone.utc)
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+        respuesta.vary.add('Cookie')
+        return respuesta
+    return decorated_function
+
+# =============================================
+# RECURSOS ESTÁTICOS
+# =============================================
+# Las plantillas piden los recursos con asset('nombre'). Si assets.py ya
+# generó static/dist/manifest.json se usa la copia local con hash en el
+# nombre (cacheable para siempre); si no, la URL del CDN.
+
+_manifiestos = {}
+CACHE_INMUTABLE = 'public, max-age=31536000, immutable'
+
+def manifiesto_assets():
+    """Nombre lógico -> archivo con hash; se relee si el manifiesto cambia"""
+    ruta = os.path.join(current_app.config['ASSETS_FOLDER'], 'manifest.json')
+    try:
+        mtime = os.stat(ruta).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    en_cache = _manifiestos.get(ruta)
+    if en_cache and en_cache[0] == mtime:
+        return en_cache[1]
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            manifiesto = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error leyendo {ruta}: {e}")
+        manifiesto = {}
+    _manifiestos[ruta] = (mtime, manifiesto)
+    return manifiesto
+
+def asset(nombre):
+    """URL de un recurso de terceros: copia local con hash o CDN original"""
+    archivo = manifiesto_assets().get(nombre)
+    if archivo:
+        return url_for('servir_asset', archivo=archivo)
+    return RECURSOS_ESTATICOS[nombre]
+
+@rutas.context_processor
+def inject_assets():
+    return {'asset': asset}
+
+@rutas.route('/assets/<path:archivo>')
+def servir_asset(archivo):
+    """Sirve un recurso con hash, precomprimido si el navegador lo acepta"""
+    carpeta = current_app.config['ASSETS_FOLDER']
+    tipo = mimetypes.guess_type(archivo)[0] or 'application/octet-stream'
+    respuesta = None
+    for codificacion, extension in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[codificacion] and os.path.isfile(os.path.join(carpeta, archivo + extension)):
+            respuesta = send_from_directory(carpeta, archivo + extension, mimetype=tipo)
+            respuesta.headers['Content-Encoding'] = codificacion
+            break
+    if respuesta is None:
+        respuesta = send_from_directory(carpeta, archivo, mimetype=tipo)
+    respuesta.headers['Cache-Control'] = CACHE_INMUTABLE
+    respuesta.vary.add('Accept-Encoding')
+    return respuesta
+
+# Context processor para inyectar variables a todos los templates
+@rutas.context_processor
+def inject_now():
+    return {
+        'now': datetime.now(),
+        'current_year': datetime.now().year,
+        'current_month': datetime.now().month,
+        'current_day': datetime.now().day
+    }
+
+# =============================================
+# FUNCIONES PARA CALENDARIO MEJORADO
+# =============================================
+
+def obtener_mes_actual():
+    """Obtiene el mes y año actual"""
+    now = datetime.now()
+    return now.year, now.month
+
+def generar_calendario_mes(year, month):
+    """Genera estructura completa del calendario para un mes"""
+    # Obtener información del mes
+    cal = calendar.monthcalendar(year, month)
+    month_name = datetime(year, month, 1).strftime('%B').capitalize()
+    year_name = year
+    
+    # Generar días del mes con información detallada
+    days = []
+    today = datetime.now().date()
+    
+    for week in cal:
+        week_days = []
+        for day in week:
+            if day == 0:
+                week_days.append(None)  # Día fuera del mes
+            else:
+                day_date = datetime(year, month, day).date()
+                is_today = (day_date == today)
+                is_weekend = day_date.weekday() >= 5  # 5=sábado, 6=domingo
+                is_past = (day_date < today)
+                
+                week_days.append({
+                    'day': day,
+                    'date': day_date.strftime('%Y-%m-%d'),
+                    'is_today': is_today,
+                    'is_weekend': is_weekend,
+                    'is_past': is_past,
+                    'weekday': day_date.strftime('%A').capitalize()[:3]
+                })
+        days.append(week_days)
+    
+    # Calcular estadísticas del mes
+    total_dias = sum(1 for week in cal for day in week if day != 0)
+    dias_laborables = sum(1 for week in cal for day in week 
+                         if day != 0 and datetime(year, month, day).weekday() < 5)
+    
+    # Reservas de cada día desde el índice por fecha (ya ordenadas por hora)
+    por_fecha = reservas_de_fechas(f'{year:04d}-{month:02d}-01',
+                                   f'{year:04d}-{month:02d}-{calendar.monthrange(year, month)[1]:02d}')
+    reservas_mes = []
+    for week in days:
+        for day_info in week:
+            if day_info:
+                day_info['reservas'] = por_fecha.get(day_info['date'], [])
+                day_info['reservas_count'] = len(day_info['reservas'])
+                reservas_mes.extend(day_info['reservas'])
+    
+    # Calcular horas totales reservadas
+    horas_totales = 0
+    grupos_unicos = set()
+    profesores_unicos = set()
+    for reserva in reservas_mes:
+        try:
+            horas_totales += int(reserva.get('duracion', 0))
+            grupos_unicos.add(reserva.get('grupo', ''))
+            profesores_unicos.add(reserva.get('profesor', ''))
+        except:
+            continue
+    dias_con_reservas = sum(1 for week in days for day_info in week if day_info and day_info['reservas_count'])
+    
+    return {
+        'year': year,
+        'month': month,
+        'month_name': month_name,
+        'year_name': year_name,
+        'calendar': days,
+        'reservas_mes': reservas_mes,
+        'total_reservas': len(reservas_mes),
+        'total_dias': total_dias,
+        'dias_laborables': dias_laborables,
+        'horas_totales': horas_totales,
+        'grupos_unicos': len(grupos_unicos),
+        'profesores_unicos': len(profesores_unicos),
+        'dias_con_reservas': dias_con_reservas,
+        'reservas_por_dia': round(len(reservas_mes) / dias_laborables, 1) if dias_laborables > 0 else 0,
+        'prev_month': get_previous_month(year, month),
+        'next_month': get_next_month(year, month),
+        'today': today.strftime('%Y-%m-%d')
+    }
+
+def get_previous_month(year, month):
+    """Obtiene el mes anterior"""
+    if month == 1:
+        return year - 1, 12
+    return year, month - 1
+
+def get_next_month(year, month):
+    """Obtiene el mes siguiente"""
+    if month == 12:
+        return year + 1, 1
+    return year, month + 1
+
+def obtener_horarios_disponibles(fecha, hora_inicio=None):
+    """Obtiene horarios disponibles para una fecha específica"""
+    # Generar todos los horarios de 7am a 7pm
+    horarios = []
+    for hora in range(7, 19):
+        horarios.append(f"{hora:02d}:00")
+    
+    # Si no hay hora_inicio especificada, devolver todos los horarios
+    if not hora_inicio:
+        return horarios
+    
+    # Verificar horarios ocupados
+    horarios_ocupados = []
+    for inicio, fin, _ in indice_ocupacion().get(fecha, ()):
+        # Marcar todas las horas que están ocupadas
+        for hora in range(inicio, fin):
+            horarios_ocupados.append(f"{hora:02d}:00")
+    
+    # Filtrar horarios disponibles
+    horarios_disponibles = [h for h in horarios if h not in horarios_ocupados]
+    
+    return horarios_disponibles, horarios_ocupados
+
+def verificar_disponibilidad(fecha, hora_inicio, duracion):
+    """Verifica si un horario está disponible"""
+    try:
+        hora_inicio_int = int(hora_inicio.split(':')[0])
+        hora_fin_int = hora_inicio_int + int(duracion)
+        
+        # Verificar que esté dentro del rango permitido
+        if hora_inicio_int < HORA_APERTURA or hora_fin_int > HORA_CIERRE:
+            return False, "Horario fuera del rango permitido (7:00 - 19:00)"
+        
+        # Verificar solapamiento con las reservas confirmadas del día
+        reserva = reserva_en_conflicto(indice_ocupacion(), fecha, hora_inicio_int, hora_fin_int)
+        if reserva:
+            return False, f"El horario se solapa con una reserva existente: {reserva['hora_inicio']}-{reserva['hora_fin']}"
+        
+        return True, "Horario disponible"
+    except Exception as e:
+        return False, f"Error verificando disponibilidad: {str(e)}"
+
+def obtener_horarios_detalle(fecha, ocupacion=None):
+    """Obtiene detalle de horarios para un día específico"""
+    horarios = []
+    reservas_dia = (indice_ocupacion() if ocupacion is None else ocupacion).get(fecha, ())
+    
+    for hora in range(HORA_APERTURA, HORA_CIERRE):
         hora_str = f"{hora:02d}:00"
         ocupado = False
         reserva_en_hora = None
         es_inicio = False
         
-        for reserva in reservas_dia:
+        for hora_inicio, hora_fin, reserva in reservas_dia:
+            if hora_inicio <= hora < hora_fin:
+                ocupado = True
+                reserva_en_hora = reserva
+                es_inicio = (hora == hora_inicio)
+                break
+        
+        horarios.append({
+            'hora': hora_str,
+            'ocupado': ocupado,
+            'reserva': reserva_en_hora,
+            'es_inicio': es_inicio
+        })
+    
+    return horarios
+
+def datos_dia(fecha):
+    """Reservas confirmadas, horarios y estadísticas de un día"""
+    reservas_dia = [r for r in reservas_de_fechas(fecha, fecha).get(fecha, [])
+                    if r.get('estado') == 'confirmada']
+    horas_reservadas = 0
+    for reserva in reservas_dia:
+        try:
+            horas_reservadas += int(reserva.get('duracion', 0))
+        except ValueError:
+            continue
+    # Un día ya archivado se dibuja con sus propias reservas
+    ocupacion = ocupacion_de(reservas_dia) if fecha < corte_archivo() else None
+    horarios_detalle = obtener_horarios_detalle(fecha, ocupacion)
+    return {
+        'reservas': reservas_dia,
+        'horarios_detalle': horarios_detalle,
+        'horas_libres': sum(1 for h in horarios_detalle if not h['ocupado']),
+        'total_reservas': len(reservas_dia),
+        'horas_reservadas': horas_reservadas,
+        'grupos_dia': len(set(r.get('grupo', '') for r in reservas_dia)),
+        'materias_dia': len(set(r.get('materia', '') for r in reservas_dia)),
+    }
+
+def grilla_disponibilidad(fecha, ocupacion=None):
+    """Horarios de un día para la API: ocupación y duraciones que caben"""
+    ocupacion = indice_ocupacion() if ocupacion is None else ocupacion
+    horarios = []
+    for hora in range(HORA_APERTURA, HORA_CIERRE):
+        reserva = reserva_en_conflicto(ocupacion, fecha, hora, hora + 1)
+        horarios.append({
+            'hora': f"{hora:02d}:00",
+            'ocupado': reserva is not None,
+            'reserva': None if reserva is None else {
+                campo: reserva.get(campo, '') for campo in
+                ('id_reserva', 'hora_inicio', 'hora_fin', 'grupo', 'materia', 'profesor')},
+            # Duraciones permitidas que pueden empezar a esta hora
+            'duraciones': [d for d in DURACIONES_RESERVA if hora + d <= HORA_CIERRE
+                           and reserva_en_conflicto(ocupacion, fecha, hora, hora + d) is None],
+        })
+    return horarios
+
+# =============================================
+# OCUPACIÓN DEL LABORATORIO Y SERIES
+# =============================================
+# Las reservas confirmadas se indexan por fecha como intervalos de horas.
+# Comprobar una fecha es buscar en su lista, así que una serie semanal se
+# valida completa en una pasada y se guarda con una sola escritura.
+
+HORA_APERTURA = 7
+HORA_CIERRE = 19
+MAX_SESIONES_SERIE = 60
+DURACIONES_RESERVA = (1, 2)
+CAMPOS_RESERVAS = ['id_reserva', 'fecha', 'hora_inicio', 'hora_fin', 'duracion',
+                   'grupo', 'materia', 'profesor', 'num_alumnos', 'observaciones',
+                   'estado', 'fecha_registro', 'responsable']
+
+_ocupacion = {}
+_reservas_por_fecha = {}
+
+def indice_ocupacion():
+    """fecha -> [(inicio, fin, reserva)] confirmadas; se reconstruye si la tabla cambió"""
+    archivo = ruta_datos(RESERVAS_CSV)
+    filas = leer_tabla(archivo)[1]
+    en_cache = _ocupacion.get(archivo)
+    if en_cache and en_cache[0] is filas:
+        return en_cache[1]
+    indice = ocupacion_de(filas)
+    _ocupacion[archivo] = (filas, indice)
+    return indice
+
+def ocupacion_de(reservas):
+    """fecha -> [(inicio, fin, reserva)] de las reservas confirmadas indicadas"""
+    indice = {}
+    for reserva in reservas:
+        if reserva.get('estado') != 'confirmada':
+            continue
+        try:
+            inicio = int(reserva['hora_inicio'].split(':')[0])
+            fin = int(reserva['hora_fin'].split(':')[0])
+        except (KeyError, ValueError):
+            continue
+        indice.setdefault(reserva['fecha'], []).append((inicio, fin, reserva))
+    for intervalos in indice.values():
+        intervalos.sort(key=lambda x: x[0])
+    return indice
+
+def reservas_por_fecha():
+    """fecha -> reservas de ese día ordenadas por hora (todos los estados)"""
+    archivo = ruta_datos(RESERVAS_CSV)
+    filas = leer_tabla(archivo)[1]
+    en_cache = _reservas_por_fecha.get(archivo)
+    if en_cache and en_cache[0] is filas:
+        return en_cache[1]
+    indice = {}
+    for reserva in filas:
+        indice.setdefault(reserva.get('fecha', ''), []).append(reserva)
+    for reservas in indice.values():
+        reservas.sort(key=lambda r: r.get('hora_inicio', ''))
+    _reservas_por_fecha[archivo] = (filas, indice)
+    return indice
+
+def reservas_de_fechas(desde, hasta):
+    """Como reservas_por_fecha(), con las archivadas si el rango llega a fechas archivadas"""
+    por_fecha = reservas_por_fecha()
+    if desde >= corte_archivo():
+        return por_fecha
+    archivadas = {}
+    for reserva in filas_archivadas(RESERVAS_CSV, desde, hasta):
+        archivadas.setdefault(reserva.get('fecha', ''), {})[reserva.get('id_reserva')] = reserva
+    if not archivadas:
+        return por_fecha
+    combinado = dict(por_fecha)
+    for fecha, reservas in archivadas.items():
+        for reserva in por_fecha.get(fecha, ()):
+            reservas[reserva.get('id_reserva')] = reserva
+        combinado[fecha] = sorted(reservas.values(), key=lambda r: r.get('hora_inicio', ''))
+    return combinado
+
+def reserva_en_conflicto(ocupacion, fecha, inicio, fin):
+    """Reserva confirmada que se solapa con [inicio, fin) ese día, o None"""
+    for inicio_existente, fin_existente, reserva in ocupacion.get(fecha, ()):
+        if inicio < fin_existente and fin > inicio_existente:
+            return reserva
+    return None
+
+def fechas_serie(desde, hasta, dias_semana, excepciones=()):
+    """Fechas ISO entre `desde` y `hasta` en los días de la semana dados (0=lunes)
+
+    Devuelve (fechas, omitidas): las omitidas son las excepciones que caían
+    en la serie.
+    """
+    inicio = datetime.strptime(desde, '%Y-%m-%d').date()
+    fin = datetime.strptime(hasta, '%Y-%m-%d').date()
+    excepciones = set(excepciones)
+    fechas, omitidas = [], []
+    dia = inicio
+    while dia <= fin:
+        if dia.weekday() in dias_semana:
+            fecha = dia.isoformat()
+            (omitidas if fecha in excepciones else fechas).append(fecha)
+        dia += timedelta(days=1)
+    return fechas, omitidas
+
+def reservar_fechas(datos, fechas, hora_inicio, duracion, omitir_conflictos=False):
+    """Reserva el mismo horario en varias fechas con una sola escritura
+
+    Devuelve (creadas, conflictos) donde conflictos es una lista de
+    (fecha, mensaje). Si hay conflictos y no se pidió omitirlos no se
+    guarda nada. `creadas` es None si la escritura falló.
+    """
+    inicio = int(hora_inicio.split(':')[0])
+    fin = inicio + int(duracion)
+    if inicio < HORA_APERTURA or fin > HORA_CIERRE:
+        return [], [(f, "Horario fuera del rango permitido (7:00 - 19:00)") for f in fechas]
+    
+    with bloqueo_tabla(ruta_datos(RESERVAS_CSV)):
+        ocupacion = indice_ocupacion()
+        conflictos = []
+        libres = []
+        for fecha in fechas:
+            reserva = reserva_en_conflicto(ocupacion, fecha, inicio, fin)
+            if reserva:
+                conflictos.append((fecha, f"Se solapa con {reserva['grupo']} ({reserva['hora_inicio']}-{reserva['hora_fin']})"))
+            else:
+                libres.append(fecha)
+        if (conflictos and not omitir_conflictos) or not libres:
+            return [], conflictos
+        
+        ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        creadas = [dict(datos,
+                        id_reserva=generar_id(),
+                        fecha=fecha,
+                        hora_inicio=f"{inicio:02d}:00",
+                        hora_fin=f"{fin:02d}:00",
+                        duracion=str(duracion),
+                        estado='confirmada',
+                        fecha_registro=ahora,
+                        responsable=session.get('nombre', ''))
+                   for fecha in libres]
+        reservas = leer_csv(RESERVAS_CSV)
+        reservas.extend(creadas)
+        if not escribir_csv(RESERVAS_CSV, reservas, CAMPOS_RESERVAS):
+            return None, conflictos
+    return creadas, conflictos
+
+# =============================================
+# CALENDARIOS ICS
+# =============================================
+# Feeds iCalendar del laboratorio, de cada profesor y de cada grupo. El
+# texto de cada evento se guarda por reserva y solo se vuelve a generar si
+# su fila cambió; cada feed se arma una vez por versión de reservas.csv y
+# su ETag es el hash del contenido, igual en todos los workers. Las horas
+# van en la zona ICS_ZONA, descrita con un VTIMEZONE como pide RFC 5545.
+
+MAX_FEEDS_ICS = 256
+# Años que describe el VTIMEZONE; fuera de ellos rige la última regla
+ANIOS_ICS = (1970, 2100)
+FILTROS_ICS = {'laboratorio': None, 'profesor': 'profesor', 'grupo': 'grupo'}
+
+_eventos_ics = {}
+_feeds_ics = OrderedDict()
+_feeds_ics_guard = threading.Lock()
+_zonas_ics = {}
+
+def texto_ics(valor):
+    """Escapa un valor de texto según RFC 5545"""
+    return (str(valor or '').replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n'))
+
+def plegar_ics(linea):
+    """Parte una línea en trozos de 75 octetos como pide RFC 5545"""
+    datos = linea.encode('utf-8')
+    if len(datos) <= 75:
+        return linea
+    partes = []
+    while datos:
+        corte = min(len(datos), 75 if not partes else 74)
+        # No cortar a mitad de un carácter UTF-8
+        while corte < len(datos) and (datos[corte] & 0xC0) == 0x80:
+            corte -= 1
+        partes.append(datos[:corte].decode('utf-8'))
+        datos = datos[corte:]
+    return '\r\n '.join(partes)
+
+def zona_ics(zona):
+    """tzinfo de la zona de los feeds (None si no se puede cargar)"""
+    if ZoneInfo is None:
+        return None
+    try:
+        return ZoneInfo(zona)
+    except (KeyError, ValueError) as e:
+        print(f"Zona horaria {zona} no disponible para los calendarios: {e}")
+        return None
+
+def hora_ics(valor):
+    """'9:00' o '09:00' -> '090000'; None si no es una hora válida"""
+    coincide = re.fullmatch(r'(\d{1,2}):(\d{2})(?::\d{2})?', (valor or '').strip())
+    if not coincide:
+        return None
+    hora, minuto = int(coincide.group(1)), int(coincide.group(2))
+    if hora > 23 or minuto > 59:
+        return None
+    return f'{hora:02d}{minuto:02d}00'
+
+def desfase_ics(desfase):
+    """timedelta -> '+HHMM' / '-HHMM'"""
+    minutos = int(desfase.total_seconds()) // 60
+    signo = '-' if minutos < 0 else '+'
+    return f'{signo}{abs(minutos) // 60:02d}{abs(minutos) % 60:02d}'
+
+def vtimezone_ics(zona, desde, hasta):
+    """VTIMEZONE de `zona` con cada cambio de horario entre dos años"""
+    desde = min(max(desde, ANIOS_ICS[0]), ANIOS_ICS[1])
+    hasta = min(max(hasta, desde), ANIOS_ICS[1])
+    clave = (zona, desde, hasta)
+    if clave in _zonas_ics:
+        return _zonas_ics[clave]
+    tz = zona_ics(zona)
+    
+    def estado(instante):
+        local = instante.astimezone(tz)
+        return local.utcoffset(), local.dst(), local.tzname()
+    
+    # Un cambio por día como máximo: se busca día a día y luego el minuto exacto
+    instante = datetime(desde, 1, 1, tzinfo=timezone.utc)
+    fin = datetime(hasta + 1, 1, 1, tzinfo=timezone.utc)
+    actual = estado(instante)
+    cambios = [(instante, actual, actual)]
+    while instante < fin:
+        siguiente = instante + timedelta(days=1)
+        if estado(siguiente) != actual:
+            bajo, alto = 0, 24 * 60
+            while alto - bajo > 1:
+                medio = (bajo + alto) // 2
+                if estado(instante + timedelta(minutes=medio)) == actual:
+                    bajo = medio
+                else:
+                    alto = medio
+            cambio = instante + timedelta(minutes=alto)
+            cambios.append((cambio, actual, estado(cambio)))
+            actual = estado(cambio)
+        instante = siguiente
+    
+    lineas = ['BEGIN:VTIMEZONE', f'TZID:{zona}']
+    for cambio, anterior, nuevo in cambios:
+        tipo = 'DAYLIGHT' if nuevo[1] else 'STANDARD'
+        # DTSTART es la hora local en que empieza, medida con el desfase anterior
+        inicio = (cambio + anterior[0]).replace(tzinfo=None)
+        lineas += [f'BEGIN:{tipo}', f"DTSTART:{inicio.strftime('%Y%m%dT%H%M%S')}",
+                   f'TZOFFSETFROM:{desfase_ics(anterior[0])}', f'TZOFFSETTO:{desfase_ics(nuevo[0])}',
+                   f'TZNAME:{texto_ics(nuevo[2])}', f'END:{tipo}']
+    lineas.append('END:VTIMEZONE')
+    texto = ''.join(linea + '\r\n' for linea in lineas)
+    _zonas_ics[clave] = texto
+    return texto
+
+def evento_ics(reserva, zona):
+    """VEVENT de una reserva (None si su fecha u horas no son válidas)
+
+    Reutiliza el texto si la fila no cambió. Con `zona` None las horas
+    van sin zona (hora local de quien se suscribe).
+    """
+    firma = (zona,) + tuple(sorted(reserva.items()))
+    en_cache = _eventos_ics.get(reserva['id_reserva'])
+    if en_cache and en_cache[0] == firma:
+        return en_cache[1]
+    
+    inicio = hora_ics(reserva.get('hora_inicio'))
+    fin = hora_ics(reserva.get('hora_fin'))
+    try:
+        fecha = datetime.strptime(reserva.get('fecha', ''), '%Y-%m-%d').strftime('%Y%m%d')
+    except ValueError:
+        fecha = None
+    if not (fecha and inicio and fin):
+        _eventos_ics[reserva['id_reserva']] = (firma, None)
+        return None
+    
+    # DTSTAMP va en UTC; sin fecha de registro válida se usa el momento actual
+    try:
+        registro = datetime.strptime(reserva.get('fecha_registro', '')[:19], '%Y-%m-%d %H:%M:%S')
+        tz = zona_ics(zona) if zona else None
+        registro = registro.replace(tzinfo=tz) if tz else registro.astimezone()
+        registro = registro.astimezone(timezone.utc)
+    except ValueError:
+        registro = datetime.now(timezone.utc)
+    tzid = f';TZID={zona}' if zona else ''
+    lineas = [
+        'BEGIN:VEVENT',
+        f"UID:{reserva['id_reserva']}@xonilab",
+        f"DTSTAMP:{registro.strftime('%Y%m%dT%H%M%SZ')}",
+        f"DTSTART{tzid}:{fecha}T{inicio}",
+        f"DTEND{tzid}:{fecha}T{fin}",
+        f"SUMMARY:{texto_ics(reserva.get('grupo'))} - {texto_ics(reserva.get('materia'))}",
+        f"DESCRIPTION:{texto_ics('Profesor: ' + reserva.get('profesor', ''))}\\n"
+        f"{texto_ics('Alumnos: ' + reserva.get('num_alumnos', ''))}"
+        + (f"\\n{texto_ics(reserva['observaciones'])}" if reserva.get('observaciones') else ''),
+        f"LOCATION:{texto_ics(current_app.config['ICS_LABORATORIO'])}",
+        'STATUS:' + ('CANCELLED' if reserva.get('estado') == 'cancelada' else 'CONFIRMED'),
+        'END:VEVENT',
+    ]
+    texto = ''.join(plegar_ics(linea) + '\r\n' for linea in lineas)
+    _eventos_ics[reserva['id_reserva']] = (firma, texto)
+    return texto
+
+def feed_ics(tipo, valor=None):
+    """(cuerpo, etag) del feed; se regenera solo si reservas.csv cambió"""
+    archivo = ruta_datos(RESERVAS_CSV)
+    filas = leer_tabla(archivo)[1]
+    clave = (archivo, tipo, valor)
+    with _feeds_ics_guard:
+        en_cache = _feeds_ics.get(clave)
+        if en_cache and en_cache[0] is filas:
+            _feeds_ics.move_to_end(clave)
+            return en_cache[1]
+    
+    zona = current_app.config['ICS_ZONA']
+    if zona_ics(zona) is None:
+        zona = None
+    columna = FILTROS_ICS[tipo]
+    nombre = current_app.config['ICS_LABORATORIO'] + (f' - {valor}' if valor else '')
+    eventos, anios = [], set()
+    for r in filas:
+        if columna is not None and r.get(columna) != valor:
+            continue
+        evento = evento_ics(r, zona)
+        if evento:
+            eventos.append(evento)
+            anios.add(int(r['fecha'][:4]))
+    cabecera = [plegar_ics('X-WR-CALNAME:' + texto_ics(nombre))]
+    if zona:
+        cabecera.append(f'X-WR-TIMEZONE:{zona}')
+    cuerpo = (
+        'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//XONILAB//Reservas//ES\r\n'
+        'CALSCALE:GREGORIAN\r\nMETHOD:PUBLISH\r\n'
+        + ''.join(linea + '\r\n' for linea in cabecera)
+        + (vtimezone_ics(zona, min(anios), max(anios)) if zona and anios else '')
+        + ''.join(eventos) + 'END:VCALENDAR\r\n'
+    ).encode('utf-8')
+    resultado = (cuerpo, hashlib.sha1(cuerpo).hexdigest()[:32])
+    
+    # Los eventos de reservas borradas o archivadas salen de la caché; tras
+    # armar el feed completo sobran justo cuando hay más que filas
+    if len(_eventos_ics) > len(filas):
+        vigentes = {r['id_reserva'] for r in filas}
+        for id_reserva in list(_eventos_ics):
+            if id_reserva not in vigentes:
+                _eventos_ics.pop(id_reserva, None)
+    
+    with _feeds_ics_guard:
+        _feeds_ics[clave] = (filas, resultado)
+        _feeds_ics.move_to_end(clave)
+        while len(_feeds_ics) > MAX_FEEDS_ICS:
+            _feeds_ics.popitem(last=False)
+    return resultado
+
+def url_ics(tipo='laboratorio', valor=None):
+    """URL absoluta de un feed, con el token si está configurado"""
+    token = current_app.config.get('ICS_TOKEN') or None
+    if tipo == 'laboratorio':
+        return url_for('calendario_ics', token=token, _external=True)
+    return url_for('calendario_ics', tipo=tipo, valor=valor, token=token, _external=True)
+
+@rutas.context_processor
+def inject_ics():
+    return {'url_ics': url_ics}
+
+# =============================================
+# REFERENCIAS NORMALIZADAS
+# =============================================
+# En modo normalizado préstamos y deudas guardan solo claves foráneas; los
+# nombres se resuelven al leer con índices en memoria por clave primaria.
+
+_indices = {}
+
+def tabla_normalizada(archivo, campos=None):
+    """Indica si la tabla está guardada sin sus columnas derivadas"""
+    derivadas = COLUMNAS_DERIVADAS.get(os.path.basename(archivo))
+    if not derivadas:
+        return False
+    if campos is None:
+        campos = leer_tabla(ruta_datos(archivo))[0]
+    return bool(campos) and not any(c in campos for c in derivadas)
+
+def indice_por_clave(tabla):
+    """Índice clave primaria -> fila; se reconstruye solo si la tabla cambió"""
+    archivo = ruta_datos(tabla)
+    filas = leer_tabla(archivo)[1]
+    en_cache = _indices.get(archivo)
+    if en_cache and en_cache[0] is filas:
+        return en_cache[1]
+    clave = clave_tabla(archivo)
+    indice = {fila[clave]: fila for fila in filas}
+    _indices[archivo] = (filas, indice)
+    return indice
+
+def resolver_referencias(archivo, filas):
+    """Completa nombres y número de cuenta a partir de las claves foráneas"""
+    items = indice_por_clave(INVENTARIO_CSV)
+    alumnos = indice_por_clave(ALUMNOS_CSV)
+    eliminados = indice_por_clave(ELIMINADOS_CSV)
+    prestamos = indice_por_clave(PRESTAMOS_CSV) if os.path.basename(archivo) == DEUDAS_CSV else None
+    
+    for fila in filas:
+        origen = fila
+        if prestamos is not None:
+            origen = prestamos.get(fila.get('id_prestamo')) or {}
+        item = items.get(origen.get('id_item')) or eliminados.get(f"item:{origen.get('id_item')}")
+        alumno = alumnos.get(origen.get('id_alumno')) or eliminados.get(f"alumno:{origen.get('id_alumno')}")
+        fila['nombre_item'] = item['nombre'] if item else NOMBRE_ELIMINADO
+        fila['nombre_alumno'] = alumno['nombre'] if alumno else NOMBRE_ELIMINADO
+        fila['num_cuenta'] = alumno['num_cuenta'] if alumno else ''
+    return filas
+
+def guardar_eliminados(registros):
+    """Conserva nombre y cuenta de ítems o alumnos que se van a borrar"""
+    if not registros:
+        return True
+    filas = leer_csv(ELIMINADOS_CSV)
+    existentes = {f['clave'] for f in filas}
+    fecha = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    nuevos = [dict(r, fecha_eliminacion=fecha) for r in registros if r['clave'] not in existentes]
+    return not nuevos or escribir_csv(ELIMINADOS_CSV, filas + nuevos, CAMPOS_ELIMINADOS)
+
+def referencias_huerfanas(archivo, filas):
+    """Nombres copiados en filas cuyo ítem o alumno ya no existe"""
+    items = indice_por_clave(INVENTARIO_CSV)
+    alumnos = indice_por_clave(ALUMNOS_CSV)
+    prestamos = indice_por_clave(PRESTAMOS_CSV) if os.path.basename(archivo) == DEUDAS_CSV else None
+    
+    huerfanas = {}
+    for fila in filas:
+        origen = fila
+        if prestamos is not None:
+            origen = prestamos.get(fila.get('id_prestamo')) or {}
+        id_item, id_alumno = origen.get('id_item'), origen.get('id_alumno')
+        if id_item and id_item not in items and fila.get('nombre_item', NOMBRE_ELIMINADO) != NOMBRE_ELIMINADO:
+            huerfanas.setdefault(f'item:{id_item}', {'clave': f'item:{id_item}',
+                                                     'nombre': fila['nombre_item'], 'num_cuenta': ''})
+        if id_alumno and id_alumno not in alumnos and fila.get('nombre_alumno', NOMBRE_ELIMINADO) != NOMBRE_ELIMINADO:
+            huerfanas.setdefault(f'alumno:{id_alumno}', {'clave': f'alumno:{id_alumno}',
+                                                         'nombre': fila['nombre_alumno'],
+                                                         'num_cuenta': fila.get('num_cuenta', '')})
+    return list(huerfanas.values())
+
+def migrar_referencias(normalizar=True):
+    """Reescribe préstamos y deudas con (o sin) las columnas derivadas"""
+    migradas = []
+    for tabla in (PRESTAMOS_CSV, DEUDAS_CSV):
+        archivo = ruta_datos(tabla)
+        with bloqueo_tabla(archivo):
+            campos, _ = leer_tabla(archivo)
+            if not campos or tabla_normalizada(archivo, campos) == normalizar:
+                continue
+            if normalizar:
+                nuevos = [c for c in campos if c not in COLUMNAS_DERIVADAS[tabla]]
+                filas = leer_tabla(archivo)[1]
+                # Las filas de ítems o alumnos ya borrados solo tienen su copia
+                if not guardar_eliminados(referencias_huerfanas(archivo, filas)):
+                    continue
+            else:
+                nuevos = ESQUEMAS_DESNORMALIZADOS[tabla] + [c for c in campos if c not in ESQUEMAS_DESNORMALIZADOS[tabla]]
+                filas = resolver_referencias(archivo, [dict(f) for f in leer_tabla(archivo)[1]])
+            tamano = os.path.getsize(archivo) + (os.path.getsize(registro_de(archivo))
+                                                 if os.path.exists(registro_de(archivo)) else 0)
+            escribir_instantanea(archivo, [normalizar_fila(f, nuevos) for f in filas], nuevos)
+            eliminar_registro(archivo)
+            _cache_tablas.pop(archivo, None)
+            migradas.append((tabla, tamano, os.path.getsize(archivo)))
+    return migradas
+
+# =============================================
+# BÚSQUEDA POR PREFIJO
+# =============================================
+# Los formularios ya no reciben tablas completas: piden candidatos mientras
+# se escribe. Cada tabla tiene una lista ordenada de (palabra, id) y una
+# consulta es un rango bisect sobre el prefijo del término más largo.
+
+LIMITE_BUSQUEDA = 20
+LIMITE_BUSQUEDA_MAX = 50
+
+CAMPOS_BUSQUEDA = {
+    INVENTARIO_CSV: ('nombre', 'codigo', 'categoria'),
+    ALUMNOS_CSV: ('nombre', 'num_cuenta', 'email'),
+    PRESTAMOS_CSV: ('nombre_alumno', 'num_cuenta', 'nombre_item'),
+}
+
+_busquedas = {}
+
+def normalizar_texto(texto):
+    """Minúsculas y sin acentos, para comparar con lo que escribe el usuario"""
+    texto = unicodedata.normalize('NFKD', str(texto or '').lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+def indice_busqueda(tabla):
+    """(palabras, ids, palabras_por_id); se reconstruye solo si cambian sus tablas"""
+    archivo = ruta_datos(tabla)
+    filas = leer_tabla(archivo)[1]
+    fuentes = (filas,)
+    if tabla == PRESTAMOS_CSV:
+        # Los nombres de un préstamo pueden venir de inventario y alumnos
+        fuentes += (leer_tabla(ruta_datos(INVENTARIO_CSV))[1], leer_tabla(ruta_datos(ALUMNOS_CSV))[1])
+    en_cache = _busquedas.get(archivo)
+    if en_cache and all(a is b for a, b in zip(en_cache[0], fuentes)):
+        return en_cache[1]
+    if tabla == PRESTAMOS_CSV and tabla_normalizada(tabla):
+        filas = resolver_referencias(archivo, [dict(f) for f in filas])
+    
+    indice = armar_indice_busqueda(tabla, filas)
+    _busquedas[archivo] = (fuentes, indice)
+    return indice
+
+def indice_busqueda_archivo(tabla):
+    """Como indice_busqueda() pero de las filas archivadas, con un cuarto
+    elemento id -> fila; se rehace si cambian los archivos"""
+    firma = tuple((ruta, firma_tabla(ruta)) for _, ruta in particiones(tabla))
+    llave = (carpeta_archivo(), tabla)
+    en_cache = _busquedas.get(llave)
+    if en_cache and en_cache[0] == firma:
+        return en_cache[1]
+    clave = CLAVES_TABLAS[tabla]
+    # Solo las columnas que muestran los resultados
+    columnas = (clave, TABLAS_ARCHIVO[tabla], 'estado') + CAMPOS_BUSQUEDA[tabla]
+    filas = {fila[clave]: {c: fila.get(c, '') for c in columnas} for fila in filas_archivadas(tabla)}
+    indice = armar_indice_busqueda(tabla, filas.values()) + (filas,)
+    _busquedas[llave] = (firma, indice)
+    return indice
+
+def armar_indice_busqueda(tabla, filas):
+    """(palabras, ids, palabras_por_id) de las filas indicadas"""
+    clave = CLAVES_TABLAS[tabla]
+    pares = []
+    palabras_por_id = {}
+    for fila in filas:
+        texto = normalizar_texto(' '.join(fila.get(c) or '' for c in CAMPOS_BUSQUEDA[tabla]))
+        palabras = tuple(set(texto.split()))
+        palabras_por_id[fila[clave]] = palabras
+        pares.extend((palabra, fila[clave]) for palabra in palabras)
+    pares.sort()
+    return ([palabra for palabra, _ in pares], [id_ for _, id_ in pares], palabras_por_id)
+
+def buscar_prefijo(tabla, consulta, limite=LIMITE_BUSQUEDA, admitir=None, indice=None):
+    """Ids con una palabra que empieza por cada término de la consulta
+
+    `indice` permite buscar en otro índice (p. ej. el de lo archivado).
+    """
+    terminos = normalizar_texto(consulta).split()
+    if not terminos:
+        return []
+    palabras, ids, palabras_por_id = (indice or indice_busqueda(tabla))[:3]
+    
+    # El término más largo es el más selectivo: acota el rango del índice
+    principal = max(terminos, key=len)
+    resto = list(terminos)
+    resto.remove(principal)
+    inicio = bisect_left(palabras, principal)
+    fin = bisect_left(palabras, principal + '\uffff', inicio)
+    
+    encontrados = []
+    vistos = set()
+    for posicion in range(inicio, fin):
+        id_ = ids[posicion]
+        if id_ in vistos:
+            continue
+        vistos.add(id_)
+        propias = palabras_por_id[id_]
+        if not all(any(p.startswith(t) for p in propias) for t in resto):
+            continue
+        if admitir and not admitir(id_):
+            continue
+        encontrados.append(id_)
+        if len(encontrados) >= limite:
+            break
+    return encontrados
+
+def limite_busqueda():
+    """Límite de resultados pedido, acotado a LIMITE_BUSQUEDA_MAX"""
+    try:
+        limite = int(request.args.get('limite', LIMITE_BUSQUEDA))
+    except ValueError:
+        limite = LIMITE_BUSQUEDA
+    return min(max(limite, 1), LIMITE_BUSQUEDA_MAX)
+
+# =============================================
+# OPERACIONES DE PRÉSTAMO
+# =============================================
+# Alta y devolución de un préstamo, compartidas por el formulario y la
+# estación de escaneo. Los ítems, alumnos y préstamos se buscan en índices
+# en memoria en lugar de recorrer las tablas.
+
+_prestamos_activos = {}
+_alumnos_por_cuenta = {}
+
+def alumno_por_cuenta(num_cuenta):
+    """Alumno con ese número de cuenta (None si no existe)"""
+    archivo = ruta_datos(ALUMNOS_CSV)
+    filas = leer_tabla(archivo)[1]
+    en_cache = _alumnos_por_cuenta.get(archivo)
+    if not en_cache or en_cache[0] is not filas:
+        en_cache = (filas, {fila.get('num_cuenta'): fila for fila in filas})
+        _alumnos_por_cuenta[archivo] = en_cache
+    return en_cache[1].get(num_cuenta)
+
+def prestamos_activos_de_item(id_item):
+    """Ids de los préstamos activos de un ítem"""
+    archivo = ruta_datos(PRESTAMOS_CSV)
+    filas = leer_tabla(archivo)[1]
+    en_cache = _prestamos_activos.get(archivo)
+    if not en_cache or en_cache[0] is not filas:
+        por_item = {}
+        for fila in filas:
+            if fila.get('estado') == 'prestado':
+                por_item.setdefault(fila.get('id_item'), []).append(fila['id_prestamo'])
+        en_cache = (filas, por_item)
+        _prestamos_activos[archivo] = en_cache
+    return list(en_cache[1].get(id_item, ()))
+
+def registrar_prestamo(item, alumno, cantidad, fecha_devolucion, observaciones=''):
+    """Reserva stock y guarda el préstamo; devuelve (prestamo, error)
+
+    `error` es (mensaje, categoría) para flash o None si se registró.
+    """
+    # Verificar si el alumno tiene deudas pendientes
+    pendientes = estado_cuenta(alumno['num_cuenta'])['pendientes']
+    if pendientes:
+        return None, (f'El alumno tiene {pendientes} deuda(s) pendiente(s). No se puede realizar el préstamo.', 'warning')
+    
+    # Reservar stock: una línea en el libro de movimientos
+    id_prestamo = generar_id()
+    reservado, cant_disponible = registrar_movimiento(item['id_item'], 'prestamo', -cantidad, id_prestamo)
+    if not reservado:
+        return None, (f'Cantidad insuficiente. Disponible: {cant_disponible}', 'danger')
+    
+    prestamos = leer_csv(PRESTAMOS_CSV)
+    nuevo = {
+        'id_prestamo': id_prestamo,
+        'id_item': item['id_item'],
+        'nombre_item': item['nombre'],
+        'id_alumno': alumno['id_alumno'],
+        'nombre_alumno': alumno['nombre'],
+        'num_cuenta': alumno['num_cuenta'],
+        'fecha_prestamo': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'fecha_devolucion': fecha_devolucion,
+        'cantidad': str(cantidad),
+        'estado': 'prestado',
+        'observaciones': observaciones
+    }
+    prestamos.append(nuevo)
+    
+    if not escribir_csv(PRESTAMOS_CSV, prestamos, ESQUEMAS_DESNORMALIZADOS[PRESTAMOS_CSV]):
+        # Liberar la reserva del préstamo que no se guardó
+        registrar_movimiento(item['id_item'], 'devolucion', cantidad, id_prestamo,
+                             observaciones='Préstamo no registrado')
+        return None, ('Error al registrar el préstamo', 'danger')
+    return nuevo, None
+
+def cerrar_prestamo(id_prestamo):
+    """Marca el préstamo como devuelto y regresa su stock; devuelve (prestamo, error)"""
+    resultado = devolver_prestamos([id_prestamo])
+    if resultado is None:
+        return None, ('Error al guardar los cambios', 'danger')
+    _, estado, prestamo = resultado[0]
+    if estado != 'devuelto':
+        return None, ('Préstamo no encontrado o ya devuelto', 'warning')
+    return prestamo, None
+
+def devolver_prestamos(ids=(), alumnos=()):
+    """Devuelve varios préstamos con una lectura y una escritura por tabla
+
+    Se devuelven los préstamos de `ids` y todos los activos de los alumnos
+    en `alumnos` (ids de alumno). Regresa una lista (id_prestamo, estado,
+    prestamo) con estado 'devuelto', 'ya_devuelto' o 'no_encontrado', o
+    None si no se pudo guardar.
+    """
+    alumnos = set(alumnos)
+    # Bajo el bloqueo de préstamos: dos devoluciones simultáneas del
+    # mismo préstamo no pueden devolver el stock dos veces
+    with bloqueo_tabla(ruta_datos(PRESTAMOS_CSV)):
+        prestamos = leer_csv(PRESTAMOS_CSV)
+        por_id = {p['id_prestamo']: p for p in prestamos}
+        solicitados = list(dict.fromkeys(ids))
+        if alumnos:
+            solicitados += [p['id_prestamo'] for p in prestamos
+                            if p.get('id_alumno') in alumnos and p.get('estado') == 'prestado'
+                            and p['id_prestamo'] not in solicitados]
+        
+        ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        resultado = []
+        devueltos = []
+        for id_prestamo in solicitados:
+            prestamo = por_id.get(id_prestamo)
+            if prestamo is None:
+                resultado.append((id_prestamo, 'no_encontrado', None))
+            elif prestamo['estado'] != 'prestado':
+                resultado.append((id_prestamo, 'ya_devuelto', prestamo))
+            else:
+                # Marcar como devuelto
+                prestamo['estado'] = 'devuelto'
+                prestamo['fecha_devolucion'] = ahora
+                devueltos.append(prestamo)
+                resultado.append((id_prestamo, 'devuelto', prestamo))
+        
+        if devueltos and not escribir_csv(PRESTAMOS_CSV, prestamos, ESQUEMAS_DESNORMALIZADOS[PRESTAMOS_CSV]):
+            return None
+    
+    # Devolver cantidades al inventario: una escritura en el libro
+    movimientos = []
+    for prestamo in devueltos:
+        try:
+            movimientos.append((prestamo['id_item'], 'devolucion', int(prestamo.get('cantidad', 0)),
+                                prestamo['id_prestamo'], ''))
+        except ValueError:
+            continue
+    registrar_movimientos(movimientos)
+    return resultado
+
+# =============================================
+# ESTADO DE CUENTA DE ALUMNOS
+# =============================================
+# Resumen de deudas por número de cuenta (pendientes, pagadas, montos y
+# último pago). Se construye una vez por versión de deudas.csv y las
+# escrituras de este proceso lo actualizan con sus cambios, así que
+# consultar si un alumno puede pedir prestado es una búsqueda en un dict.
+# Los montos se guardan en centavos para que las sumas no acumulen error.
+
+_resumenes_deudas = {}
+
+def centavos(monto):
+    """Convierte un monto de texto a centavos (0 si no es válido)"""
+    try:
+        return int(round(float(monto or 0) * 100))
+    except ValueError:
+        return 0
+
+def cuenta_de_deuda(deuda):
+    """Número de cuenta del alumno de una deuda (también en modo normalizado)"""
+    if 'num_cuenta' in deuda:
+        return deuda['num_cuenta']
+    prestamo = fila_prestamo(deuda.get('id_prestamo')) or {}
+    alumno = indice_por_clave(ALUMNOS_CSV).get(prestamo.get('id_alumno')) or {}
+    return alumno.get('num_cuenta', '')
+
+def resumen_vacio():
+    """Resumen de una cuenta sin deudas"""
+    return {'pendientes': 0, 'centavos_pendientes': 0, 'pagadas': 0,
+            'centavos_pagados': 0, 'ultimo_pago': '', 'deudas': set()}
+
+def _sumar_deuda(resumen, deuda, signo):
+    """Suma (signo=1) o resta (signo=-1) una deuda del resumen"""
+    cuenta = cuenta_de_deuda(deuda)
+    monto = centavos(deuda.get('monto'))
+    for clave in (cuenta, None):
+        # None acumula los totales de todas las cuentas
+        if clave not in resumen:
+            resumen[clave] = resumen_vacio()
+        datos = resumen[clave]
+        if deuda.get('estado') == 'pendiente':
+            datos['pendientes'] += signo
+            datos['centavos_pendientes'] += signo * monto
+        elif deuda.get('estado') == 'pagado':
+            datos['pagadas'] += signo
+            datos['centavos_pagados'] += signo * monto
+            if signo > 0:
+                datos['ultimo_pago'] = max(datos['ultimo_pago'], deuda.get('fecha_pago', ''))
+            elif deuda.get('fecha_pago') and deuda['fecha_pago'] == datos['ultimo_pago']:
+                return False
+        if clave is not None:
+            if signo > 0:
+                datos['deudas'].add(deuda['id_deuda'])
+            else:
+                datos['deudas'].discard(deuda['id_deuda'])
+    return True
+
+def fuentes_cuentas(normalizada):
+    """Tablas de las que sale la cuenta de cada deuda en modo normalizado"""
+    if not normalizada:
+        return ()
+    return (leer_tabla(ruta_datos(ALUMNOS_CSV))[1], leer_tabla(ruta_datos(PRESTAMOS_CSV))[1])
+
+def mismas_fuentes(antes, ahora):
+    """Indica si las tablas de cuentas siguen en la versión con la que se armó el resumen"""
+    return len(antes) == len(ahora) and all(a is b for a, b in zip(antes, ahora))
+
+def resumen_deudas():
+    """num_cuenta -> resumen de deudas; la clave None tiene los totales
+
+    En modo normalizado las deudas no guardan la cuenta, así que el resumen
+    se rehace también cuando cambian alumnos o préstamos (p. ej. al
+    corregir el número de cuenta de un alumno).
+    """
+    archivo = ruta_datos(DEUDAS_CSV)
+    campos, filas = leer_tabla(archivo)
+    fuentes = fuentes_cuentas(tabla_normalizada(archivo, campos))
+    en_cache = _resumenes_deudas.get(archivo)
+    if en_cache and en_cache[0] is filas and mismas_fuentes(en_cache[2], fuentes):
+        return en_cache[1]
+    resumen = {None: resumen_vacio()}
+    for deuda in filas:
+        _sumar_deuda(resumen, deuda, 1)
+    _resumenes_deudas[archivo] = (filas, resumen, fuentes)
+    return resumen
+
+def actualizar_resumen_deudas(archivo, filas_antes, anteriores, cambios, filas_despues):
+    """Aplica al resumen los cambios escritos en deudas.csv"""
+    en_cache = _resumenes_deudas.pop(archivo, None)
+    if not en_cache or en_cache[0] is not filas_antes:
+        return
+    # Si cambió una cuenta desde que se armó, las claves ya no sirven
+    fuentes = fuentes_cuentas(bool(en_cache[2]))
+    if not mismas_fuentes(en_cache[2], fuentes):
+        return
+    # Copia lo que modifica: otras peticiones pueden estar leyendo el resumen
+    resumen = dict(en_cache[1])
+    copiadas = set()
+    
+    def copiar(deuda):
+        for clave in (cuenta_de_deuda(deuda), None):
+            if clave in resumen and clave not in copiadas:
+                resumen[clave] = dict(resumen[clave], deudas=set(resumen[clave]['deudas']))
+                copiadas.add(clave)
+    
+    for cambio in cambios:
+        pk = cambio['fila']['id_deuda'] if cambio['op'] == 'upsert' else cambio['pk']
+        # Quitar la versión anterior y sumar la nueva; si se pierde el último
+        # pago de una cuenta se reconstruye en la siguiente consulta
+        if pk in anteriores:
+            copiar(anteriores[pk])
+            if not _sumar_deuda(resumen, anteriores[pk], -1):
+                return
+        if cambio['op'] == 'upsert':
+            copiar(cambio['fila'])
+            _sumar_deuda(resumen, cambio['fila'], 1)
+    _resumenes_deudas[archivo] = (filas_despues, resumen, fuentes)
+
+def resumen_deudas_archivadas():
+    """Como resumen_deudas() pero de las deudas archivadas; se rehace si cambian los archivos"""
+    rutas = [ruta for _, ruta in particiones(DEUDAS_CSV)]
+    firma = tuple((ruta, firma_tabla(ruta)) for ruta in rutas)
+    en_cache = _resumenes_archivados.get(carpeta_archivo())
+    if en_cache and en_cache[0] == firma:
+        for ruta in rutas:
+            anotar_lectura(ruta)
+        return en_cache[1]
+    resumen = {None: resumen_vacio()}
+    for deuda in filas_archivadas(DEUDAS_CSV):
+        _sumar_deuda(resumen, deuda, 1)
+    _resumenes_archivados[carpeta_archivo()] = (firma, resumen)
+    return resumen
+
+def estado_cuenta(num_cuenta, con_archivo=False):
+    """Resumen de deudas de un alumno con los montos en pesos
+
+    Con `con_archivo` también cuenta las deudas pagadas ya archivadas.
+    """
+    datos = resumen_deudas().get(num_cuenta) or resumen_vacio()
+    archivadas = resumen_deudas_archivadas().get(num_cuenta) if con_archivo else None
+    if archivadas:
+        datos = {
+            'pendientes': datos['pendientes'] + archivadas['pendientes'],
+            'centavos_pendientes': datos['centavos_pendientes'] + archivadas['centavos_pendientes'],
+            'pagadas': datos['pagadas'] + archivadas['pagadas'],
+            'centavos_pagados': datos['centavos_pagados'] + archivadas['centavos_pagados'],
+            'ultimo_pago': max(datos['ultimo_pago'], archivadas['ultimo_pago']),
+            'deudas': datos['deudas'] | archivadas['deudas'],
+        }
+    return {
+        'pendientes': datos['pendientes'],
+        'monto_pendiente': datos['centavos_pendientes'] / 100,
+        'pagadas': datos['pagadas'],
+        'monto_pagado': datos['centavos_pagados'] / 100,
+        'ultimo_pago': datos['ultimo_pago'],
+        'deudas': sorted(datos['deudas']),
+    }
+
+# =============================================
+# EVENTOS EN VIVO
+# =============================================
+# El dashboard y el calendario reciben por Server-Sent Events los cambios
+# de préstamos, reservas, deudas y stock. Las escrituras de este proceso
+# publican su delta al momento; las de otros procesos se detectan
+# comparando cada pocos segundos la firma de las tablas. Cada cliente tiene
+# un búfer acotado: si se llena (cliente lento) se le pide recargar.
+
+TABLAS_EVENTOS = {PRESTAMOS_CSV: 'prestamos', RESERVAS_CSV: 'reservas', DEUDAS_CSV: 'deudas'}
+CAMPOS_EVENTOS = {
+    PRESTAMOS_CSV: ['id_prestamo', 'id_item', 'nombre_item', 'nombre_alumno', 'num_cuenta',
+                    'fecha_prestamo', 'fecha_devolucion', 'cantidad', 'estado'],
+    RESERVAS_CSV: ['id_reserva', 'fecha', 'hora_inicio', 'hora_fin', 'duracion', 'grupo',
+                   'materia', 'profesor', 'estado'],
+    DEUDAS_CSV: ['id_deuda', 'num_cuenta', 'nombre_alumno', 'monto', 'estado'],
+}
+EVENTOS_RECIENTES = 256
+LATIDO_EVENTOS = 15
+DURACION_CONEXION_EVENTOS = 300
+
+_canales = {}
+_vigilantes = set()
+
+class CanalEventos:
+    """Eventos de una carpeta de datos y los búferes de sus clientes"""
+    
+    def __init__(self):
+        self.condicion = threading.Condition()
+        # Los ids de evento solo valen en este proceso y esta ejecución
+        self.origen = generar_id()
+        self.ultimo = 0
+        self.recientes = deque(maxlen=EVENTOS_RECIENTES)
+        self.clientes = {}
+        self.siguiente_cliente = 0
+        # Última versión publicada de cada tabla (para detectar cambios externos)
+        self.vigilancia = threading.RLock()
+        self.vistas = {}
+        self.firmas = {}
+        self.saldos = None
+        self.tamano_libro = None
+    
+    def publicar(self, tipo, datos):
+        with self.condicion:
+            self.ultimo += 1
+            evento = (f'{self.origen}-{self.ultimo}', tipo, json.dumps(datos, ensure_ascii=False))
+            self.recientes.append((self.ultimo, evento))
+            for cliente in self.clientes.values():
+                if len(cliente['cola']) == cliente['cola'].maxlen:
+                    cliente['desbordado'] = True
+                cliente['cola'].append(evento)
+            self.condicion.notify_all()
+        metricas.sumar('xonilab_eventos_total', {'tipo': tipo})
+    
+    def suscribir(self, desde, capacidad, maximo):
+        """Registra un cliente; devuelve (clave, es_el_primero) o (None, False) si no hay lugar
+        
+        `desde` es el último id que vio el cliente; los eventos posteriores
+        que sigan en memoria se le reenvían.
+        """
+        with self.condicion:
+            if len(self.clientes) >= maximo:
+                return None, False
+            cliente = {'cola': deque(maxlen=capacidad), 'desbordado': False}
+            origen, _, numero = (desde or '').rpartition('-')
+            if origen == self.origen and numero.isdigit() and int(numero) < self.ultimo:
+                numero = int(numero)
+                pendientes = [evento for n, evento in self.recientes if n > numero]
+                # Si ya no están todos los eventos perdidos, el cliente debe recargar
+                cliente['desbordado'] = (len(pendientes) < self.ultimo - numero
+                                         or len(pendientes) > capacidad)
+                cliente['cola'].extend(pendientes)
+            self.siguiente_cliente += 1
+            self.clientes[self.siguiente_cliente] = cliente
+            return self.siguiente_cliente, len(self.clientes) == 1
+    
+    def esperar(self, clave, espera):
+        """Eventos pendientes de un cliente ([] si no hubo; None si debe recargar)"""
+        with self.condicion:
+            cliente = self.clientes.get(clave)
+            if cliente is None:
+                return None
+            if not cliente['cola'] and not cliente['desbordado']:
+                self.condicion.wait(espera)
+            eventos = list(cliente['cola'])
+            cliente['cola'].clear()
+            if cliente['desbordado']:
+                cliente['desbordado'] = False
+                metricas.sumar('xonilab_eventos_desbordes_total', {})
+                return None
+            return eventos
+    
+    def cancelar(self, clave):
+        with self.condicion:
+            self.clientes.pop(clave, None)
+
+def canal_eventos(carpeta=None):
+    """Canal de eventos de una carpeta de datos (se crea al primer uso)"""
+    carpeta = carpeta or carpeta_datos()
+    with _bloqueos_guard:
+        if carpeta not in _canales:
+            _canales[carpeta] = CanalEventos()
+        return _canales[carpeta]
+
+def canal_con_clientes(archivo):
+    """Canal de la carpeta de una tabla si tiene clientes conectados"""
+    canal = _canales.get(os.path.dirname(archivo))
+    return canal if canal is not None and canal.clientes else None
+
+def cambios_entre(archivo, antes, despues):
+    """Pares (antes, después) de las filas que difieren entre dos versiones
+
+    Las filas que desaparecieron por haberse archivado no cuentan como
+    borradas.
+    """
+    clave = clave_tabla(archivo)
+    tabla = os.path.basename(archivo)
+    previas = {fila.get(clave): fila for fila in antes}
+    pares = []
+    for fila in despues:
+        previa = previas.pop(fila.get(clave), None)
+        if previa != fila:
+            pares.append((previa, fila))
+    corte = corte_archivo()
+    pares.extend((previa, None) for previa in previas.values()
+                 if not fila_archivable(tabla, previa, corte))
+    return pares
+
+def delta_tabla(archivo, pares):
+    """Datos del evento de una tabla: filas antes/después con los campos que usan las páginas"""
+    tabla = os.path.basename(archivo)
+    campos = CAMPOS_EVENTOS[tabla]
+    filas = [dict(fila) for par in pares for fila in par if fila is not None]
+    if tabla_normalizada(archivo):
+        resolver_referencias(archivo, filas)
+    resumidas = iter([{c: fila[c] for c in campos if c in fila} for fila in filas])
+    cambios = [{'antes': next(resumidas) if antes is not None else None,
+                'despues': next(resumidas) if despues is not None else None}
+               for antes, despues in pares]
+    datos = {'cambios': cambios}
+    if tabla == RESERVAS_CSV:
+        # El calendario redibuja completos los días tocados
+        por_fecha = reservas_por_fecha()
+        fechas = {fila.get('fecha', '') for fila in filas}
+        datos['dias'] = {fecha: [{c: r.get(c, '') for c in campos} for r in por_fecha.get(fecha, [])]
+                         for fecha in sorted(fechas)}
+    return datos
+
+def publicar_cambios(archivo, filas_antes, actuales, cambios, filas_despues):
+    """Publica los cambios que escribió este proceso en una tabla con eventos"""
+    canal = canal_con_clientes(archivo)
+    if canal is None:
+        return
+    clave = clave_tabla(archivo)
+    with canal.vigilancia:
+        vista = canal.vistas.get(archivo)
+        if vista is not None and vista is not filas_antes:
+            # Otro proceso escribió desde la última publicación: se incluye su parte
+            pares = cambios_entre(archivo, vista, filas_despues)
+        else:
+            pares = []
+            for cambio in cambios:
+                if cambio['op'] == 'upsert':
+                    antes = actuales.get(cambio['fila'][clave])
+                    if antes != cambio['fila']:
+                        pares.append((antes, cambio['fila']))
+                elif cambio['pk'] in actuales:
+                    pares.append((actuales[cambio['pk']], None))
+        canal.vistas[archivo] = filas_despues
+        canal.firmas[archivo] = firma_tabla(archivo)
+        if pares:
+            canal.publicar(TABLAS_EVENTOS[os.path.basename(archivo)], delta_tabla(archivo, pares))
+
+def publicar_stock(ruta, ids):
+    """Publica el disponible de los ítems que acaban de moverse en el libro"""
+    canal = canal_con_clientes(ruta)
+    if canal is None:
+        return
+    with canal.vigilancia:
+        if canal.saldos is None:
+            return
+        cambios = []
+        for id_item in dict.fromkeys(ids):
+            cantidad = saldo_item(id_item, ruta)
+            antes = canal.saldos.get(id_item)
+            if antes != cantidad:
+                canal.saldos[id_item] = cantidad
+                cambios.append({'id_item': id_item, 'antes': antes, 'cantidad': cantidad})
+        if cambios:
+            canal.publicar('stock', {'cambios': cambios})
+
+def preparar_vigilancia(canal):
+    """Toma la versión actual de las tablas como punto de partida de los eventos"""
+    with canal.vigilancia:
+        for tabla in TABLAS_EVENTOS:
+            archivo = ruta_datos(tabla)
+            # La firma se toma antes de leer: si cambia mientras tanto se revisa otra vez
+            canal.firmas[archivo] = firma_tabla(archivo)
+            canal.vistas[archivo] = leer_tabla(archivo)[1]
+        ruta = ruta_movimientos()
+        canal.tamano_libro = os.path.getsize(ruta) if os.path.exists(ruta) else None
+        canal.saldos = saldos_stock(ruta) or {}
+
+def revisar_cambios_externos(canal):
+    """Publica los cambios que otros procesos hicieron en las tablas con eventos"""
+    with canal.vigilancia:
+        for tabla, tipo in TABLAS_EVENTOS.items():
+            archivo = ruta_datos(tabla)
+            firma = firma_tabla(archivo)
+            if firma == canal.firmas.get(archivo):
+                continue
+            filas = leer_tabla(archivo)[1]
+            pares = cambios_entre(archivo, canal.vistas.get(archivo, []), filas)
+            canal.vistas[archivo] = filas
+            canal.firmas[archivo] = firma
+            if pares:
+                canal.publicar(tipo, delta_tabla(archivo, pares))
+        
+        ruta = ruta_movimientos()
+        tamano = os.path.getsize(ruta) if os.path.exists(ruta) else None
+        if tamano == canal.tamano_libro or canal.saldos is None:
+            return
+        canal.tamano_libro = tamano
+        saldos = saldos_stock(ruta) or {}
+        cambios = [{'id_item': id_item, 'antes': canal.saldos.get(id_item), 'cantidad': cantidad}
+                   for id_item, cantidad in saldos.items() if canal.saldos.get(id_item) != cantidad]
+        canal.saldos = saldos
+        if cambios:
+            canal.publicar('stock', {'cambios': cambios})
+
+def iniciar_vigilante_eventos(app, intervalo):
+    """Inicia el hilo que busca cambios de otros procesos mientras haya clientes"""
+    carpeta = app.config['CSV_FOLDER']
+    with _bloqueos_guard:
+        if intervalo <= 0 or carpeta in _vigilantes:
+            return
+        _vigilantes.add(carpeta)
+    canal = canal_eventos(carpeta)
+    
+    def ciclo():
+        while True:
+            time.sleep(intervalo)
+            if not canal.clientes:
+                continue
             try:
-                hora_inicio = int(reserva['hora_inicio'].split(':')[0])
-                hora_fin = int(reserva['hora_fin'].split(':')[0])
-                
-                if hora_inicio <= hora < hora_fin:
-                    ocupado = True
-                    reserva_en_hora = reserva
-                    es_inicio = (hora == hora_inicio)
-                    break
-            except:
+                with app.app_context():
+                    revisar_cambios_externos(canal)
+            except Exception as e:
+                print(f"Error revisando cambios para eventos: {e}")
+    
+    threading.Thread(target=ciclo, daemon=True).start()
+
+def url_eventos():
+    """URL del flujo de eventos desde el último evento ya reflejado en la página"""
+    canal = canal_eventos()
+    return url_for('eventos', desde=f'{canal.origen}-{canal.ultimo}')
+
+@rutas.context_processor
+def inject_eventos():
+    return {'url_eventos': url_eventos}
+
+# Actualizadores llamados por escribir_csv tras registrar cambios en una tabla
+INDICES_INCREMENTALES = {
+    DEUDAS_CSV: [actualizar_resumen_deudas, publicar_cambios],
+    PRESTAMOS_CSV: [publicar_cambios],
+    RESERVAS_CSV: [publicar_cambios],
+}
+
+# =============================================
+# VENCIMIENTOS DE PRÉSTAMOS
+# =============================================
+# Índice de los préstamos activos ordenado por fecha de devolución. Las
+# fechas ISO se ordenan como texto, así que vencidos y próximos a vencer
+# son consultas por rango con bisect en lugar de recorrer todos.
+
+_vencimientos = {}
+_revisiones = set()
+
+CAMPOS_REPORTE_VENCIDOS = ['id_prestamo', 'nombre_item', 'nombre_alumno', 'num_cuenta',
+                           'fecha_prestamo', 'fecha_devolucion', 'dias_vencido', 'cantidad']
+
+def indice_vencimientos():
+    """(fechas, ids) de préstamos activos; se reconstruye solo si la tabla cambió"""
+    archivo = ruta_datos(PRESTAMOS_CSV)
+    filas = leer_tabla(archivo)[1]
+    en_cache = _vencimientos.get(archivo)
+    if en_cache and en_cache[0] is filas:
+        return en_cache[1]
+    pares = []
+    for p in filas:
+        if p.get('estado') != 'prestado':
+            continue
+        fecha = p.get('fecha_devolucion', '')[:10]
+        try:
+            datetime.strptime(fecha, '%Y-%m-%d')
+        except ValueError:
+            continue
+        pares.append((fecha, p['id_prestamo']))
+    pares.sort()
+    indice = ([fecha for fecha, _ in pares], [id_prestamo for _, id_prestamo in pares])
+    _vencimientos[archivo] = (filas, indice)
+    return indice
+
+def prestamos_por_vencimiento(desde=None, hasta=None, hoy=None):
+    """Préstamos activos con devolución entre `desde` y `hasta` (inclusive)"""
+    fechas, ids = indice_vencimientos()
+    inicio = bisect_left(fechas, desde) if desde else 0
+    fin = bisect_right(fechas, hasta) if hasta else len(fechas)
+    prestamos = indice_por_clave(PRESTAMOS_CSV)
+    resultado = [dict(prestamos[i]) for i in ids[inicio:fin] if i in prestamos]
+    if tabla_normalizada(PRESTAMOS_CSV):
+        resolver_referencias(PRESTAMOS_CSV, resultado)
+    
+    hoy = hoy or datetime.now().date()
+    for prestamo in resultado:
+        fecha = datetime.strptime(prestamo['fecha_devolucion'][:10], '%Y-%m-%d').date()
+        prestamo['dias_restantes'] = (fecha - hoy).days
+    return resultado
+
+def vencimientos(dias=3, hoy=None):
+    """Préstamos vencidos y los que vencen en los próximos `dias`"""
+    hoy = hoy or datetime.now().date()
+    return {
+        'fecha': hoy.isoformat(),
+        'vencidos': prestamos_por_vencimiento(hasta=(hoy - timedelta(days=1)).isoformat(), hoy=hoy),
+        'proximos': prestamos_por_vencimiento(hoy.isoformat(), (hoy + timedelta(days=dias)).isoformat(), hoy=hoy),
+    }
+
+def generar_reporte_vencidos(carpeta, hoy=None, solo_si_falta=False):
+    """Escribe reportes/vencidos_<fecha>.csv con los préstamos vencidos
+
+    Varios workers pueden intentarlo a la vez: se escribe bajo un bloqueo
+    entre procesos y, con `solo_si_falta`, no se rehace un reporte que
+    otro ya generó.
+    """
+    hoy = hoy or datetime.now().date()
+    os.makedirs(carpeta, exist_ok=True)
+    ruta = os.path.join(carpeta, f'vencidos_{hoy.isoformat()}.csv')
+    with bloqueo_tabla(os.path.join(carpeta, 'vencidos')):
+        if solo_si_falta and os.path.exists(ruta):
+            return ruta
+        vencidos = sorted(vencimientos(0, hoy)['vencidos'], key=lambda p: p['dias_restantes'])
+        with open(ruta + '.tmp', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=CAMPOS_REPORTE_VENCIDOS, extrasaction='ignore')
+            writer.writeheader()
+            for prestamo in vencidos:
+                writer.writerow(dict(prestamo, dias_vencido=-prestamo['dias_restantes']))
+        os.replace(ruta + '.tmp', ruta)
+    return ruta
+
+def iniciar_revision_vencidos(app, intervalo=INTERVALO_REVISION_VENCIDOS):
+    """Inicia el hilo que genera una vez al día el reporte de vencidos"""
+    carpeta = app.config['REPORTES_FOLDER']
+    with _bloqueos_guard:
+        if intervalo <= 0 or carpeta in _revisiones:
+            return
+        _revisiones.add(carpeta)
+    
+    def ciclo():
+        while True:
+            hoy = datetime.now().date()
+            if not os.path.exists(os.path.join(carpeta, f'vencidos_{hoy.isoformat()}.csv')):
+                try:
+                    with app.app_context():
+                        generar_reporte_vencidos(carpeta, hoy, solo_si_falta=True)
+                except Exception as e:
+                    print(f"Error generando reporte de vencidos: {e}")
+            time.sleep(intervalo)
+    
+    threading.Thread(target=ciclo, daemon=True).start()
+
+# =============================================
+# NOTIFICACIONES
+# =============================================
+# Los recordatorios se generan por alumno (préstamos vencidos y deudas
+# pendientes) y se guardan en una bandeja de salida (notificaciones.csv).
+# Un hilo en segundo plano o `python notificar.py` los entrega con el
+# transporte configurado, limitando envíos por minuto y reintentando con
+# espera creciente. Las peticiones web solo encolan, nunca envían.
+
+CAMPOS_NOTIFICACIONES = ['id_notificacion', 'clave', 'id_alumno', 'nombre_alumno', 'destino',
+                         'asunto', 'mensaje', 'estado', 'intentos', 'proximo_intento',
+                         'fecha_creacion', 'fecha_envio', 'error']
+INTERVALO_NOTIFICADOR = 60
+
+_entrega_guard = threading.Lock()
+_notificadores = set()
+
+def enviar_smtp(notificacion, config):
+    """Transporte SMTP (p. ej. un servidor local de pruebas)"""
+    import smtplib
+    from email.message import EmailMessage
+    
+    mensaje = EmailMessage()
+    mensaje['From'] = config['NOTIFICACIONES_REMITENTE']
+    mensaje['To'] = notificacion['destino']
+    mensaje['Subject'] = notificacion['asunto']
+    mensaje.set_content(notificacion['mensaje'])
+    host, _, puerto = config['NOTIFICACIONES_SMTP'].partition(':')
+    with smtplib.SMTP(host, int(puerto or 25), timeout=30) as servidor:
+        servidor.send_message(mensaje)
+
+def enviar_archivo(notificacion, config):
+    """Transporte de archivo: deja cada mensaje como .eml en una carpeta"""
+    from email.message import EmailMessage
+    
+    carpeta = config['NOTIFICACIONES_FOLDER']
+    os.makedirs(carpeta, exist_ok=True)
+    mensaje = EmailMessage()
+    mensaje['From'] = config['NOTIFICACIONES_REMITENTE']
+    mensaje['To'] = notificacion['destino']
+    mensaje['Subject'] = notificacion['asunto']
+    mensaje.set_content(notificacion['mensaje'])
+    ruta = os.path.join(carpeta, f"{notificacion['id_notificacion']}.eml")
+    with open(ruta + '.tmp', 'wb') as f:
+        f.write(bytes(mensaje))
+    os.replace(ruta + '.tmp', ruta)
+
+# Transportes disponibles; se pueden registrar otros con la misma firma
+TRANSPORTES = {
+    'smtp': enviar_smtp,
+    'archivo': enviar_archivo,
+}
+
+def redactar_recordatorio(alumno, vencidos, deudas):
+    """Asunto y texto del recordatorio de un alumno"""
+    lineas = [f"Hola {alumno['nombre']},", '']
+    if vencidos:
+        lineas.append('Tienes préstamos vencidos en el laboratorio:')
+        for p in vencidos:
+            lineas.append(f"  - {p['nombre_item']} (x{p['cantidad']}), debía devolverse el "
+                          f"{p['fecha_devolucion'][:10]} ({-p['dias_restantes']} día(s) de retraso)")
+        lineas.append('')
+    if deudas:
+        lineas.append('Tienes adeudos pendientes:')
+        total = 0.0
+        for d in deudas:
+            try:
+                monto = float(d['monto'] or 0)
+            except ValueError:
+                # Un monto mal capturado no detiene la bandeja; se confirma en persona
+                print(f"⚠️  Deuda {d.get('id_deuda')}: monto inválido '{d['monto']}'")
+                lineas.append(f"  - {d['nombre_item']}: {d['descripcion_dano']} (monto por confirmar)")
                 continue
-        
-        horarios.append({
-            'hora': hora_str,
-            'ocupado': ocupado,
-            'reserva': reserva_en_hora,
-            'es_inicio': es_inicio
-        })
+            total += monto
+            lineas.append(f"  - {d['nombre_item']}: {d['descripcion_dano']} (${monto:.2f})")
+        lineas.append(f"  Total: ${total:.2f}")
+        lineas.append('')
+    lineas.append('Por favor acude al laboratorio para regularizar tu situación.')
+    lineas.append('')
+    lineas.append('Laboratorio XONILAB')
     
-    return horarios
+    if vencidos and deudas:
+        asunto = 'XONILAB - Préstamos vencidos y adeudos pendientes'
+    elif vencidos:
+        asunto = 'XONILAB - Préstamos vencidos'
+    else:
+        asunto = 'XONILAB - Adeudos pendientes'
+    return asunto, '\n'.join(lineas)
+
+def encolar_recordatorios(hoy=None):
+    """Agrega a la bandeja un recordatorio por alumno con vencidos o deudas
+    
+    Cada alumno recibe a lo más uno por día (clave alumno:fecha). Devuelve
+    cuántos se encolaron y cuántos alumnos no tienen correo.
+    """
+    hoy = hoy or datetime.now().date()
+    vencidos = {}
+    for p in vencimientos(0, hoy)['vencidos']:
+        vencidos.setdefault(p['id_alumno'], []).append(p)
+    deudas = {}
+    for d in leer_csv(DEUDAS_CSV):
+        if d.get('estado') == 'pendiente':
+            deudas.setdefault(d['num_cuenta'], []).append(d)
+    
+    ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    resultado = {'encolados': 0, 'sin_correo': 0}
+    with bloqueo_tabla(ruta_datos(NOTIFICACIONES_CSV)):
+        bandeja = leer_csv(NOTIFICACIONES_CSV)
+        claves = {n['clave'] for n in bandeja}
+        for alumno in leer_csv(ALUMNOS_CSV):
+            pendientes = vencidos.get(alumno['id_alumno'], [])
+            adeudos = deudas.get(alumno['num_cuenta'], [])
+            clave = f"{alumno['id_alumno']}:{hoy.isoformat()}"
+            if (not pendientes and not adeudos) or clave in claves:
+                continue
+            if not alumno.get('email'):
+                resultado['sin_correo'] += 1
+                continue
+            asunto, mensaje = redactar_recordatorio(alumno, pendientes, adeudos)
+            bandeja.append({
+                'id_notificacion': generar_id(),
+                'clave': clave,
+                'id_alumno': alumno['id_alumno'],
+                'nombre_alumno': alumno['nombre'],
+                'destino': alumno['email'],
+                'asunto': asunto,
+                'mensaje': mensaje,
+                'estado': 'pendiente',
+                'intentos': '0',
+                'proximo_intento': ahora,
+                'fecha_creacion': ahora,
+                'fecha_envio': '',
+                'error': '',
+            })
+            resultado['encolados'] += 1
+        if resultado['encolados']:
+            escribir_csv(NOTIFICACIONES_CSV, bandeja, CAMPOS_NOTIFICACIONES)
+    return resultado
+
+def entregar_notificaciones(transporte=None, limite=None):
+    """Entrega las notificaciones pendientes con el transporte configurado
+    
+    Envía a lo más NOTIFICACIONES_POR_MINUTO espaciadas en el minuto. Los
+    fallos se reintentan con espera de 2^intentos minutos hasta
+    NOTIFICACIONES_INTENTOS; después quedan como 'fallida'. Solo un hilo o
+    proceso entrega a la vez; si otro ya lo hace devuelve None.
+    """
+    config = current_app.config
+    enviar = TRANSPORTES[transporte or config['NOTIFICACIONES_TRANSPORTE']]
+    por_minuto = max(int(config['NOTIFICACIONES_POR_MINUTO']), 1)
+    maximo_intentos = int(config['NOTIFICACIONES_INTENTOS'])
+    archivo = ruta_datos(NOTIFICACIONES_CSV)
+    
+    if not _entrega_guard.acquire(blocking=False):
+        return None
+    try:
+        with open(archivo + '.entrega', 'a') as turno:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(turno, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+            
+            ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            lote = [n for n in leer_csv(NOTIFICACIONES_CSV)
+                    if n['estado'] == 'pendiente' and n['proximo_intento'] <= ahora]
+            lote = lote[:min(limite or por_minuto, por_minuto)]
+            resultado = {'enviadas': 0, 'reintentos': 0, 'fallidas': 0}
+            
+            for n, notificacion in enumerate(lote):
+                if n:
+                    time.sleep(60.0 / por_minuto)
+                cambios = {}
+                try:
+                    enviar(notificacion, config)
+                    cambios = {'estado': 'enviada', 'error': '',
+                               'fecha_envio': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+                    resultado['enviadas'] += 1
+                except Exception as e:
+                    intentos = int(notificacion['intentos'] or 0) + 1
+                    cambios = {'intentos': str(intentos), 'error': str(e)[:200]}
+                    if intentos >= maximo_intentos:
+                        cambios['estado'] = 'fallida'
+                        resultado['fallidas'] += 1
+                    else:
+                        espera = timedelta(minutes=2 ** intentos)
+                        cambios['proximo_intento'] = (datetime.now() + espera).strftime('%Y-%m-%d %H:%M:%S')
+                        resultado['reintentos'] += 1
+                
+                # Se guarda tras cada envío para no repetirlo si el proceso se detiene
+                bandeja = leer_csv(NOTIFICACIONES_CSV)
+                for fila in bandeja:
+                    if fila['id_notificacion'] == notificacion['id_notificacion']:
+                        fila.update(cambios)
+                        break
+                escribir_csv(NOTIFICACIONES_CSV, bandeja, CAMPOS_NOTIFICACIONES)
+            return resultado
+    finally:
+        _entrega_guard.release()
+
+def iniciar_notificador(app, intervalo=INTERVALO_NOTIFICADOR):
+    """Inicia el hilo que encola los recordatorios del día y los entrega"""
+    carpeta = app.config['CSV_FOLDER']
+    with _bloqueos_guard:
+        if intervalo <= 0 or carpeta in _notificadores:
+            return
+        _notificadores.add(carpeta)
+    
+    def ciclo():
+        encolado = None
+        while True:
+            try:
+                with app.app_context():
+                    hoy = datetime.now().date()
+                    if encolado != hoy:
+                        encolar_recordatorios(hoy)
+                        encolado = hoy
+                    entregar_notificaciones()
+            except Exception as e:
+                print(f"Error en el notificador: {e}")
+            time.sleep(intervalo)
+    
+    threading.Thread(target=ciclo, daemon=True).start()
+
+# =============================================
+# VERIFICACIÓN DE CONSISTENCIA
+# =============================================
+# Revisa en una sola pasada las referencias entre tablas y el stock. Cada
+# problema indica, si es reparable, los campos a corregir en su fila.
+
+TIPOS_PROBLEMA = {
+    'stock_invalido': ('Cantidad de inventario no numérica', False),
+    'stock_negativo': ('Cantidad de inventario negativa', True),
+    'estado_stock': ('Estado del ítem no coincide con su cantidad', True),
+    'stock_descuadrado': ('Movimientos de préstamo no cuadran con los préstamos activos', True),
+    'prestamo_item_inexistente': ('Préstamo de un ítem que ya no existe', False),
+    'prestamo_alumno_inexistente': ('Préstamo de un alumno que ya no existe', False),
+    'prestamo_cantidad_invalida': ('Préstamo con cantidad inválida', False),
+    'prestamo_copia_desactualizada': ('Nombre de ítem/alumno copiado en el préstamo desactualizado', True),
+    'deuda_prestamo_inexistente': ('Deuda de un préstamo que no existe', False),
+    'deuda_copia_desactualizada': ('Datos del préstamo copiados en la deuda desactualizados', True),
+    'deuda_monto_invalido': ('Deuda con monto inválido', False),
+    'alumno_cuenta_duplicada': ('Número de cuenta repetido en alumnos', False),
+    'reserva_solapada': ('Reservas confirmadas que se solapan', False),
+}
+
+def verificar_consistencia():
+    """Revisa todas las tablas y devuelve la lista de problemas encontrados"""
+    problemas = []
+    
+    def problema(tipo, tabla, id_fila, detalle, cambios=None):
+        problemas.append({'tipo': tipo, 'tabla': tabla, 'id': id_fila,
+                          'detalle': detalle, 'cambios': cambios})
+    
+    # Inventario: índice id -> nombre y validación de stock (según el libro)
+    items = {}
+    inventario = ruta_datos(INVENTARIO_CSV)
+    for item in aplicar_saldos(inventario, [dict(i) for i in leer_tabla(inventario)[1]]):
+        items[item['id_item']] = item['nombre']
+        try:
+            cantidad = int(item.get('cantidad') or 0)
+        except ValueError:
+            problema('stock_invalido', INVENTARIO_CSV, item['id_item'], f"{item['nombre']}: '{item['cantidad']}'")
+            continue
+        if cantidad < 0:
+            problema('stock_negativo', MOVIMIENTOS_CSV, item['id_item'], f"{item['nombre']}: {cantidad}",
+                     {'tipo': 'ajuste', 'cantidad': -cantidad})
+        elif (cantidad > 0) != (item.get('estado') == 'disponible'):
+            problema('estado_stock', INVENTARIO_CSV, item['id_item'],
+                     f"{item['nombre']}: cantidad {cantidad}, estado '{item.get('estado')}'",
+                     {'estado': 'disponible' if cantidad > 0 else 'agotado'})
+    
+    # Alumnos: índice id -> (nombre, cuenta) y cuentas repetidas
+    alumnos = {}
+    cuentas = {}
+    for alumno in leer_tabla(ruta_datos(ALUMNOS_CSV))[1]:
+        alumnos[alumno['id_alumno']] = (alumno['nombre'], alumno['num_cuenta'])
+        if alumno['num_cuenta'] in cuentas:
+            problema('alumno_cuenta_duplicada', ALUMNOS_CSV, alumno['id_alumno'],
+                     f"{alumno['num_cuenta']} también en {cuentas[alumno['num_cuenta']]}")
+        cuentas.setdefault(alumno['num_cuenta'], alumno['id_alumno'])
+    
+    # Préstamos: referencias y copias de nombres
+    prestamos = {}
+    prestado = {}
+    filas_prestamos = leer_tabla(ruta_datos(PRESTAMOS_CSV))[1]
+    normalizada = tabla_normalizada(PRESTAMOS_CSV)
+    if normalizada:
+        # Los nombres se resuelven al leer, también los de filas borradas
+        filas_prestamos = resolver_referencias(PRESTAMOS_CSV, [dict(p) for p in filas_prestamos])
+    for p in filas_prestamos:
+        prestamos[p['id_prestamo']] = (p['nombre_alumno'], p['num_cuenta'], p['nombre_item'])
+        cambios = {}
+        if p['id_item'] not in items:
+            problema('prestamo_item_inexistente', PRESTAMOS_CSV, p['id_prestamo'],
+                     f"{p['nombre_item']} ({p['id_item']}), estado {p['estado']}")
+        elif p['nombre_item'] != items[p['id_item']]:
+            cambios['nombre_item'] = items[p['id_item']]
+        if p['id_alumno'] not in alumnos:
+            problema('prestamo_alumno_inexistente', PRESTAMOS_CSV, p['id_prestamo'],
+                     f"{p['nombre_alumno']} ({p['num_cuenta']}), estado {p['estado']}")
+        else:
+            nombre, cuenta = alumnos[p['id_alumno']]
+            if p['nombre_alumno'] != nombre:
+                cambios['nombre_alumno'] = nombre
+            if p['num_cuenta'] != cuenta:
+                cambios['num_cuenta'] = cuenta
+        if cambios and not normalizada:
+            problema('prestamo_copia_desactualizada', PRESTAMOS_CSV, p['id_prestamo'],
+                     ', '.join(f"{c}: '{p[c]}' → '{v}'" for c, v in cambios.items()), cambios)
+            prestamos[p['id_prestamo']] = (cambios.get('nombre_alumno', p['nombre_alumno']),
+                                           cambios.get('num_cuenta', p['num_cuenta']),
+                                           cambios.get('nombre_item', p['nombre_item']))
+        try:
+            if int(p.get('cantidad') or 0) <= 0:
+                raise ValueError
+            if p['estado'] == 'prestado':
+                prestado[p['id_item']] = prestado.get(p['id_item'], 0) + int(p['cantidad'])
+        except ValueError:
+            problema('prestamo_cantidad_invalida', PRESTAMOS_CSV, p['id_prestamo'], f"cantidad '{p['cantidad']}'")
+    
+    # Libro de stock: lo que salió y no ha vuelto debe ser lo prestado
+    for id_item, tipos in (resumen_movimientos() or {}).items():
+        if id_item not in items:
+            continue
+        fuera = -(tipos.get('prestamo', 0) + tipos.get('devolucion', 0))
+        diferencia = fuera - prestado.get(id_item, 0)
+        if diferencia:
+            problema('stock_descuadrado', MOVIMIENTOS_CSV, id_item,
+                     f"{items[id_item]}: {fuera} fuera según el libro, {prestado.get(id_item, 0)} en préstamos activos",
+                     {'tipo': 'devolucion' if diferencia > 0 else 'prestamo', 'cantidad': diferencia})
+    
+    # Deudas: referencia al préstamo y copias de sus datos
+    for d in leer_tabla(ruta_datos(DEUDAS_CSV))[1]:
+        if d['id_prestamo'] not in prestamos:
+            problema('deuda_prestamo_inexistente', DEUDAS_CSV, d['id_deuda'],
+                     f"{d.get('nombre_alumno', d['id_deuda'])} (préstamo {d['id_prestamo']})")
+        elif 'nombre_item' in d:
+            nombre, cuenta, item = prestamos[d['id_prestamo']]
+            cambios = {c: v for c, v in (('nombre_alumno', nombre), ('num_cuenta', cuenta), ('nombre_item', item))
+                       if d[c] != v}
+            if cambios:
+                problema('deuda_copia_desactualizada', DEUDAS_CSV, d['id_deuda'],
+                         ', '.join(f"{c}: '{d[c]}' → '{v}'" for c, v in cambios.items()), cambios)
+        try:
+            if float(d.get('monto') or 0) <= 0:
+                raise ValueError
+        except ValueError:
+            problema('deuda_monto_invalido', DEUDAS_CSV, d['id_deuda'], f"monto '{d['monto']}'")
+    
+    # Reservas: solapamientos entre confirmadas del mismo día
+    ocupacion = {}
+    for r in leer_tabla(ruta_datos(RESERVAS_CSV))[1]:
+        if r.get('estado') != 'confirmada':
+            continue
+        try:
+            inicio = int(r['hora_inicio'].split(':')[0])
+            fin = int(r['hora_fin'].split(':')[0])
+        except (ValueError, AttributeError):
+            continue
+        horas = ocupacion.setdefault(r['fecha'], {})
+        for hora in range(inicio, fin):
+            if hora in horas:
+                problema('reserva_solapada', RESERVAS_CSV, r['id_reserva'],
+                         f"{r['fecha']} {r['hora_inicio']}-{r['hora_fin']} {r['grupo']} choca con {horas[hora]}")
+                break
+        for hora in range(inicio, fin):
+            horas.setdefault(hora, r['id_reserva'])
+    
+    return problemas
+
+def resumir_problemas(problemas):
+    """Cuenta problemas por tipo"""
+    resumen = {}
+    for p in problemas:
+        resumen[p['tipo']] = resumen.get(p['tipo'], 0) + 1
+    return resumen
+
+def reparar_consistencia(tipos):
+    """Aplica las reparaciones de los tipos indicados con una escritura por tabla"""
+    por_tabla = {}
+    movimientos = []
+    for p in verificar_consistencia():
+        if p['tipo'] in tipos and p['cambios']:
+            if p['tabla'] == MOVIMIENTOS_CSV:
+                movimientos.append((p['id'], p['cambios']))
+            else:
+                por_tabla.setdefault(p['tabla'], {}).setdefault(p['id'], {}).update(p['cambios'])
+    
+    reparados = {}
+    # El stock se corrige agregando movimientos, nunca reescribiendo el libro
+    for id_item, cambio in movimientos:
+        registrar_movimiento(id_item, cambio['tipo'], cambio['cantidad'], 'reparacion',
+                             observaciones='Reparación de consistencia', minimo=None)
+    if movimientos:
+        reparados[MOVIMIENTOS_CSV] = len(movimientos)
+    for tabla, cambios in por_tabla.items():
+        clave = clave_tabla(tabla)
+        campos = leer_tabla(ruta_datos(tabla))[0]
+        filas = leer_csv(tabla)
+        for fila in filas:
+            if fila[clave] in cambios:
+                fila.update(cambios[fila[clave]])
+        if escribir_csv(tabla, filas, campos):
+            reparados[tabla] = len(cambios)
+    return reparados
 
 # =============================================
 # RUTAS PRINCIPALES
 # =============================================
 
-@app.route('/')
+@rutas.route('/')
 def index():
     """Página principal"""
     return redirect(url_for('login'))
 
-@app.route('/login', methods=['GET', 'POST'])
+@rutas.route('/login', methods=['GET', 'POST'])
 def login():
     """Página de login"""
     if request.method == 'POST':
@@ -489,15 +3734,16 @@ def login():
     
     return render_template('login.html')
 
-@app.route('/logout')
+@rutas.route('/logout')
 def logout():
     """Cerrar sesión"""
     session.clear()
     flash('Sesión cerrada correctamente', 'info')
     return redirect(url_for('login'))
 
-@app.route('/dashboard')
+@rutas.route('/dashboard')
 @login_required
+@pagina_cacheable
 def dashboard():
     """Dashboard principal"""
     try:
@@ -538,17 +3784,10 @@ def dashboard():
         reservas_hoy = [r for r in reservas if r['fecha'] == hoy and r.get('estado') == 'confirmada']
         reservas_hoy_count = len(reservas_hoy)
         
-        # Préstamos próximos a vencer (en 3 días)
+        # Préstamos próximos a vencer (en 3 días): consulta por rango
         hoy_date = datetime.now()
-        prestamos_proximos_vencer = []
-        for prestamo in prestamos_activos:
-            try:
-                fecha_devolucion = datetime.strptime(prestamo.get('fecha_devolucion', ''), '%Y-%m-%d')
-                dias_restantes = (fecha_devolucion - hoy_date).days
-                if 0 <= dias_restantes <= 3:
-                    prestamos_proximos_vencer.append(prestamo)
-            except:
-                continue
+        prestamos_proximos_vencer = prestamos_por_vencimiento(
+            hoy, (hoy_date + timedelta(days=3)).strftime('%Y-%m-%d'))
         
         # Últimos movimientos
         prestamos_recientes = prestamos[-5:] if len(prestamos) > 5 else prestamos
@@ -575,6 +3814,7 @@ def dashboard():
                              total_deudas=total_deudas,
                              total_monto_deudas=total_monto_deudas,
                              items_bajo_stock=items_bajo_stock[:5],
+                             total_bajo_stock=len(items_bajo_stock),
                              prestamos_recientes=prestamos_recientes,
                              prestamos_proximos_vencer=prestamos_proximos_vencer[:5],
                              reservas_hoy=reservas_hoy,
@@ -591,6 +3831,7 @@ def dashboard():
                              total_deudas=0,
                              total_monto_deudas=0,
                              items_bajo_stock=[],
+                             total_bajo_stock=0,
                              prestamos_recientes=[],
                              prestamos_proximos_vencer=[],
                              reservas_hoy=[],
@@ -598,12 +3839,165 @@ def dashboard():
                              reservas_proximas=[],
                              today=datetime.now().strftime('%Y-%m-%d'))
 
+# =============================================
+# RUTAS DE EVENTOS EN VIVO
+# =============================================
+
+def limite_clientes_eventos():
+    """Flujos /eventos simultáneos por proceso
+
+    Cada flujo ocupa un hilo del servidor mientras dura, así que con
+    SERVIDOR_HILOS conocido se deja al menos la mitad para las demás
+    peticiones.
+    """
+    limite = current_app.config['EVENTOS_CLIENTES']
+    hilos = current_app.config.get('SERVIDOR_HILOS', 0)
+    if hilos:
+        limite = min(limite, hilos // 2)
+    return limite
+
+def duracion_conexion_eventos():
+    """Segundos que dura cada conexión, por debajo del timeout del worker"""
+    timeout = current_app.config.get('SERVIDOR_TIMEOUT', 0)
+    if timeout:
+        return max(1, min(DURACION_CONEXION_EVENTOS, timeout // 2))
+    return DURACION_CONEXION_EVENTOS
+
+@rutas.route('/eventos')
+@login_required
+def eventos():
+    """Flujo Server-Sent Events con los cambios de préstamos, reservas, deudas y stock
+
+    Sin hilos libres (worker sync de gunicorn o límite alcanzado) se
+    rechaza y las páginas pasan a consultar cada cierto tiempo.
+    """
+    if not request.environ.get('wsgi.multithread'):
+        # Un flujo dejaría al proceso sin atender nada más
+        return Response(status=204)
+    canal = canal_eventos()
+    desde = request.headers.get('Last-Event-ID') or request.args.get('desde', '')
+    clave, primero = canal.suscribir(desde, current_app.config['EVENTOS_BUFFER'],
+                                     limite_clientes_eventos())
+    if clave is None:
+        return Response('retry: 30000\n\n', status=503, mimetype='text/event-stream')
+    try:
+        if primero:
+            preparar_vigilancia(canal)
+        iniciar_vigilante_eventos(current_app._get_current_object(),
+                                  current_app.config['EVENTOS_INTERVALO'])
+    except Exception:
+        canal.cancelar(clave)
+        raise
+    
+    duracion = duracion_conexion_eventos()
+    latido = min(LATIDO_EVENTOS, duracion)
+    
+    def flujo():
+        yield 'retry: 3000\n\n'
+        # Las conexiones se renuevan cada cierto tiempo; el navegador se
+        # reconecta solo y recibe lo que se publicó mientras tanto
+        limite = time.monotonic() + duracion
+        while time.monotonic() < limite:
+            eventos = canal.esperar(clave, max(0.1, min(latido, limite - time.monotonic())))
+            if eventos is None:
+                yield 'event: recargar\ndata: {}\n\n'
+                return
+            if not eventos:
+                yield ': latido\n\n'
+            for id_evento, tipo, datos in eventos:
+                yield f'id: {id_evento}\nevent: {tipo}\ndata: {datos}\n\n'
+    
+    respuesta = Response(flujo(), mimetype='text/event-stream')
+    respuesta.call_on_close(lambda: canal.cancelar(clave))
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+# =============================================
+# RUTAS DE BÚSQUEDA
+# =============================================
+
+@rutas.route('/buscar/items')
+@login_required
+def buscar_items():
+    """Ítems cuyo nombre, código o categoría empiezan con la consulta (JSON)"""
+    todos = request.args.get('todos') == '1'
+    items = indice_por_clave(INVENTARIO_CSV)
+    saldos = saldos_stock()
+    
+    def disponible(id_item):
+        if saldos is not None:
+            return saldos.get(id_item, 0)
+        try:
+            return int(items[id_item].get('cantidad', 0))
+        except ValueError:
+            return 0
+    
+    ids = buscar_prefijo(INVENTARIO_CSV, request.args.get('q', ''), limite_busqueda(),
+                         None if todos else lambda i: disponible(i) > 0)
+    return jsonify({'resultados': [{
+        'id': i,
+        'nombre': items[i].get('nombre', ''),
+        'codigo': items[i].get('codigo', ''),
+        'disponible': disponible(i),
+        'etiqueta': f"{items[i].get('nombre', '')} (Disponible: {disponible(i)})",
+    } for i in ids]})
+
+@rutas.route('/buscar/alumnos')
+@login_required
+def buscar_alumnos():
+    """Alumnos activos cuyo nombre, cuenta o email empiezan con la consulta (JSON)"""
+    todos = request.args.get('todos') == '1'
+    alumnos = indice_por_clave(ALUMNOS_CSV)
+    ids = buscar_prefijo(ALUMNOS_CSV, request.args.get('q', ''), limite_busqueda(),
+                         None if todos else lambda i: alumnos[i].get('activo') == '1')
+    return jsonify({'resultados': [{
+        'id': i,
+        'nombre': alumnos[i].get('nombre', ''),
+        'num_cuenta': alumnos[i].get('num_cuenta', ''),
+        'etiqueta': f"{alumnos[i].get('nombre', '')} - {alumnos[i].get('num_cuenta', '')}",
+    } for i in ids]})
+
+@rutas.route('/buscar/prestamos')
+@login_required
+def buscar_prestamos():
+    """Préstamos por alumno, cuenta o ítem; `estado` filtra (JSON)
+
+    Con `historial=1`, si faltan resultados se completan con préstamos
+    archivados.
+    """
+    estado = request.args.get('estado', '')
+    consulta = request.args.get('q', '')
+    limite = limite_busqueda()
+    prestamos = indice_por_clave(PRESTAMOS_CSV)
+    ids = buscar_prefijo(PRESTAMOS_CSV, consulta, limite,
+                         (lambda i: prestamos[i].get('estado') == estado) if estado else None)
+    resultado = [dict(prestamos[i]) for i in ids]
+    if tabla_normalizada(PRESTAMOS_CSV):
+        resolver_referencias(PRESTAMOS_CSV, resultado)
+    if request.args.get('historial') == '1' and len(resultado) < limite:
+        indice = indice_busqueda_archivo(PRESTAMOS_CSV)
+        archivados = indice[3]
+        ids = buscar_prefijo(PRESTAMOS_CSV, consulta, limite, lambda i: i not in prestamos and (
+            not estado or archivados[i].get('estado') == estado), indice)
+        resultado += [archivados[i] for i in ids[:limite - len(resultado)]]
+    return jsonify({'resultados': [{
+        'id': p['id_prestamo'],
+        'nombre_alumno': p.get('nombre_alumno', ''),
+        'num_cuenta': p.get('num_cuenta', ''),
+        'nombre_item': p.get('nombre_item', ''),
+        'fecha_prestamo': p.get('fecha_prestamo', ''),
+        'estado': p.get('estado', ''),
+        'etiqueta': f"{p.get('nombre_alumno', '')} - {p.get('nombre_item', '')} ({p.get('fecha_prestamo', '')[:10]})",
+    } for p in resultado]})
+
 # =============================================
 # RUTAS DE INVENTARIO
 # =============================================
 
-@app.route('/inventario')
+@rutas.route('/inventario')
 @login_required
+@pagina_cacheable
 def inventario():
     """Página de inventario"""
     items = leer_csv(INVENTARIO_CSV)
@@ -650,7 +4044,7 @@ def inventario():
                          items_agotados=items_agotados,
                          items_bajo_stock=items_bajo_stock)
 
-@app.route('/inventario/agregar', methods=['POST'])
+@rutas.route('/inventario/agregar', methods=['POST'])
 @login_required
 def agregar_item():
     """Agregar nuevo ítem"""
@@ -696,7 +4090,6 @@ def agregar_item():
         
         # Generar código QR para el ítem
         try:
-            item_url = f"http://{request.host}/inventario/item/{nuevo_item['id_item']}"
             qr_filename = generar_qr_item(nuevo_item['id_item'], codigo, nombre)
             if qr_filename:
                 nuevo_item['qr_code'] = qr_filename
@@ -708,6 +4101,7 @@ def agregar_item():
         if escribir_csv(INVENTARIO_CSV, items, 
                        ['id_item', 'codigo', 'nombre', 'categoria', 'descripcion', 
                         'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code']):
+            registrar_movimiento(nuevo_item['id_item'], 'alta', cantidad_int, minimo=None)
             flash(f'✅ Ítem "{nombre}" agregado correctamente (Código: {codigo})', 'success')
         else:
             flash('Error al guardar el ítem', 'danger')
@@ -718,11 +4112,22 @@ def agregar_item():
         flash(f'Error al agregar ítem: {str(e)}', 'danger')
         return redirect(url_for('inventario'))
 
-@app.route('/inventario/editar/<id_item>', methods=['POST'])
+@rutas.route('/inventario/editar/<id_item>', methods=['POST'])
 @login_required
 def editar_item(id_item):
     """Editar ítem existente"""
     try:
+        try:
+            cantidad = int(request.form.get('cantidad', '0').strip())
+            if cantidad < 0:
+                raise ValueError
+            # Disponible que mostraba el formulario; sin él se compara con el libro
+            mostrada = request.form.get('cantidad_mostrada', '').strip()
+            mostrada = int(mostrada) if mostrada else None
+        except ValueError:
+            flash('Cantidad inválida', 'danger')
+            return redirect(url_for('inventario'))
+        
         items = leer_csv(INVENTARIO_CSV)
         item_encontrado = False
         
@@ -731,18 +4136,15 @@ def editar_item(id_item):
                 item['nombre'] = request.form.get('nombre', '').strip()
                 item['categoria'] = request.form.get('categoria', '').strip()
                 item['descripcion'] = request.form.get('descripcion', '').strip()
-                item['cantidad'] = request.form.get('cantidad', '0').strip()
                 item['unidad'] = request.form.get('unidad', '').strip()
                 item['ubicacion'] = request.form.get('ubicacion', '').strip()
                 
-                # Actualizar estado según cantidad
-                try:
-                    if int(item['cantidad']) > 0:
-                        item['estado'] = 'disponible'
-                    else:
-                        item['estado'] = 'agotado'
-                except:
-                    item['estado'] = 'disponible'
+                # Actualizar cantidad y estado solo si el usuario cambió la cantidad
+                if mostrada is None:
+                    item['cantidad'] = str(cantidad)
+                elif cantidad != mostrada:
+                    item['cantidad'] = str(max(0, int(item['cantidad'] or 0) + cantidad - mostrada))
+                item['estado'] = 'disponible' if int(item['cantidad'] or 0) > 0 else 'agotado'
                 
                 item_encontrado = True
                 break
@@ -751,6 +4153,14 @@ def editar_item(id_item):
             if escribir_csv(INVENTARIO_CSV, items, 
                            ['id_item', 'codigo', 'nombre', 'categoria', 'descripcion', 
                             'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code']):
+                # El cambio de cantidad queda como ajuste en el libro de stock. Se
+                # ajusta lo que el usuario cambió respecto a lo que vio, así un
+                # préstamo hecho mientras el formulario estaba abierto no se revierte
+                with bloqueo_tabla(ruta_movimientos()):
+                    diferencia = cantidad - (saldo_item(id_item) if mostrada is None else mostrada)
+                    if diferencia:
+                        registrar_movimiento(id_item, 'ajuste', diferencia, minimo=None,
+                                             observaciones='Edición del ítem')
                 flash('✅ Ítem actualizado correctamente', 'success')
             else:
                 flash('Error al actualizar el ítem', 'danger')
@@ -763,7 +4173,7 @@ def editar_item(id_item):
         flash(f'Error al editar ítem: {str(e)}', 'danger')
         return redirect(url_for('inventario'))
 
-@app.route('/inventario/eliminar/<id_item>')
+@rutas.route('/inventario/eliminar/<id_item>')
 @login_required
 @admin_required
 def eliminar_item(id_item):
@@ -774,7 +4184,7 @@ def eliminar_item(id_item):
         # Eliminar archivo QR si existe
         for item in items:
             if item['id_item'] == id_item and item.get('qr_code'):
-                qr_path = os.path.join(QR_FOLDER, item['qr_code'])
+                qr_path = os.path.join(carpeta_qr(), item['qr_code'])
                 if os.path.exists(qr_path):
                     os.remove(qr_path)
                 break
@@ -782,6 +4192,12 @@ def eliminar_item(id_item):
         items_filtrados = [item for item in items if item['id_item'] != id_item]
         
         if len(items_filtrados) < len(items):
+            # Con referencias normalizadas el historial solo guarda el id
+            if tabla_normalizada(PRESTAMOS_CSV):
+                nombre = next(item['nombre'] for item in items if item['id_item'] == id_item)
+                if not guardar_eliminados([{'clave': f'item:{id_item}', 'nombre': nombre, 'num_cuenta': ''}]):
+                    flash('Error al eliminar el ítem', 'danger')
+                    return redirect(url_for('inventario'))
             if escribir_csv(INVENTARIO_CSV, items_filtrados, 
                            ['id_item', 'codigo', 'nombre', 'categoria', 'descripcion', 
                             'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code']):
@@ -797,7 +4213,7 @@ def eliminar_item(id_item):
         flash(f'Error al eliminar ítem: {str(e)}', 'danger')
         return redirect(url_for('inventario'))
 
-@app.route('/inventario/item/<id_item>')
+@rutas.route('/inventario/item/<id_item>')
 @login_required
 def ver_item(id_item):
     """Ver detalle de un ítem"""
@@ -809,22 +4225,20 @@ def ver_item(id_item):
             flash('Ítem no encontrado', 'danger')
             return redirect(url_for('inventario'))
         
-        # Obtener historial de préstamos del ítem
-        prestamos = leer_csv(PRESTAMOS_CSV)
-        historial = [p for p in prestamos if p['id_item'] == id_item]
-        historial.sort(key=lambda x: x.get('fecha_prestamo', ''), reverse=True)
+        # Historial de préstamos del ítem, incluidos los archivados
+        prestamos_item = prestamos_de_item(id_item)
+        prestamos_item.sort(key=lambda x: x.get('fecha_prestamo', ''), reverse=True)
         
-        # Generar QR para vista
-        qr_data = f"XONILAB - {item['codigo']}\n{item['nombre']}\n{item['descripcion']}\nStock: {item['cantidad']} {item['unidad']}"
-        qr_base64 = obtener_qr_base64(qr_data)
+        # Generar QR para vista (el mismo que se imprime)
+        qr_base64 = obtener_qr_base64(url_qr_item(item['id_item']))
         
-        return render_template('item_detalle.html', item=item, historial=historial, qr_base64=qr_base64)
+        return render_template('item_detalle.html', item=item, historial=prestamos_item, qr_base64=qr_base64)
     
     except Exception as e:
         flash(f'Error al cargar el ítem: {str(e)}', 'danger')
         return redirect(url_for('inventario'))
 
-@app.route('/inventario/qr/<id_item>')
+@rutas.route('/inventario/qr/<id_item>')
 @login_required
 def descargar_qr_item(id_item):
     """Descargar código QR del ítem"""
@@ -836,36 +4250,31 @@ def descargar_qr_item(id_item):
             flash('Ítem no encontrado', 'danger')
             return redirect(url_for('inventario'))
         
-        # Si ya tiene QR guardado, enviarlo
-        if item.get('qr_code'):
-            qr_path = os.path.join(QR_FOLDER, item['qr_code'])
+        # Si ya tiene el QR compacto guardado, enviarlo (los PNG anteriores
+        # con texto libre se regeneran)
+        if item.get('qr_code') == archivo_qr_item(item['id_item']):
+            qr_path = os.path.join(carpeta_qr(), item['qr_code'])
             if os.path.exists(qr_path):
                 return send_file(qr_path, as_attachment=True, download_name=f"QR_{item['codigo']}.png")
         
         # Si no tiene QR, generarlo
-        item_url = f"http://{request.host}/inventario/item/{item['id_item']}"
-        qr = qrcode.QRCode(version=1, box_size=10, border=4)
-        qr.add_data(f"XONILAB - {item['codigo']}\n{item['nombre']}\n{item_url}")
-        qr.make(fit=True)
-        
-        qr_image = qr.make_image(fill_color="black", back_color="white")
-        
-        # Guardar para futuras descargas
-        qr_filename = f"qr_{item['id_item']}.png"
-        qr_path = os.path.join(QR_FOLDER, qr_filename)
-        qr_image.save(qr_path)
+        qr_filename = generar_qr_item(item['id_item'], item['codigo'], item['nombre'])
+        if not qr_filename:
+            flash('Error al generar el código QR', 'danger')
+            return redirect(url_for('inventario'))
         
-        # Actualizar registro del item
+        # Actualizar registro del item (y quitar el PNG anterior)
+        anterior = item.get('qr_code')
+        if anterior and anterior != qr_filename and os.path.exists(os.path.join(carpeta_qr(), anterior)):
+            os.remove(os.path.join(carpeta_qr(), anterior))
         item['qr_code'] = qr_filename
         escribir_csv(INVENTARIO_CSV, items, 
                     ['id_item', 'codigo', 'nombre', 'categoria', 'descripcion', 
                      'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code'])
         
         # Enviar archivo
-        img_io = BytesIO()
-        qr_image.save(img_io, 'PNG')
-        img_io.seek(0)
-        return send_file(img_io, mimetype='image/png', as_attachment=True, download_name=f"QR_{item['codigo']}.png")
+        return send_file(os.path.join(carpeta_qr(), qr_filename), mimetype='image/png',
+                         as_attachment=True, download_name=f"QR_{item['codigo']}.png")
     
     except Exception as e:
         flash(f'Error al generar QR: {str(e)}', 'danger')
@@ -875,13 +4284,14 @@ def descargar_qr_item(id_item):
 # RUTAS DE PRÉSTAMOS
 # =============================================
 
-@app.route('/prestamos')
+@rutas.route('/prestamos')
 @login_required
+@pagina_cacheable
 def prestamos():
     """Página de préstamos"""
-    prestamos_lista = leer_csv(PRESTAMOS_CSV)
-    items = leer_csv(INVENTARIO_CSV)
-    alumnos = leer_csv(ALUMNOS_CSV)
+    # Por defecto solo lo vigente; con ?historial=1 también lo archivado
+    ver_historial = request.args.get('historial') == '1'
+    prestamos_lista = list(historial(PRESTAMOS_CSV)) if ver_historial else leer_csv(PRESTAMOS_CSV)
     
     # Filtrar por estado
     estado = request.args.get('estado', '')
@@ -905,23 +4315,17 @@ def prestamos():
     prestamos_activos = len([p for p in prestamos_lista if p.get('estado') == 'prestado'])
     prestamos_devueltos = len([p for p in prestamos_lista if p.get('estado') == 'devuelto'])
     
-    # Items disponibles (con stock > 0)
-    items_disponibles = [i for i in items if int(i.get('cantidad', 0)) > 0]
-    
-    # Alumnos activos
-    alumnos_activos = [a for a in alumnos if a.get('activo') == '1']
-    
+    # Ítems y alumnos del formulario se buscan con /buscar/items y /buscar/alumnos
     return render_template('prestamos.html',
                          prestamos=prestamos_lista,
-                         items=items_disponibles,
-                         alumnos=alumnos_activos,
                          estado=estado,
                          buscar=buscar,
+                         ver_historial=ver_historial,
                          total_prestamos=total_prestamos,
                          prestamos_activos=prestamos_activos,
                          prestamos_devueltos=prestamos_devueltos)
 
-@app.route('/prestamos/nuevo', methods=['POST'])
+@rutas.route('/prestamos/nuevo', methods=['POST'])
 @login_required
 def nuevo_prestamo():
     """Crear nuevo préstamo"""
@@ -938,83 +4342,36 @@ def nuevo_prestamo():
             return redirect(url_for('prestamos'))
         
         # Obtener información del ítem
-        items = leer_csv(INVENTARIO_CSV)
-        item = next((i for i in items if i['id_item'] == id_item), None)
+        item = indice_por_clave(INVENTARIO_CSV).get(id_item)
         
         if not item:
             flash('Ítem no encontrado', 'danger')
             return redirect(url_for('prestamos'))
         
-        # Verificar disponibilidad
+        # Validar cantidad (la disponibilidad se comprueba al reservar)
         try:
-            cant_disponible = int(item.get('cantidad', 0))
             cant_prestar = int(cantidad)
             
             if cant_prestar <= 0:
                 flash('La cantidad debe ser mayor a 0', 'danger')
                 return redirect(url_for('prestamos'))
-            
-            if cant_prestar > cant_disponible:
-                flash(f'Cantidad insuficiente. Disponible: {cant_disponible}', 'danger')
-                return redirect(url_for('prestamos'))
-            
-            # Actualizar inventario
-            item['cantidad'] = str(cant_disponible - cant_prestar)
-            if int(item['cantidad']) == 0:
-                item['estado'] = 'agotado'
-            
-            if not escribir_csv(INVENTARIO_CSV, items, 
-                               ['id_item', 'codigo', 'nombre', 'categoria', 'descripcion', 
-                                'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code']):
-                flash('Error al actualizar el inventario', 'danger')
-                return redirect(url_for('prestamos'))
         
         except ValueError:
             flash('Error en la cantidad especificada', 'danger')
             return redirect(url_for('prestamos'))
         
         # Obtener información del alumno
-        alumnos = leer_csv(ALUMNOS_CSV)
-        alumno = next((a for a in alumnos if a['id_alumno'] == id_alumno), None)
+        alumno = indice_por_clave(ALUMNOS_CSV).get(id_alumno)
         
         if not alumno:
             flash('Alumno no encontrado', 'danger')
             return redirect(url_for('prestamos'))
         
-        # Verificar si el alumno tiene deudas pendientes
-        deudas = leer_csv(DEUDAS_CSV)
-        deudas_alumno = [d for d in deudas if d['num_cuenta'] == alumno['num_cuenta'] and d['estado'] == 'pendiente']
-        
-        if deudas_alumno:
-            flash(f'El alumno tiene {len(deudas_alumno)} deuda(s) pendiente(s). No se puede realizar el préstamo.', 'warning')
-            return redirect(url_for('prestamos'))
-        
-        # Crear préstamo
-        prestamos = leer_csv(PRESTAMOS_CSV)
-        
-        nuevo_prestamo = {
-            'id_prestamo': generar_id(),
-            'id_item': id_item,
-            'nombre_item': item['nombre'],
-            'id_alumno': id_alumno,
-            'nombre_alumno': alumno['nombre'],
-            'num_cuenta': alumno['num_cuenta'],
-            'fecha_prestamo': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'fecha_devolucion': fecha_devolucion,
-            'cantidad': cantidad,
-            'estado': 'prestado',
-            'observaciones': observaciones
-        }
-        
-        prestamos.append(nuevo_prestamo)
-        
-        if escribir_csv(PRESTAMOS_CSV, prestamos,
-                       ['id_prestamo', 'id_item', 'nombre_item', 'id_alumno', 
-                        'nombre_alumno', 'num_cuenta', 'fecha_prestamo', 
-                        'fecha_devolucion', 'cantidad', 'estado', 'observaciones']):
-            flash('✅ Préstamo registrado correctamente', 'success')
+        prestamo, error = registrar_prestamo(item, alumno, cant_prestar, fecha_devolucion, observaciones)
+        if error:
+            flash(*error)
         else:
-            flash('Error al registrar el préstamo', 'danger')
+            flash('✅ Préstamo registrado correctamente', 'success')
         
         return redirect(url_for('prestamos'))
     
@@ -1022,52 +4379,16 @@ def nuevo_prestamo():
         flash(f'Error al crear préstamo: {str(e)}', 'danger')
         return redirect(url_for('prestamos'))
 
-@app.route('/prestamos/devolver/<id_prestamo>')
+@rutas.route('/prestamos/devolver/<id_prestamo>')
 @login_required
 def devolver_prestamo(id_prestamo):
     """Registrar devolución"""
     try:
-        prestamos = leer_csv(PRESTAMOS_CSV)
-        items = leer_csv(INVENTARIO_CSV)
-        devuelto = False
-        
-        for prestamo in prestamos:
-            if prestamo['id_prestamo'] == id_prestamo and prestamo['estado'] == 'prestado':
-                # Marcar como devuelto
-                prestamo['estado'] = 'devuelto'
-                prestamo['fecha_devolucion'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Devolver cantidad al inventario
-                for item in items:
-                    if item['id_item'] == prestamo['id_item']:
-                        try:
-                            cant_actual = int(item.get('cantidad', 0))
-                            cant_devuelta = int(prestamo.get('cantidad', 0))
-                            item['cantidad'] = str(cant_actual + cant_devuelta)
-                            
-                            if int(item['cantidad']) > 0:
-                                item['estado'] = 'disponible'
-                        except:
-                            pass
-                        break
-                
-                devuelto = True
-                break
-        
-        if devuelto:
-            # Guardar cambios
-            if (escribir_csv(PRESTAMOS_CSV, prestamos,
-                           ['id_prestamo', 'id_item', 'nombre_item', 'id_alumno', 
-                            'nombre_alumno', 'num_cuenta', 'fecha_prestamo', 
-                            'fecha_devolucion', 'cantidad', 'estado', 'observaciones']) and
-                escribir_csv(INVENTARIO_CSV, items, 
-                           ['id_item', 'codigo', 'nombre', 'categoria', 'descripcion', 
-                            'cantidad', 'unidad', 'ubicacion', 'estado', 'fecha_registro', 'qr_code'])):
-                flash('✅ Préstamo devuelto correctamente', 'success')
-            else:
-                flash('Error al guardar los cambios', 'danger')
+        prestamo, error = cerrar_prestamo(id_prestamo)
+        if error:
+            flash(*error)
         else:
-            flash('Préstamo no encontrado o ya devuelto', 'warning')
+            flash('✅ Préstamo devuelto correctamente', 'success')
         
         return redirect(url_for('prestamos'))
     
@@ -1075,12 +4396,179 @@ def devolver_prestamo(id_prestamo):
         flash(f'Error al devolver préstamo: {str(e)}', 'danger')
         return redirect(url_for('prestamos'))
 
+@rutas.route('/prestamos/devolver', methods=['POST'])
+@login_required
+def devolver_lote():
+    """Devolver varios préstamos: los seleccionados o los de un alumno o grupo"""
+    try:
+        ids = [i.strip() for i in request.form.getlist('prestamos') if i.strip()]
+        num_cuenta = request.form.get('num_cuenta', '').strip()
+        grupo = request.form.get('grupo', '').strip()
+        
+        alumnos = set()
+        if num_cuenta:
+            alumno = alumno_por_cuenta(num_cuenta)
+            if not alumno:
+                flash('Alumno no encontrado', 'danger')
+                return redirect(url_for('prestamos'))
+            alumnos.add(alumno['id_alumno'])
+        if grupo:
+            alumnos.update(a['id_alumno'] for a in indice_por_clave(ALUMNOS_CSV).values()
+                           if a.get('grupo') == grupo)
+        
+        if not ids and not alumnos:
+            flash('Seleccione préstamos, un alumno o un grupo', 'warning')
+            return redirect(url_for('prestamos'))
+        
+        resultado = devolver_prestamos(ids, alumnos)
+        if resultado is None:
+            flash('Error al guardar los cambios', 'danger')
+            return redirect(url_for('prestamos'))
+        
+        filas = [dict(prestamo or {}, id_prestamo=id_prestamo, resultado=estado)
+                 for id_prestamo, estado, prestamo in resultado]
+        if tabla_normalizada(PRESTAMOS_CSV):
+            resolver_referencias(PRESTAMOS_CSV, [f for f in filas if f.get('id_item')])
+        devueltos = sum(1 for f in filas if f['resultado'] == 'devuelto')
+        
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'devueltos': devueltos, 'resultados': [
+                {'id': f['id_prestamo'], 'resultado': f['resultado']} for f in filas]})
+        
+        if devueltos:
+            flash(f'✅ {devueltos} préstamo(s) devuelto(s)', 'success')
+        if devueltos < len(filas):
+            flash(f'{len(filas) - devueltos} préstamo(s) no se devolvieron', 'warning')
+        elif not filas:
+            flash('No hay préstamos activos para devolver', 'warning')
+        return render_template('devolucion_lote.html', resultados=filas, devueltos=devueltos,
+                               num_cuenta=num_cuenta, grupo=grupo)
+    
+    except Exception as e:
+        flash(f'Error al devolver préstamos: {str(e)}', 'danger')
+        return redirect(url_for('prestamos'))
+
+@rutas.route('/prestamos/vencimientos')
+@login_required
+def vencimientos_prestamos():
+    """Préstamos vencidos y próximos a vencer (JSON)"""
+    try:
+        dias = min(max(int(request.args.get('dias', 3)), 0), 60)
+    except ValueError:
+        dias = 3
+    resultado = vencimientos(dias)
+    return jsonify({
+        'fecha': resultado['fecha'],
+        'dias': dias,
+        'vencidos': resultado['vencidos'],
+        'proximos': resultado['proximos'],
+    })
+
+@rutas.route('/prestamos/vencidos/reporte')
+@login_required
+def reporte_vencidos():
+    """Descargar el reporte de préstamos vencidos del día"""
+    try:
+        carpeta = current_app.config['REPORTES_FOLDER']
+        ruta = generar_reporte_vencidos(carpeta, solo_si_falta=not request.args.get('actualizar'))
+        return send_file(ruta, mimetype='text/csv', as_attachment=True,
+                         download_name=os.path.basename(ruta))
+    except Exception as e:
+        flash(f'Error generando el reporte de vencidos: {str(e)}', 'danger')
+        return redirect(url_for('prestamos'))
+
+# =============================================
+# ESTACIÓN DE ESCANEO
+# =============================================
+
+@rutas.route('/i/<id_item>')
+@rutas.route('/item/<id_item>')
+@login_required
+def escanear_item(id_item):
+    """Destino de los QR de ítems: abre la estación de escaneo con el ítem"""
+    return redirect(url_for('escaner', item=id_item))
+
+@rutas.route('/escaner')
+@login_required
+def escaner():
+    """Estación de escaneo para préstamos y devoluciones en mostrador"""
+    return render_template('escaner.html', item=request.args.get('item', ''))
+
+@rutas.route('/escaner/registrar', methods=['POST'])
+@login_required
+def escaner_registrar():
+    """Presta o devuelve un ítem escaneado en una sola petición (JSON)
+    
+    Con `num_cuenta`, devuelve el préstamo activo del alumno para ese ítem
+    o, si no tiene, registra uno nuevo. Sin cuenta solo identifica el ítem,
+    salvo con accion=devolver, que devuelve su préstamo activo cuando es el
+    único. `accion` (prestar/devolver) fuerza una de las dos operaciones.
+    """
+    datos = request.get_json(silent=True) or request.form
+    id_item = str(datos.get('item', '')).strip().rstrip('/').rsplit('/', 1)[-1]
+    num_cuenta = str(datos.get('num_cuenta', '')).strip()
+    accion = str(datos.get('accion', '')).strip()
+    
+    def respuesta(resultado, mensaje, codigo=200, **extra):
+        return jsonify(dict(resultado=resultado, mensaje=mensaje, **extra)), codigo
+    
+    item = indice_por_clave(INVENTARIO_CSV).get(id_item)
+    if not item:
+        return respuesta('error', 'Ítem no encontrado', 404)
+    resumen_item = {'id': id_item, 'nombre': item['nombre'], 'codigo': item['codigo']}
+    
+    prestamos = indice_por_clave(PRESTAMOS_CSV)
+    activos = [prestamos[i] for i in prestamos_activos_de_item(id_item) if i in prestamos]
+    
+    alumno = None
+    if num_cuenta:
+        alumno = alumno_por_cuenta(num_cuenta)
+        if not alumno:
+            return respuesta('error', 'Alumno no encontrado', 404, item=resumen_item)
+        activos = [p for p in activos if p.get('id_alumno') == alumno['id_alumno']]
+    
+    # Devolución: el préstamo activo del alumno, o el único del ítem solo si
+    # se pidió devolver (quien escanea el ítem para llevárselo aún no se identificó)
+    if (alumno or accion == 'devolver') and accion != 'prestar' and len(activos) == 1:
+        prestamo, error = cerrar_prestamo(activos[0]['id_prestamo'])
+        if error:
+            return respuesta('error', error[0], 409, item=resumen_item)
+        resumen_item['disponible'] = saldo_item(id_item)
+        return respuesta('devuelto', f"✅ {item['nombre']} devuelto", item=resumen_item,
+                         prestamo={'id': prestamo['id_prestamo'], 'num_cuenta': num_cuenta or prestamo.get('num_cuenta', '')})
+    
+    if accion == 'devolver' and not activos:
+        return respuesta('error', 'No hay préstamo activo para devolver', 404, item=resumen_item)
+    if alumno and activos and accion != 'prestar':
+        return respuesta('error', 'El alumno tiene varios préstamos activos de este ítem', 409, item=resumen_item)
+    if not alumno:
+        # Falta el alumno para decidir qué préstamo se devuelve o a quién se presta
+        resumen_item['disponible'] = saldo_item(id_item)
+        return respuesta('identificado', 'Escanee o escriba el número de cuenta del alumno',
+                         item=resumen_item, activos=len(activos))
+    
+    # Préstamo nuevo
+    try:
+        cantidad = int(datos.get('cantidad', 1))
+    except (TypeError, ValueError):
+        cantidad = 0
+    if cantidad <= 0:
+        return respuesta('error', 'La cantidad debe ser mayor a 0', 400, item=resumen_item)
+    fecha_devolucion = (datetime.now() + timedelta(days=current_app.config['DIAS_PRESTAMO_ESCANEO'])).strftime('%Y-%m-%d')
+    prestamo, error = registrar_prestamo(item, alumno, cantidad, fecha_devolucion, 'Estación de escaneo')
+    if error:
+        return respuesta('error', error[0], 409, item=resumen_item)
+    resumen_item['disponible'] = saldo_item(id_item)
+    return respuesta('prestado', f"✅ {item['nombre']} prestado a {alumno['nombre']} hasta {fecha_devolucion}",
+                     item=resumen_item, prestamo={'id': prestamo['id_prestamo'], 'num_cuenta': num_cuenta})
+
 # =============================================
 # RUTAS DE ALUMNOS
 # =============================================
 
-@app.route('/alumnos')
+@rutas.route('/alumnos')
 @login_required
+@pagina_cacheable
 def alumnos():
     """Página de alumnos"""
     alumnos_lista = leer_csv(ALUMNOS_CSV)
@@ -1114,19 +4602,18 @@ def alumnos():
     alumnos_activos = len([a for a in alumnos_lista if a.get('activo') == '1'])
     alumnos_inactivos = total_alumnos - alumnos_activos
     
-    # Obtener préstamos y deudas para estadísticas
-    prestamos = leer_csv(PRESTAMOS_CSV)
-    deudas = leer_csv(DEUDAS_CSV)
+    # Préstamos activos por cuenta en una pasada; deudas desde el resumen
+    prestamos_activos = {}
+    for p in leer_csv(PRESTAMOS_CSV):
+        if p.get('estado') == 'prestado':
+            prestamos_activos[p.get('num_cuenta')] = prestamos_activos.get(p.get('num_cuenta'), 0) + 1
+    deudas = resumen_deudas()
     
     # Agregar estadísticas a cada alumno
     for alumno in alumnos_lista:
         num_cuenta = alumno.get('num_cuenta', '')
-        # Contar préstamos activos
-        prestamos_alumno = [p for p in prestamos if p.get('num_cuenta') == num_cuenta and p.get('estado') == 'prestado']
-        alumno['prestamos_activos'] = len(prestamos_alumno)
-        # Contar deudas pendientes
-        deudas_alumno = [d for d in deudas if d.get('num_cuenta') == num_cuenta and d.get('estado') == 'pendiente']
-        alumno['deudas_pendientes'] = len(deudas_alumno)
+        alumno['prestamos_activos'] = prestamos_activos.get(num_cuenta, 0)
+        alumno['deudas_pendientes'] = deudas[num_cuenta]['pendientes'] if num_cuenta in deudas else 0
     
     return render_template('alumnos.html', 
                          alumnos=alumnos_lista, 
@@ -1138,7 +4625,37 @@ def alumnos():
                          alumnos_activos=alumnos_activos,
                          alumnos_inactivos=alumnos_inactivos)
 
-@app.route('/alumnos/agregar', methods=['POST'])
+@rutas.route('/alumnos/<id_alumno>/estado-cuenta')
+@login_required
+@pagina_cacheable
+def estado_cuenta_alumno(id_alumno):
+    """Estado de cuenta de un alumno: deudas y préstamos"""
+    alumno = indice_por_clave(ALUMNOS_CSV).get(id_alumno)
+    if not alumno:
+        flash('Alumno no encontrado', 'danger')
+        return redirect(url_for('alumnos'))
+    
+    cuenta = estado_cuenta(alumno['num_cuenta'], con_archivo=True)
+    deudas = indice_por_clave(DEUDAS_CSV)
+    deudas_alumno = [dict(deudas[i]) for i in cuenta['deudas'] if i in deudas]
+    if tabla_normalizada(DEUDAS_CSV):
+        resolver_referencias(DEUDAS_CSV, deudas_alumno)
+    # Las pagadas que ya se archivaron se leen de sus archivos
+    archivadas = set(cuenta['deudas']) - set(deudas)
+    if archivadas:
+        deudas_alumno.extend(d for d in filas_archivadas(DEUDAS_CSV) if d['id_deuda'] in archivadas)
+    deudas_alumno.sort(key=lambda d: d.get('fecha_deuda', ''), reverse=True)
+    
+    prestamos_alumno = [p for p in historial(PRESTAMOS_CSV) if p.get('id_alumno') == id_alumno]
+    prestamos_alumno.sort(key=lambda p: p.get('fecha_prestamo', ''), reverse=True)
+    
+    return render_template('estado_cuenta.html',
+                           alumno=alumno,
+                           cuenta=cuenta,
+                           deudas=deudas_alumno,
+                           prestamos=prestamos_alumno)
+
+@rutas.route('/alumnos/agregar', methods=['POST'])
 @login_required
 def agregar_alumno():
     """Agregar nuevo alumno"""
@@ -1185,7 +4702,7 @@ def agregar_alumno():
         flash(f'Error al agregar alumno: {str(e)}', 'danger')
         return redirect(url_for('alumnos'))
 
-@app.route('/alumnos/editar/<id_alumno>', methods=['POST'])
+@rutas.route('/alumnos/editar/<id_alumno>', methods=['POST'])
 @login_required
 def editar_alumno(id_alumno):
     """Editar alumno"""
@@ -1220,7 +4737,7 @@ def editar_alumno(id_alumno):
         flash(f'Error al editar alumno: {str(e)}', 'danger')
         return redirect(url_for('alumnos'))
 
-@app.route('/alumnos/eliminar/<id_alumno>')
+@rutas.route('/alumnos/eliminar/<id_alumno>')
 @login_required
 @admin_required
 def eliminar_alumno(id_alumno):
@@ -1241,6 +4758,13 @@ def eliminar_alumno(id_alumno):
                 if prestamos_activos:
                     flash('No se puede eliminar el alumno porque tiene préstamos activos', 'warning')
                     return redirect(url_for('alumnos'))
+                
+                # Con referencias normalizadas el historial solo guarda el id
+                if tabla_normalizada(PRESTAMOS_CSV) and not guardar_eliminados([{
+                        'clave': f'alumno:{id_alumno}', 'nombre': alumno_eliminar['nombre'],
+                        'num_cuenta': num_cuenta}]):
+                    flash('Error al eliminar el alumno', 'danger')
+                    return redirect(url_for('alumnos'))
             
             if escribir_csv(ALUMNOS_CSV, alumnos_filtrados,
                            ['id_alumno', 'nombre', 'num_cuenta', 'grupo', 'semestre', 'telefono', 'email', 'activo']):
@@ -1260,12 +4784,14 @@ def eliminar_alumno(id_alumno):
 # RUTAS DE DEUDAS
 # =============================================
 
-@app.route('/deudas')
+@rutas.route('/deudas')
 @login_required
+@pagina_cacheable
 def deudas():
     """Página de deudas por daños en préstamos"""
-    deudas_lista = leer_csv(DEUDAS_CSV)
-    prestamos = leer_csv(PRESTAMOS_CSV)
+    # Por defecto solo lo vigente; con ?historial=1 también lo archivado
+    ver_historial = request.args.get('historial') == '1'
+    deudas_lista = list(historial(DEUDAS_CSV)) if ver_historial else leer_csv(DEUDAS_CSV)
     
     # Filtrar por estado
     estado = request.args.get('estado', '')
@@ -1284,21 +4810,29 @@ def deudas():
     # Ordenar por fecha
     deudas_lista.sort(key=lambda x: x.get('fecha_deuda', ''), reverse=True)
     
-    # Estadísticas
+    # Estadísticas: sin filtros salen del resumen mantenido; con filtros o
+    # con historial, de una sola pasada sobre las deudas mostradas
     total_deudas = len(deudas_lista)
-    deudas_pendientes = len([d for d in deudas_lista if d.get('estado') == 'pendiente'])
-    deudas_pagadas = len([d for d in deudas_lista if d.get('estado') == 'pagado'])
+    if estado or buscar or ver_historial:
+        totales = {None: resumen_vacio()}
+        for d in deudas_lista:
+            _sumar_deuda(totales, d, 1)
+        totales = totales[None]
+    else:
+        totales = resumen_deudas()[None]
+    deudas_pendientes = totales['pendientes']
+    deudas_pagadas = totales['pagadas']
     
     # Calcular montos
-    total_monto = sum(float(d.get('monto', 0)) for d in deudas_lista)
-    monto_pendiente = sum(float(d.get('monto', 0)) for d in deudas_lista if d.get('estado') == 'pendiente')
-    monto_pagado = sum(float(d.get('monto', 0)) for d in deudas_lista if d.get('estado') == 'pagado')
+    total_monto = sum(centavos(d.get('monto')) for d in deudas_lista) / 100
+    monto_pendiente = totales['centavos_pendientes'] / 100
+    monto_pagado = totales['centavos_pagados'] / 100
     
     return render_template('deudas.html',
                          deudas=deudas_lista,
-                         prestamos=prestamos,
                          estado=estado,
                          buscar=buscar,
+                         ver_historial=ver_historial,
                          total_deudas=total_deudas,
                          deudas_pendientes=deudas_pendientes,
                          deudas_pagadas=deudas_pagadas,
@@ -1306,7 +4840,7 @@ def deudas():
                          monto_pendiente=monto_pendiente,
                          monto_pagado=monto_pagado)
 
-@app.route('/deudas/nueva', methods=['POST'])
+@rutas.route('/deudas/nueva', methods=['POST'])
 @login_required
 def nueva_deuda():
     """Registrar nueva deuda por daño"""
@@ -1330,40 +4864,49 @@ def nueva_deuda():
             flash('Monto inválido', 'danger')
             return redirect(url_for('deudas'))
         
-        # Obtener información del préstamo
-        prestamos = leer_csv(PRESTAMOS_CSV)
-        prestamo = next((p for p in prestamos if p['id_prestamo'] == id_prestamo), None)
+        # Obtener información del préstamo (solo su fila), también si ya se archivó
+        prestamo = prestamo_por_id(id_prestamo, con_archivo=True)
         
         if not prestamo:
             flash('Préstamo no encontrado', 'danger')
             return redirect(url_for('deudas'))
         
-        # Crear deuda
-        deudas = leer_csv(DEUDAS_CSV)
-        
-        nueva_deuda = {
-            'id_deuda': generar_id(),
-            'id_prestamo': id_prestamo,
-            'nombre_alumno': prestamo['nombre_alumno'],
-            'num_cuenta': prestamo['num_cuenta'],
-            'nombre_item': prestamo['nombre_item'],
-            'descripcion_dano': descripcion_dano,
-            'monto': monto,
-            'estado': 'pendiente',
-            'fecha_deuda': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'fecha_pago': '',
-            'observaciones': observaciones
-        }
-        
-        deudas.append(nueva_deuda)
-        
-        if escribir_csv(DEUDAS_CSV, deudas,
-                       ['id_deuda', 'id_prestamo', 'nombre_alumno', 'num_cuenta', 
-                        'nombre_item', 'descripcion_dano', 'monto', 'estado', 
-                        'fecha_deuda', 'fecha_pago', 'observaciones']):
-            flash('✅ Deuda registrada correctamente', 'success')
-        else:
-            flash('Error al registrar la deuda', 'danger')
+        with bloqueo_tabla(ruta_datos(PRESTAMOS_CSV)):
+            # Un préstamo archivado vuelve a la tabla vigente, donde las deudas
+            # lo buscan y el archivador lo conserva mientras tenga deuda
+            if prestamo.get('archivado'):
+                prestamos = leer_csv(PRESTAMOS_CSV)
+                prestamos.append(prestamo)
+                if not escribir_csv(PRESTAMOS_CSV, prestamos, ESQUEMAS_DESNORMALIZADOS[PRESTAMOS_CSV]):
+                    flash('Error al registrar la deuda', 'danger')
+                    return redirect(url_for('deudas'))
+            
+            # Crear deuda
+            deudas = leer_csv(DEUDAS_CSV)
+            
+            nueva_deuda = {
+                'id_deuda': generar_id(),
+                'id_prestamo': id_prestamo,
+                'nombre_alumno': prestamo['nombre_alumno'],
+                'num_cuenta': prestamo['num_cuenta'],
+                'nombre_item': prestamo['nombre_item'],
+                'descripcion_dano': descripcion_dano,
+                'monto': monto,
+                'estado': 'pendiente',
+                'fecha_deuda': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'fecha_pago': '',
+                'observaciones': observaciones
+            }
+            
+            deudas.append(nueva_deuda)
+            
+            if escribir_csv(DEUDAS_CSV, deudas,
+                           ['id_deuda', 'id_prestamo', 'nombre_alumno', 'num_cuenta', 
+                            'nombre_item', 'descripcion_dano', 'monto', 'estado', 
+                            'fecha_deuda', 'fecha_pago', 'observaciones']):
+                flash('✅ Deuda registrada correctamente', 'success')
+            else:
+                flash('Error al registrar la deuda', 'danger')
         
         return redirect(url_for('deudas'))
     
@@ -1371,7 +4914,7 @@ def nueva_deuda():
         flash(f'Error al registrar deuda: {str(e)}', 'danger')
         return redirect(url_for('deudas'))
 
-@app.route('/deudas/pagar/<id_deuda>')
+@rutas.route('/deudas/pagar/<id_deuda>')
 @login_required
 def pagar_deuda(id_deuda):
     """Marcar deuda como pagada"""
@@ -1403,7 +4946,7 @@ def pagar_deuda(id_deuda):
         flash(f'Error al pagar deuda: {str(e)}', 'danger')
         return redirect(url_for('deudas'))
 
-@app.route('/deudas/eliminar/<id_deuda>')
+@rutas.route('/deudas/eliminar/<id_deuda>')
 @login_required
 @admin_required
 def eliminar_deuda(id_deuda):
@@ -1433,8 +4976,9 @@ def eliminar_deuda(id_deuda):
 # RUTAS DE CALENDARIO MEJORADO
 # =============================================
 
-@app.route('/calendario')
+@rutas.route('/calendario')
 @login_required
+@pagina_cacheable
 def calendario():
     """Calendario de sesiones de prácticas"""
     try:
@@ -1449,37 +4993,9 @@ def calendario():
         if month < 1 or month > 12:
             month = now.month
         
-        # Generar estructura del calendario
+        # Generar estructura del calendario (con reservas y estadísticas por día)
         calendario_data = generar_calendario_mes(year, month)
         
-        # Obtener estadísticas adicionales
-        reservas_mes = calendario_data['reservas_mes']
-        
-        # Calcular horas totales reservadas
-        horas_totales = 0
-        grupos_unicos = set()
-        profesores_unicos = set()
-        
-        for reserva in reservas_mes:
-            try:
-                horas_totales += int(reserva.get('duracion', 0))
-                grupos_unicos.add(reserva.get('grupo', ''))
-                profesores_unicos.add(reserva.get('profesor', ''))
-            except:
-                continue
-        
-        # Días con reservas
-        dias_con_reservas = len(set(r['fecha'] for r in reservas_mes))
-        
-        # Agregar estadísticas a calendario_data
-        calendario_data.update({
-            'horas_totales': horas_totales,
-            'grupos_unicos': len(grupos_unicos),
-            'profesores_unicos': len(profesores_unicos),
-            'dias_con_reservas': dias_con_reservas,
-            'reservas_por_dia': round(len(reservas_mes) / max(1, calendario_data['dias_laborables']), 1) if calendario_data['dias_laborables'] > 0 else 0
-        })
-        
         return render_template('calendario.html', **calendario_data)
     
     except Exception as e:
@@ -1489,43 +5005,26 @@ def calendario():
         calendario_data = generar_calendario_mes(now.year, now.month)
         return render_template('calendario.html', **calendario_data)
 
-@app.route('/calendario/dia/<fecha>')
+@rutas.route('/calendario/dia/<fecha>')
 @login_required
+@pagina_cacheable
 def calendario_dia(fecha):
     """Ver reservas de un día específico"""
     try:
         # Validar fecha
         fecha_obj = datetime.strptime(fecha, '%Y-%m-%d')
         
-        # Obtener reservas del día
-        reservas = leer_csv(RESERVAS_CSV)
-        reservas_dia = [r for r in reservas if r['fecha'] == fecha and r.get('estado') == 'confirmada']
-        
-        # Ordenar reservas por hora de inicio
-        reservas_dia.sort(key=lambda x: x.get('hora_inicio', ''))
-        
-        # Generar información detallada de horarios
-        horarios_detalle = obtener_horarios_detalle(fecha)
+        # Reservas, horarios y estadísticas del día desde los índices
+        dia = datos_dia(fecha)
         
         # Obtener horarios disponibles para nueva reserva
         horarios_disponibles = obtener_horarios_disponibles(fecha)
         
-        # Calcular estadísticas del día
-        total_reservas = len(reservas_dia)
-        horas_reservadas = sum(int(r.get('duracion', 0)) for r in reservas_dia)
-        grupos_dia = set(r.get('grupo', '') for r in reservas_dia)
-        materias_dia = set(r.get('materia', '') for r in reservas_dia)
-        
         return render_template('calendario_dia.html',
                              fecha=fecha,
                              fecha_obj=fecha_obj,
-                             reservas=reservas_dia,
-                             horarios_detalle=horarios_detalle,
                              horarios_disponibles=horarios_disponibles,
-                             total_reservas=total_reservas,
-                             horas_reservadas=horas_reservadas,
-                             grupos_dia=len(grupos_dia),
-                             materias_dia=len(materias_dia))
+                             **dia)
     
     except ValueError:
         flash('Fecha inválida', 'danger')
@@ -1534,86 +5033,87 @@ def calendario_dia(fecha):
         flash(f'Error cargando el día: {str(e)}', 'danger')
         return redirect(url_for('calendario'))
 
-@app.route('/calendario/reservar', methods=['POST'])
+def validar_reserva(formulario):
+    """Valida los campos de una reserva; devuelve (datos, hora_inicio, duracion, error)
+
+    `error` es (mensaje, categoría) para flash o None.
+    """
+    fecha = formulario.get('fecha', '').strip()
+    hora_inicio = formulario.get('hora_inicio', '').strip()
+    duracion = formulario.get('duracion', '1').strip()
+    grupo = formulario.get('grupo', '').strip()
+    materia = formulario.get('materia', '').strip()
+    profesor = formulario.get('profesor', '').strip()
+    num_alumnos = formulario.get('num_alumnos', '').strip()
+    observaciones = formulario.get('observaciones', '').strip()
+    
+    # Validar campos obligatorios
+    if not fecha or not hora_inicio or not duracion or not grupo or not materia or not profesor:
+        return None, None, None, ('Fecha, hora, duración, grupo, materia y profesor son obligatorios', 'warning')
+    try:
+        datetime.strptime(fecha, '%Y-%m-%d')
+    except ValueError:
+        return None, None, None, ('Fecha inválida', 'danger')
+    
+    # Validar duración
+    try:
+        duracion_int = int(duracion)
+    except ValueError:
+        return None, None, None, ('Duración inválida', 'danger')
+    if duracion_int not in DURACIONES_RESERVA:
+        return None, None, None, ('La duración debe ser de 1 o 2 horas', 'danger')
+    
+    # Validar número de alumnos
+    try:
+        num_alumnos_int = int(num_alumnos) if num_alumnos else 0
+    except ValueError:
+        num_alumnos_int = 0
+    if num_alumnos_int < 0:
+        return None, None, None, ('El número de alumnos no puede ser negativo', 'danger')
+    
+    try:
+        int(hora_inicio.split(':')[0])
+    except ValueError:
+        return None, None, None, ('Hora de inicio inválida', 'danger')
+    
+    datos = {
+        'grupo': grupo,
+        'materia': materia,
+        'profesor': profesor,
+        'num_alumnos': str(num_alumnos_int),
+        'observaciones': observaciones,
+    }
+    return datos, hora_inicio, duracion_int, None
+
+@rutas.route('/calendario/reservar', methods=['POST'])
 @login_required
 def reservar_sesion():
     """Crear nueva reserva de sesión"""
     try:
         fecha = request.form.get('fecha', '').strip()
-        hora_inicio = request.form.get('hora_inicio', '').strip()
-        duracion = request.form.get('duracion', '1').strip()
-        grupo = request.form.get('grupo', '').strip()
-        materia = request.form.get('materia', '').strip()
-        profesor = request.form.get('profesor', '').strip()
-        num_alumnos = request.form.get('num_alumnos', '').strip()
-        observaciones = request.form.get('observaciones', '').strip()
-        
-        # Validar campos obligatorios
-        if not fecha or not hora_inicio or not duracion or not grupo or not materia or not profesor:
-            flash('Fecha, hora, duración, grupo, materia y profesor son obligatorios', 'warning')
+        datos, hora_inicio, duracion_int, error = validar_reserva(request.form)
+        if error:
+            flash(*error)
             return redirect(url_for('calendario_dia', fecha=fecha) if fecha else url_for('calendario'))
         
-        # Validar duración
-        try:
-            duracion_int = int(duracion)
-            if duracion_int not in [1, 2]:
-                flash('La duración debe ser de 1 o 2 horas', 'danger')
-                return redirect(url_for('calendario_dia', fecha=fecha))
-        except:
-            flash('Duración inválida', 'danger')
-            return redirect(url_for('calendario_dia', fecha=fecha))
-        
-        # Validar número de alumnos
-        try:
-            num_alumnos_int = int(num_alumnos) if num_alumnos else 0
-            if num_alumnos_int < 0:
-                flash('El número de alumnos no puede ser negativo', 'danger')
-                return redirect(url_for('calendario_dia', fecha=fecha))
-        except:
-            num_alumnos_int = 0
+        # Serie semanal: todas las fechas se comprueban y se guardan juntas
+        if request.form.get('repetir'):
+            return reservar_serie(fecha, hora_inicio, duracion_int, datos)
         
         # Verificar disponibilidad
-        disponible, mensaje = verificar_disponibilidad(fecha, hora_inicio, duracion)
+        disponible, mensaje = verificar_disponibilidad(fecha, hora_inicio, duracion_int)
         
         if not disponible:
             flash(mensaje, 'danger')
             return redirect(url_for('calendario_dia', fecha=fecha))
         
-        # Calcular hora de fin
-        try:
-            hora_inicio_int = int(hora_inicio.split(':')[0])
-            hora_fin_int = hora_inicio_int + duracion_int
-            hora_fin = f"{hora_fin_int:02d}:00"
-        except:
-            flash('Hora de inicio inválida', 'danger')
-            return redirect(url_for('calendario_dia', fecha=fecha))
-        
-        # Crear reserva
-        reservas = leer_csv(RESERVAS_CSV)
-        
-        nueva_reserva = {
-            'id_reserva': generar_id(),
-            'fecha': fecha,
-            'hora_inicio': hora_inicio,
-            'hora_fin': hora_fin,
-            'duracion': duracion,
-            'grupo': grupo,
-            'materia': materia,
-            'profesor': profesor,
-            'num_alumnos': str(num_alumnos_int),
-            'observaciones': observaciones,
-            'estado': 'confirmada',
-            'fecha_registro': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'responsable': session.get('nombre', '')
-        }
-        
-        reservas.append(nueva_reserva)
+        # Crear reserva (se vuelve a comprobar bajo el bloqueo de reservas)
+        creadas, conflictos = reservar_fechas(datos, [fecha], hora_inicio, duracion_int)
         
-        if escribir_csv(RESERVAS_CSV, reservas,
-                       ['id_reserva', 'fecha', 'hora_inicio', 'hora_fin', 'duracion',
-                        'grupo', 'materia', 'profesor', 'num_alumnos', 'observaciones', 
-                        'estado', 'fecha_registro', 'responsable']):
+        if creadas:
             flash('✅ Sesión reservada correctamente', 'success')
+        elif conflictos:
+            flash(conflictos[0][1], 'danger')
         else:
             flash('Error al reservar la sesión', 'danger')
         
@@ -1623,7 +5123,109 @@ def reservar_sesion():
         flash(f'Error al reservar sesión: {str(e)}', 'danger')
         return redirect(url_for('calendario'))
 
-@app.route('/calendario/cancelar/<id_reserva>')
+def reservar_serie(fecha, hora_inicio, duracion, datos):
+    """Reserva una serie semanal desde el formulario y muestra el resultado por fecha"""
+    hasta = request.form.get('hasta', '').strip()
+    try:
+        dias_semana = {int(d) for d in request.form.getlist('dias')} or \
+            {datetime.strptime(fecha, '%Y-%m-%d').weekday()}
+        excepciones = [e for e in request.form.get('excepciones', '').replace(',', ' ').split() if e]
+        for excepcion in excepciones:
+            datetime.strptime(excepcion, '%Y-%m-%d')
+        fechas, omitidas = fechas_serie(fecha, hasta, dias_semana, excepciones)
+    except ValueError:
+        flash('Fechas de la serie inválidas (use AAAA-MM-DD)', 'danger')
+        return redirect(url_for('calendario_dia', fecha=fecha))
+    
+    if not fechas:
+        flash('La serie no tiene fechas entre el inicio y la fecha final', 'warning')
+        return redirect(url_for('calendario_dia', fecha=fecha))
+    if len(fechas) > MAX_SESIONES_SERIE:
+        flash(f'La serie tiene {len(fechas)} sesiones; el máximo es {MAX_SESIONES_SERIE}', 'danger')
+        return redirect(url_for('calendario_dia', fecha=fecha))
+    
+    omitir_conflictos = bool(request.form.get('omitir_conflictos'))
+    creadas, conflictos = reservar_fechas(datos, fechas, hora_inicio, duracion, omitir_conflictos)
+    if creadas is None:
+        flash('Error al reservar la serie', 'danger')
+        return redirect(url_for('calendario_dia', fecha=fecha))
+    
+    motivos = dict(conflictos)
+    reservadas = {r['fecha'] for r in creadas}
+    resultados = [{'fecha': f, 'estado': 'reservada' if f in reservadas else 'conflicto' if f in motivos else 'no_reservada',
+                   'motivo': motivos.get(f, '')} for f in fechas]
+    resultados += [{'fecha': f, 'estado': 'excepcion', 'motivo': 'Excepción'} for f in omitidas]
+    resultados.sort(key=lambda r: r['fecha'])
+    
+    if creadas:
+        flash(f'✅ {len(creadas)} sesión(es) reservada(s)', 'success')
+    if conflictos:
+        flash(f'{len(conflictos)} fecha(s) con conflicto' +
+              ('' if omitir_conflictos else '; no se reservó ninguna sesión'), 'warning')
+    return render_template('serie_reservas.html', resultados=resultados, datos=datos,
+                           hora_inicio=hora_inicio, duracion=duracion, fecha=fecha, hasta=hasta)
+
+@rutas.route('/calendario/disponibilidad')
+@login_required
+def disponibilidad():
+    """Horarios libres y ocupados de un día o de su semana (JSON)"""
+    try:
+        fecha_obj = datetime.strptime(request.args.get('fecha', datetime.now().strftime('%Y-%m-%d')), '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'Fecha inválida (use AAAA-MM-DD)'}), 400
+    if request.args.get('vista') == 'semana':
+        lunes = fecha_obj - timedelta(days=fecha_obj.weekday())
+        fechas = [(lunes + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(7)]
+    else:
+        fechas = [fecha_obj.strftime('%Y-%m-%d')]
+    
+    ocupacion = indice_ocupacion()
+    return jsonify({
+        'apertura': f"{HORA_APERTURA:02d}:00",
+        'cierre': f"{HORA_CIERRE:02d}:00",
+        'dias': [{'fecha': f, 'horarios': grilla_disponibilidad(f, ocupacion)} for f in fechas],
+    })
+
+@rutas.route('/calendario/api/reservar', methods=['POST'])
+@login_required
+def reservar_sesion_api():
+    """Reserva una sesión y devuelve la grilla actualizada del día (JSON)"""
+    formulario = request.get_json(silent=True)
+    if isinstance(formulario, dict):
+        # Los números del JSON se validan igual que los del formulario
+        formulario = {clave: str(valor) for clave, valor in formulario.items() if valor is not None}
+    else:
+        formulario = request.form
+    datos, hora_inicio, duracion, error = validar_reserva(formulario)
+    fecha = formulario.get('fecha', '').strip()
+    if error:
+        return jsonify({'ok': False, 'mensaje': error[0]}), 400
+    
+    creadas, conflictos = reservar_fechas(datos, [fecha], hora_inicio, duracion)
+    if creadas:
+        codigo, mensaje = 200, '✅ Sesión reservada correctamente'
+    elif conflictos:
+        codigo, mensaje = 409, conflictos[0][1]
+    else:
+        codigo, mensaje = 500, 'Error al reservar la sesión'
+    
+    # La grilla y los fragmentos de la vista del día reflejan lo guardado
+    dia = datos_dia(fecha)
+    return jsonify({
+        'ok': bool(creadas),
+        'mensaje': mensaje,
+        'reserva': creadas[0] if creadas else None,
+        'fecha': fecha,
+        'horarios': grilla_disponibilidad(fecha),
+        'estadisticas': {clave: dia[clave] for clave in
+                         ('total_reservas', 'horas_reservadas', 'grupos_dia', 'materias_dia', 'horas_libres')},
+        'html': {
+            'horarios': render_template('_horarios_dia.html', **dia),
+            'reservas': render_template('_reservas_dia.html', **dia),
+        },
+    }), codigo
+
+@rutas.route('/calendario/cancelar/<id_reserva>')
 @login_required
 def cancelar_reserva(id_reserva):
     """Cancelar reserva de sesión"""
@@ -1659,7 +5261,7 @@ def cancelar_reserva(id_reserva):
         flash(f'Error al cancelar reserva: {str(e)}', 'danger')
         return redirect(url_for('calendario'))
 
-@app.route('/calendario/eliminar/<id_reserva>')
+@rutas.route('/calendario/eliminar/<id_reserva>')
 @login_required
 @admin_required
 def eliminar_reserva(id_reserva):
@@ -1690,28 +5292,49 @@ def eliminar_reserva(id_reserva):
         flash(f'Error al eliminar reserva: {str(e)}', 'danger')
         return redirect(url_for('calendario'))
 
+@rutas.route('/calendario/ics')
+@rutas.route('/calendario/ics/<tipo>/<path:valor>')
+def calendario_ics(tipo='laboratorio', valor=None):
+    """Feed iCalendar del laboratorio, de un profesor o de un grupo"""
+    # Los clientes de calendario no inician sesión: usan el token configurado
+    token = current_app.config.get('ICS_TOKEN')
+    if 'username' not in session and not (token and request.args.get('token') == token):
+        return Response('Acceso restringido\n', status=403, mimetype='text/plain')
+    if tipo not in FILTROS_ICS or (tipo == 'laboratorio') != (valor is None):
+        return Response('Calendario no encontrado\n', status=404, mimetype='text/plain')
+    
+    cuerpo, etag = feed_ics(tipo, valor)
+    if request.if_none_match.contains(etag):
+        metricas.sumar('xonilab_ics_total', {'resultado': '304'})
+        respuesta = Response(status=304)
+    else:
+        metricas.sumar('xonilab_ics_total', {'resultado': '200'})
+        nombre = secure_filename(valor or 'laboratorio') or 'calendario'
+        respuesta = Response(cuerpo, mimetype='text/calendar')
+        respuesta.headers['Content-Disposition'] = f'inline; filename="{nombre}.ics"'
+    respuesta.set_etag(etag)
+    respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
 # =============================================
 # RUTAS ADICIONALES
 # =============================================
 
-@app.route('/reportes')
+@rutas.route('/reportes')
 @login_required
+@pagina_cacheable
 def reportes():
     """Página de reportes"""
     try:
-        # Obtener datos para reportes
+        # Obtener datos para reportes; préstamos, deudas y reservas se
+        # recorren una vez sobre lo vigente y lo archivado
         inventario = leer_csv(INVENTARIO_CSV)
-        prestamos = leer_csv(PRESTAMOS_CSV)
         alumnos = leer_csv(ALUMNOS_CSV)
-        deudas = leer_csv(DEUDAS_CSV)
-        reservas = leer_csv(RESERVAS_CSV)
         
         # Estadísticas generales
         total_items = len(inventario)
-        total_prestamos = len(prestamos)
         total_alumnos = len(alumnos)
-        total_deudas = len(deudas)
-        total_reservas = len([r for r in reservas if r.get('estado') == 'confirmada'])
+        total_deudas = sum(1 for _ in historial(DEUDAS_CSV))
         
         # Inventario por categoría
         categorias = {}
@@ -1729,7 +5352,9 @@ def reportes():
             mes_key = fecha.strftime('%Y-%m')
             prestamos_por_mes[mes_key] = 0
         
-        for prestamo in prestamos:
+        total_prestamos = 0
+        for prestamo in historial(PRESTAMOS_CSV):
+            total_prestamos += 1
             try:
                 fecha = datetime.strptime(prestamo['fecha_prestamo'][:7], '%Y-%m')
                 mes_key = fecha.strftime('%Y-%m')
@@ -1753,9 +5378,11 @@ def reportes():
             mes_key = fecha.strftime('%Y-%m')
             reservas_por_mes[mes_key] = 0
         
-        for reserva in reservas:
+        total_reservas = 0
+        for reserva in historial(RESERVAS_CSV):
             try:
                 if reserva.get('estado') == 'confirmada':
+                    total_reservas += 1
                     mes_key = reserva['fecha'][:7]
                     if mes_key in reservas_por_mes:
                         reservas_por_mes[mes_key] += 1
@@ -1794,21 +5421,142 @@ def reportes():
                              reservas_mes=[],
                              today=datetime.now().strftime('%Y-%m-%d'))
 
-@app.route('/configuracion')
+@rutas.route('/configuracion')
 @login_required
 @admin_required
 def configuracion():
     """Página de configuración del sistema"""
     return render_template('configuracion.html')
 
-@app.route('/backup')
+@rutas.route('/consistencia')
+@login_required
+@admin_required
+def consistencia():
+    """Verificación de consistencia entre tablas"""
+    problemas = verificar_consistencia()
+    resumen = resumir_problemas(problemas)
+    grupos = [{'tipo': tipo,
+               'descripcion': TIPOS_PROBLEMA[tipo][0],
+               'reparable': TIPOS_PROBLEMA[tipo][1],
+               'total': resumen[tipo],
+               'ejemplos': [p for p in problemas if p['tipo'] == tipo][:50]}
+              for tipo in TIPOS_PROBLEMA if tipo in resumen]
+    return render_template('consistencia.html', grupos=grupos, total=len(problemas))
+
+@rutas.route('/consistencia/reparar', methods=['POST'])
+@login_required
+@admin_required
+def reparar():
+    """Reparar los problemas seleccionados"""
+    try:
+        tipos = [t for t in request.form.getlist('tipo') if TIPOS_PROBLEMA.get(t, ('', False))[1]]
+        if not tipos:
+            flash('Seleccione al menos un tipo de problema reparable', 'warning')
+            return redirect(url_for('consistencia'))
+        
+        reparados = reparar_consistencia(tipos)
+        if reparados:
+            detalle = ', '.join(f"{n} en {tabla}" for tabla, n in reparados.items())
+            flash(f'✅ Filas reparadas: {detalle}', 'success')
+        else:
+            flash('No había filas que reparar', 'info')
+        return redirect(url_for('consistencia'))
+    
+    except Exception as e:
+        flash(f'Error al reparar: {str(e)}', 'danger')
+        return redirect(url_for('consistencia'))
+
+@rutas.route('/notificaciones')
+@login_required
+@admin_required
+def notificaciones():
+    """Bandeja de salida de recordatorios"""
+    bandeja = leer_csv(NOTIFICACIONES_CSV)
+    resumen = {}
+    for n in bandeja:
+        resumen[n['estado']] = resumen.get(n['estado'], 0) + 1
+    bandeja.sort(key=lambda n: n['fecha_creacion'], reverse=True)
+    return render_template('notificaciones.html',
+                           notificaciones=bandeja[:200],
+                           resumen=resumen,
+                           transporte=current_app.config['NOTIFICACIONES_TRANSPORTE'])
+
+@rutas.route('/notificaciones/encolar', methods=['POST'])
+@login_required
+@admin_required
+def encolar_notificaciones():
+    """Encolar los recordatorios del día (el envío lo hace el notificador)"""
+    try:
+        resultado = encolar_recordatorios()
+        mensaje = f"✅ Recordatorios encolados: {resultado['encolados']}"
+        if resultado['sin_correo']:
+            mensaje += f" ({resultado['sin_correo']} alumno(s) sin correo)"
+        flash(mensaje, 'success')
+    except Exception as e:
+        flash(f'Error al encolar recordatorios: {str(e)}', 'danger')
+    return redirect(url_for('notificaciones'))
+
+@rutas.route('/metrics')
+def metrics():
+    """Métricas del proceso en formato Prometheus (solo administradores)"""
+    # Un recolector puede autenticarse con el token configurado
+    token = current_app.config.get('METRICS_TOKEN')
+    autorizado_token = token and request.headers.get('Authorization') == f'Bearer {token}'
+    if not autorizado_token and session.get('rol') != 'admin':
+        return Response('Acceso restringido\n', status=403, mimetype='text/plain')
+    return Response(metricas.exportar(), mimetype='text/plain; version=0.0.4')
+
+@rutas.route('/perfiles')
+@login_required
+@admin_required
+def perfiles():
+    """Listado de peticiones perfiladas"""
+    carpeta = current_app.config['PERFILES_FOLDER']
+    return render_template('perfiles.html',
+                         perfiles=listar_perfiles(carpeta),
+                         perfil=None,
+                         muestreo=current_app.config.get('PERFIL_MUESTREO', 0),
+                         motor=current_app.config.get('PERFIL_MOTOR', 'cprofile'))
+
+@rutas.route('/perfiles/<nombre>')
+@login_required
+@admin_required
+def perfil_detalle(nombre):
+    """Ver el reporte de un perfil"""
+    carpeta = current_app.config['PERFILES_FOLDER']
+    nombre = os.path.basename(nombre)
+    perfil = next((p for p in listar_perfiles(carpeta) if p.get('nombre') == nombre), None)
+    if not perfil:
+        flash('Perfil no encontrado', 'danger')
+        return redirect(url_for('perfiles'))
+    
+    # Los perfiles de pyinstrument tienen su propio reporte HTML interactivo
+    if perfil.get('motor') == 'pyinstrument' and request.args.get('formato') != 'texto':
+        return send_file(os.path.join(carpeta, nombre + '.html'))
+    
+    with open(os.path.join(carpeta, nombre + '.txt'), 'r', encoding='utf-8') as f:
+        reporte = f.read()
+    return render_template('perfiles.html', perfiles=[], perfil=perfil, reporte=reporte)
+
+@rutas.route('/perfiles/descargar/<nombre>')
+@login_required
+@admin_required
+def perfil_descargar(nombre):
+    """Descargar el perfil en formato pstats (.prof)"""
+    ruta = os.path.join(current_app.config['PERFILES_FOLDER'], os.path.basename(nombre) + '.prof')
+    if not os.path.exists(ruta):
+        flash('Perfil no encontrado', 'danger')
+        return redirect(url_for('perfiles'))
+    return send_file(ruta, as_attachment=True, download_name=os.path.basename(ruta))
+
+@rutas.route('/backup')
 @login_required
 @admin_required
 def backup():
     """Crear copia de seguridad"""
     try:
         # Crear directorio de backups si no existe
-        backup_dir = os.path.join(BASE_DIR, 'backups')
+        backup_dir = current_app.config['BACKUP_FOLDER']
         os.makedirs(backup_dir, exist_ok=True)
         
         # Nombre del archivo de backup
@@ -1818,20 +5566,26 @@ def backup():
         # Importar módulo de zip
         import zipfile
         
+        # Integrar cambios pendientes para respaldar instantáneas completas
+        compactar_todo()
+        
         # Crear archivo zip
         with zipfile.ZipFile(backup_file, 'w', zipfile.ZIP_DEFLATED) as zipf:
             # Agregar archivos CSV
-            csv_files = [USUARIOS_CSV, INVENTARIO_CSV, PRESTAMOS_CSV, 
-                        ALUMNOS_CSV, DEUDAS_CSV, RESERVAS_CSV]
+            for csv_file in TABLAS_CSV:
+                csv_path = ruta_datos(csv_file)
+                if os.path.exists(csv_path):
+                    zipf.write(csv_path, csv_file)
             
-            for csv_file in csv_files:
-                if os.path.exists(csv_file):
-                    zipf.write(csv_file, os.path.basename(csv_file))
+            # Agregar archivos históricos
+            for tabla in TABLAS_ARCHIVO:
+                for _, ruta in particiones(tabla):
+                    zipf.write(ruta, os.path.join(CARPETA_ARCHIVO, os.path.basename(ruta)))
             
             # Agregar códigos QR
-            if os.path.exists(QR_FOLDER):
-                for qr_file in os.listdir(QR_FOLDER):
-                    qr_path = os.path.join(QR_FOLDER, qr_file)
+            if os.path.exists(carpeta_qr()):
+                for qr_file in os.listdir(carpeta_qr()):
+                    qr_path = os.path.join(carpeta_qr(), qr_file)
                     if os.path.isfile(qr_path):
                         zipf.write(qr_path, os.path.join('qrcodes', qr_file))
         
@@ -1861,26 +5615,125 @@ def backup():
 # ERROR HANDLERS
 # =============================================
 
-@app.errorhandler(404)
+@rutas.errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@rutas.errorhandler(500)
 def internal_server_error(e):
     return render_template('500.html'), 500
 
+# =============================================
+# FÁBRICA DE LA APLICACIÓN
+# =============================================
+
+def crear_app(config=None):
+    """Crea y configura una instancia de la aplicación
+    
+    `config` puede indicar otras carpetas (CSV_FOLDER, QR_FOLDER,
+    BACKUP_FOLDER), p. ej. para crear instancias aisladas en pruebas.
+    """
+    configurar_locale()
+    
+    app = Flask(__name__)
+    app.secret_key = "xonilab_Darian_Alberto_Camacho_Salas"
+    app.config.update(
+        CSV_FOLDER=os.environ.get('XONILAB_DATOS', CSV_FOLDER),
+        QR_FOLDER=QR_FOLDER,
+        BACKUP_FOLDER=BACKUP_FOLDER,
+        COMPACTADOR=True,
+        SERVER_TIMING=os.environ.get('XONILAB_SERVER_TIMING', 'False').lower() == 'true',
+        METRICS_TOKEN=os.environ.get('XONILAB_METRICS_TOKEN', ''),
+        PERFILES_FOLDER=PERFILES_FOLDER,
+        PERFIL_MUESTREO=float(os.environ.get('XONILAB_PERFIL_MUESTREO', 0)),
+        PERFIL_MOTOR=os.environ.get('XONILAB_PERFIL_MOTOR', 'cprofile'),
+        PERFIL_MAXIMO=200,
+        REFERENCIAS_NORMALIZADAS=os.environ.get('XONILAB_NORMALIZADO', 'False').lower() == 'true',
+        REPORTES_FOLDER=os.environ.get('XONILAB_REPORTES', REPORTES_FOLDER),
+        REVISION_VENCIDOS=True,
+        ARCHIVADOR=os.environ.get('XONILAB_ARCHIVAR', 'True').lower() == 'true',
+        ARCHIVO_DIAS=int(os.environ.get('XONILAB_ARCHIVO_DIAS', 30)),
+        ARCHIVO_PERIODO=os.environ.get('XONILAB_ARCHIVO_PERIODO', 'semestre'),
+        ARCHIVO_GZIP=os.environ.get('XONILAB_ARCHIVO_GZIP', 'False').lower() == 'true',
+        INDICE_FILAS=os.environ.get('XONILAB_INDICE_FILAS', 'False').lower() == 'true',
+        NOTIFICACIONES_TRANSPORTE=os.environ.get('XONILAB_NOTIFICAR', ''),
+        NOTIFICACIONES_SMTP=os.environ.get('XONILAB_SMTP', 'localhost:1025'),
+        NOTIFICACIONES_REMITENTE=os.environ.get('XONILAB_REMITENTE', 'laboratorio@xonilab.local'),
+        NOTIFICACIONES_FOLDER=NOTIFICACIONES_FOLDER,
+        NOTIFICACIONES_POR_MINUTO=int(os.environ.get('XONILAB_NOTIFICAR_POR_MINUTO', 30)),
+        NOTIFICACIONES_INTENTOS=5,
+        ICS_TOKEN=os.environ.get('XONILAB_ICS_TOKEN', ''),
+        ICS_ZONA=os.environ.get('XONILAB_ZONA', 'America/Mexico_City'),
+        ICS_LABORATORIO=os.environ.get('XONILAB_LABORATORIO', 'XONILAB'),
+        DIAS_PRESTAMO_ESCANEO=int(os.environ.get('XONILAB_DIAS_PRESTAMO', 7)),
+        EVENTOS_BUFFER=int(os.environ.get('XONILAB_EVENTOS_BUFFER', 64)),
+        EVENTOS_CLIENTES=int(os.environ.get('XONILAB_EVENTOS_CLIENTES', 50)),
+        SERVIDOR_HILOS=int(os.environ.get('XONILAB_THREADS', 0)),
+        SERVIDOR_TIMEOUT=int(os.environ.get('XONILAB_TIMEOUT', 0)),
+        EVENTOS_INTERVALO=float(os.environ.get('XONILAB_EVENTOS_INTERVALO', 2)),
+        CACHE_PAGINAS=os.environ.get('XONILAB_CACHE_PAGINAS', 'True').lower() == 'true',
+        CACHE_PAGINAS_BYTES=int(os.environ.get('XONILAB_CACHE_PAGINAS_BYTES', 32 * 1024 * 1024)),
+        ASSETS_FOLDER=ASSETS_FOLDER,
+    )
+    app.config.update(config or {})
+    
+    # Sin static/dist/ las páginas siguen cargando los recursos desde los CDN
+    if not os.path.exists(os.path.join(app.config['ASSETS_FOLDER'], 'manifest.json')):
+        print("⚠️  Recursos locales sin generar: ejecute `python assets.py` para no depender de CDNs")
+    
+    # Preparar carpetas y archivos de datos
+    os.makedirs(app.config['CSV_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['QR_FOLDER'], exist_ok=True)
+    inicializar_csv(app.config['CSV_FOLDER'])
+    inicializar_movimientos(app.config['CSV_FOLDER'])
+    
+    # Modo de referencias normalizadas (préstamos y deudas solo con claves)
+    if app.config['REFERENCIAS_NORMALIZADAS']:
+        with app.app_context():
+            migrar_referencias(True)
+    
+    # Integrar registros pendientes y programar la compactación periódica
+    compactar_todo(app.config['CSV_FOLDER'])
+    if app.config['COMPACTADOR']:
+        iniciar_compactador(app.config['CSV_FOLDER'])
+    
+    # Mover a los archivos históricos lo cerrado y seguir haciéndolo periódicamente
+    if app.config['ARCHIVADOR']:
+        with app.app_context():
+            archivar_todo()
+        iniciar_archivador(app)
+    
+    # Índice de posiciones de préstamos: construirlo antes de la primera consulta
+    if app.config['INDICE_FILAS']:
+        with app.app_context():
+            indice_filas(ruta_datos(PRESTAMOS_CSV))
+    
+    # Reporte diario de préstamos vencidos
+    if app.config['REVISION_VENCIDOS']:
+        iniciar_revision_vencidos(app)
+    
+    # Entrega de recordatorios (solo si hay transporte configurado)
+    if app.config['NOTIFICACIONES_TRANSPORTE'] not in ('', *TRANSPORTES):
+        print(f"⚠️  Transporte de notificaciones desconocido: '{app.config['NOTIFICACIONES_TRANSPORTE']}' "
+              f"(opciones: {', '.join(sorted(TRANSPORTES))}); no se entregarán recordatorios")
+    elif app.config['NOTIFICACIONES_TRANSPORTE']:
+        iniciar_notificador(app)
+    
+    rutas.instalar(app)
+    return app
+
 # =============================================
 # EJECUCIÓN PRINCIPAL
 # =============================================
 
 if __name__ == '__main__':
-    # Inicializar archivos CSV
-    inicializar_csv()
+    # Crear la aplicación (inicializa archivos CSV)
+    app = crear_app()
     
     # Configuración de la aplicación
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5005))
-    debug = os.environ.get('DEBUG', 'True').lower() == 'true'
+    debug = os.environ.get('DEBUG', 'False').lower() == 'true'
     
     # URL del sistema
     url = f"http://{host}:{port}"
@@ -1923,6 +5776,9 @@ if __name__ == '__main__':
     print("  ✓ QR para cada ítem del inventario")
     print("  ✓ Descarga de códigos QR")
     print("  ✓ Respaldo automático de QR en backups")
+    print()
+    print("⚙️  SERVIDOR DE DESARROLLO (un solo proceso)")
+    print("  Para producción use: python servidor.py --workers 4 --threads 4")
     print("=" * 80)
     
     # Iniciar servidor
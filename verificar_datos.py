@@ -0,0 +1,57 @@
+#XONILAB - Verificación de consistencia de datos
+#Revisa referencias entre tablas y stock en una sola pasada y, opcionalmente,
+#aplica las reparaciones automáticas (una escritura por tabla).
+#
+#Uso:
+#  python verificar_datos.py
+#  python verificar_datos.py --datos /ruta/data --reparar estado_stock,prestamo_copia_desactualizada
+#  python verificar_datos.py --reparar todo
+
+import argparse
+import json
+import sys
+
+from start import (crear_app, verificar_consistencia, resumir_problemas,
+                   reparar_consistencia, TIPOS_PROBLEMA)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verificación de consistencia de XONILAB')
+    parser.add_argument('--datos', help='Carpeta de datos (por defecto la de la aplicación)')
+    parser.add_argument('--reparar', help="Tipos a reparar separados por comas, o 'todo'")
+    parser.add_argument('--json', action='store_true', help='Imprimir los problemas en JSON')
+    parser.add_argument('--limite', type=int, default=10, help='Ejemplos por tipo a mostrar')
+    args = parser.parse_args()
+
+    config = {'COMPACTADOR': False, 'REVISION_VENCIDOS': False, 'ARCHIVADOR': False}
+    if args.datos:
+        config['CSV_FOLDER'] = args.datos
+    app = crear_app(config)
+
+    with app.app_context():
+        if args.reparar:
+            tipos = [t for t, (_, reparable) in TIPOS_PROBLEMA.items() if reparable]
+            if args.reparar != 'todo':
+                tipos = [t for t in args.reparar.split(',') if t in tipos]
+            for tabla, n in reparar_consistencia(tipos).items():
+                print(f"✅ {n} fila(s) reparadas en {tabla}")
+
+        problemas = verificar_consistencia()
+
+    if args.json:
+        print(json.dumps(problemas, ensure_ascii=False, indent=2))
+    else:
+        resumen = resumir_problemas(problemas)
+        if not problemas:
+            print("✅ Sin problemas de consistencia")
+        for tipo, total in resumen.items():
+            descripcion, reparable = TIPOS_PROBLEMA[tipo]
+            print(f"\n{'🔧' if reparable else '⚠️ '} {tipo} - {descripcion}: {total}")
+            for p in [p for p in problemas if p['tipo'] == tipo][:args.limite]:
+                print(f"    {p['tabla']} {p['id']}: {p['detalle']}")
+
+    sys.exit(1 if problemas else 0)
+
+
+if __name__ == '__main__':
+    main()
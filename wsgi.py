@@ -0,0 +1,6 @@
+#XONILAB - Punto de entrada WSGI
+#Uso: gunicorn -w 4 --threads 4 -b 0.0.0.0:5005 wsgi:application
+
+from start import crear_app
+
+application = crear_app()